@@ -1,19 +1,25 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import asyncio
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import os
 from dotenv import load_dotenv
 
 # services
 from ..config.database import db_manager
+from ..config.embeddings import get_cache_stats, get_batcher
+from ..config.query_cache import query_cache
+from ..config.llm_client import llm_client
+from ..config.single_flight import single_flight
 from ..services.chat_service import chat_service
 from ..services.notification_service import notification_service
 from ..services.vector_indexer import vector_indexer
+from ..services.incremental_indexer import incremental_indexer
+from ..services.neighbor_table import neighbor_table
 from ..services.rag_service import rag_service
-from ..models.chat import ChatRequest, ChatResponse
+from ..models.chat import ChatRequest, ChatResponse, BatchSearchRequest
 from ..models.notification import (
     Notification, NotificationPreferences, NotificationType, 
     NotificationChannel, NotificationPriority
@@ -62,7 +68,8 @@ async def startup_event():
     try:
         await db_manager.connect()
         await notification_service.create_default_templates()
-        await vector_indexer.full_reindex()   # Index data for semantic search
+        # Keeps the index in sync from a change stream, bootstrapping it in the background if empty
+        await incremental_indexer.start()
         
         print("AI Assistant started successfully!")
     except Exception as e:
@@ -71,6 +78,8 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     try:
+        await incremental_indexer.stop()
+        await llm_client.close()
         await db_manager.disconnect()
         print("AI Assistant shutdown complete!")
     except Exception as e:
@@ -85,11 +94,34 @@ async def health_check():
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest):
     try:
-        response = await chat_service.process_message(request, user_id=request.user_id, session_id=str(request.session_id))
+        response = await chat_service.process_message(
+            request.message,
+            user_id=request.user_id,
+            session_id=str(request.session_id),
+            use_cache=request.use_cache
+        )
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """Server-sent events: sources, then a token event per chunk, then done with the saved message"""
+    async def events():
+        async for event in chat_service.stream_message(
+            request.message,
+            user_id=request.user_id,
+            session_id=str(request.session_id),
+            use_cache=request.use_cache
+        ):
+            yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/chat/session/{session_id}")
 async def get_chat_history(session_id: str, user_id: str):
     try:
@@ -114,13 +146,26 @@ async def websocket_chat_endpoint(websocket: WebSocket, user_id: str):
                 message=message_data.get("message", ""),
                 user_id=user_id,
                 session_id=message_data.get("session_id"),
-                context=message_data.get("context")
+                context=message_data.get("context"),
+                use_cache=message_data.get("use_cache", True)
             )
             
+            if message_data.get("stream"):
+                # One frame per event, the last one is "done" (or "error")
+                async for event in chat_service.stream_message(
+                    chat_request.message,
+                    user_id=user_id,
+                    session_id=str(chat_request.session_id),
+                    use_cache=chat_request.use_cache
+                ):
+                    await websocket.send_text(json.dumps(event, default=str))
+                continue
+            
             response = await chat_service.process_message(
-                chat_request, 
+                chat_request.message, 
                 user_id=user_id, 
-                session_id=str(chat_request.session_id)
+                session_id=str(chat_request.session_id),
+                use_cache=chat_request.use_cache
             )
             
             # Send response back
@@ -164,6 +209,13 @@ async def create_notification_from_template(
     #     raise HTTPException(status_code=404, detail="Template not found")
     return notification
 
+@app.get("/notifications/{notification_id}/progress")
+async def get_notification_progress(notification_id: str):
+    progress = await notification_service.get_progress(notification_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Notification not found")
+    return progress
+
 @app.get("/notifications/user/{user_id}")
 async def get_user_notifications(
     user_id: str,
@@ -216,10 +268,51 @@ async def websocket_notifications_endpoint(websocket: WebSocket, user_id: str):
 
 # Vector search endpoints
 @app.get("/search")
-async def semantic_search(query: str, top_k: int = 5):
-    results = await db_manager.semantic_search(query, top_k)
+async def semantic_search(
+    query: str,
+    top_k: int = 5,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    type: Optional[str] = None,
+    category: Optional[str] = None,
+    price_lt: Optional[float] = None,
+    price_gt: Optional[float] = None,
+    is_published: Optional[bool] = None,
+    hybrid: bool = False
+):
+    filters = {
+        "type": type, "category": category, "price_lt": price_lt,
+        "price_gt": price_gt, "is_published": is_published
+    }
+    filters = {field: value for field, value in filters.items() if value is not None}
+    if hybrid:
+        results = await db_manager.hybrid_search(query, top_k, filters=filters)
+    else:
+        results = await db_manager.semantic_search(query, top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)
     return {"query": query, "results": results}
 
+@app.get("/similar/{entity_type}/{item_id}")
+async def similar_items(entity_type: str, item_id: str, k: int = 10):
+    # Served from stored vectors (or the precomputed table), never by re-encoding text
+    results = await neighbor_table.get(entity_type, item_id, k)
+    source = "table"
+    if results is None:
+        results = await db_manager.similar_items(entity_type, item_id, k)
+        source = "index"
+    if results is None:
+        raise HTTPException(status_code=404, detail=f"{entity_type} {item_id} is not indexed")
+    return {"type": entity_type, "id": item_id, "source": source, "results": results}
+
+@app.post("/search/batch")
+async def semantic_search_batch(request: BatchSearchRequest):
+    results = await db_manager.semantic_search_many(request.queries, request.top_k, filters=request.filters)
+    return {
+        "results": [
+            {"query": query, "results": query_results}
+            for query, query_results in zip(request.queries, results)
+        ]
+    }
+
 # @app.post("/index/reindex")
 # async def reindex_data(data_type: str, data_id: str = None):
 #     await vector_indexer.reindex_specific_data(data_type, data_id)
@@ -245,7 +338,15 @@ async def get_admin_stats():
             "orders": order_count,
             "users": user_count,
             "notifications": notification_count,
-            "vector_index_size": len(db_manager.vector_mapping) if db_manager.vector_mapping else 0
+            "vector_index_size": db_manager.vector_count(),
+            "incremental_indexer": incremental_indexer.get_status(),
+            "embedding_cache": get_cache_stats(),
+            "embedding_batcher": get_batcher().get_stats(),
+            "query_cache": query_cache.get_stats(),
+            "response_cache": rag_service.response_cache.get_stats(),
+            "llm": llm_client.get_stats(),
+            "session_memory": rag_service.session_memory.get_stats(),
+            "single_flight": single_flight.get_stats()
         }
 
 @app.exception_handler(Exception)
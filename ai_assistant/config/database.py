@@ -1,11 +1,47 @@
 import os
+import uuid
+import zlib
+import heapq
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from motor.motor_asyncio import AsyncIOMotorClient
-import faiss
 import numpy as np
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Optional
 import pickle
 import json
-import base64
+from .vector_shard import VectorShard
+from .vector_index import IdMappedIndex
+from .index_factory import IndexConfig
+from .query_cache import query_cache
+from .single_flight import single_flight
+
+ENTITY_TYPES = ("product", "order", "user")
+# Optional hash sharding inside a type, e.g. "product=4,order=2". Changing it needs a full reindex
+HASH_SHARDS = {
+    entity_type.strip(): int(count)
+    for entity_type, _, count in (item.partition("=") for item in os.getenv("VECTOR_HASH_SHARDS", "").split(",") if "=" in item)
+}
+SEARCH_THREADS = int(os.getenv("VECTOR_SEARCH_THREADS", str(os.cpu_count() or 4)))
+# Reciprocal rank fusion constant and how many hits each retriever contributes to hybrid search
+RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+# Vectors without a known type
+OTHER_SHARD_TYPE = "other"
+# The single index used before sharding, moved into the shards on first start
+LEGACY_INDEX_NAME = "main_index"
+
+# Only the fields the indexer turns into text/metadata
+INDEXING_PROJECTIONS = {
+    "products": {
+        "name": 1, "description": 1, "category": 1, "brand": 1, "material": 1, "tags": 1, "price": 1,
+        "gender": 1, "collections": 1, "sizes": 1, "colors": 1, "isFeatured": 1, "isPublished": 1,
+    },
+    "orders": {
+        "orderNumber": 1, "status": 1, "shippingAddress.address": 1, "orderItems.name": 1,
+        "orderItems.size": 1, "orderItems.color": 1, "totalPrice": 1, "user": 1, "createdAt": 1,
+    },
+    "users": {"name": 1, "email": 1, "role": 1},
+}
 
 class DatabaseManager:
     def __init__(self):
@@ -13,8 +49,24 @@ class DatabaseManager:
         self.db_name = os.getenv("DB_NAME", "Odoo DB")
         self.client = None
         self.db = None
-        self.vector_index = None
         self.vector_dimension = 384  # For all-MiniLM-L6-v2
+        self.index_config = IndexConfig()
+        # Shard name -> VectorShard, grouped per entity type in shard_groups
+        self.shards: Dict[str, VectorShard] = {}
+        self.shard_groups: Dict[str, List[VectorShard]] = {}
+        self._search_pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="vector-search")
+        # Shard name -> replacement index while a rebuild is in progress
+        self._staging: Optional[Dict[str, IdMappedIndex]] = None
+    
+    def vector_count(self) -> int:
+        return sum(len(shard) for shard in self.shards.values())
+    
+    def type_counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for shard in self.shards.values():
+            for entity_type, count in shard.type_counts().items():
+                counts[entity_type] = counts.get(entity_type, 0) + count
+        return counts
         
     async def connect(self):
         try:
@@ -27,124 +79,399 @@ class DatabaseManager:
             raise
     
     async def disconnect(self):
+        for shard in self.shards.values():
+            await shard.wait_idle()
         if self.client:
+            await self.flush_vector_index()
             self.client.close()
             print("Disconnected from MongoDB")
     
+    def _create_shards(self):
+        self.shards, self.shard_groups = {}, {}
+        for entity_type in ENTITY_TYPES + (OTHER_SHARD_TYPE,):
+            count = max(HASH_SHARDS.get(entity_type, 1), 1)
+            names = [f"{entity_type}_index"] if count == 1 else [f"{entity_type}_index_{i}" for i in range(count)]
+            group = [VectorShard(name, self.db, self.index_config, self.vector_dimension) for name in names]
+            self.shard_groups[entity_type] = group
+            self.shards.update((shard.name, shard) for shard in group)
+    
     async def initialize_vector_index(self):
+        """Load every shard from its snapshot plus the segments logged after it"""
         try:
             if self.db is None:
                 raise Exception("Database connection is not established")
-            index_data = await self.db.vector_index.find_one({"name": "main_index"})
-            
-            if index_data:
-                index_bytes = base64.b64decode(index_data["index_data"])
-                self.vector_index = faiss.read_index_from_buffer(index_bytes)
-                
-                mapping_data = await self.db.vector_mapping.find({}).to_list(length=None)
-                self.vector_mapping = [doc["metadata"] for doc in mapping_data]
-                
-                print(f"Loaded existing vector index from MongoDB with {len(self.vector_mapping)} entries")
-            else:
-                self.vector_index = faiss.IndexFlatIP(self.vector_dimension)
-                self.vector_mapping = []
-                print("Created new vector index")
+            self._create_shards()
+            await next(iter(self.shards.values())).store.ensure_indexes()
+            await asyncio.gather(*(shard.load() for shard in self.shards.values()))
+            await self._migrate_legacy_index()
+            # Snapshots written with another index type (e.g. old flat ones) are rebuilt in the background
+            for shard in self.shards.values():
+                shard.maybe_schedule_migration()
         except Exception as e:
             print(f"Error initializing vector index: {e}")
-            self.vector_index = faiss.IndexFlatIP(self.vector_dimension)
-            self.vector_mapping = []
+            if not self.shards:
+                self._create_shards()
+    
+    async def _migrate_legacy_index(self):
+        """Move the pre-sharding single index into the shards, once"""
+        legacy = VectorShard(LEGACY_INDEX_NAME, self.db, self.index_config, self.vector_dimension)
+        if await self.db.vector_index.find_one({"name": LEGACY_INDEX_NAME}, {"_id": 1}) is None:
+            return
+        await legacy.load()
+        doc_ids, vectors, metadata = legacy.export()
+        if doc_ids:
+            await self.upsert_vectors(doc_ids, vectors, metadata)
+            await self.compact_vector_index()
+        await legacy.store.drop()
+        print(f"Moved {len(doc_ids)} vectors from {LEGACY_INDEX_NAME} into per-type shards")
     
     async def save_vector_index(self):
-        try:
-            if not self.vector_index or self.db is None:
-                print("Database connection is not established or vector index is missing.")
-                return
-                
-            # Save FAISS index to MongoDB
-            index_bytes = faiss.write_index_to_buffer(self.vector_index)
-            index_b64 = base64.b64encode(index_bytes).decode('utf-8')
-            
-            await self.db.vector_index.update_one(
-                {"name": "main_index"},
-                {
-                    "$set": {
-                        "name": "main_index",
-                        "index_data": index_b64,
-                        "dimension": self.vector_dimension,
-                        "updated_at": self._get_current_timestamp()
-                    }
-                },
-                upsert=True
-            )
-            await self.db.vector_mapping.delete_many({})
-            
-            # new mapping
-            if self.vector_mapping:
-                mapping_docs = [
-                    {
-                        "index": i,
-                        "metadata": metadata,
-                        "created_at": self._get_current_timestamp()
-                    }
-                    for i, metadata in enumerate(self.vector_mapping)
-                ]
-                await self.db.vector_mapping.insert_many(mapping_docs)
-            
-            print(f"Vector index saved to MongoDB with {len(self.vector_mapping)} entries")
-        except Exception as e:
-            print(f"Error saving vector index to MongoDB: {e}")
+        """Write a full snapshot of every shard. Regular writes go through flush_vector_index"""
+        await self.compact_vector_index()
     
-    async def add_to_vector_index(self, embedding: List[float], metadata: Dict[str, Any]):
-        embedding_array = np.array([embedding], dtype=np.float32)
-        if self.vector_index is None:
+    async def compact_vector_index(self):
+        if not self.shards or self.db is None:
+            print("Database connection is not established or vector index is missing.")
+            return
+        await asyncio.gather(*(shard.compact() for shard in self.shards.values()))
+    
+    async def _ensure_vector_index(self) -> bool:
+        if not self.shards:
             await self.initialize_vector_index()
-        if self.vector_index is not None:
-            self.vector_index.add(embedding_array)
-            self.vector_mapping.append(metadata)
-            await self.save_vector_index()
-        else:
+        if not self.shards:
             print("Failed to initialize vector index")
-            
+            return False
+        return True
     
-    async def semantic_search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        from config.embeddings import get_embedding
+    def _shard_for(self, entity_type: str, doc_id: str) -> VectorShard:
+        group = self.shard_groups.get(entity_type) or self.shard_groups[OTHER_SHARD_TYPE]
+        if len(group) == 1:
+            return group[0]
+        return group[zlib.crc32(doc_id.encode("utf-8")) % len(group)]
+    
+    async def upsert_vectors(self, doc_ids: List[str], embeddings: np.ndarray, metadata: List[Dict[str, Any]],
+                             staged: bool = False):
+        """Insert or replace vectors by document id, routed by metadata['type'].
+        Nothing is persisted until flush_vector_index(). With staged, only the rebuild in progress gets them"""
+        embedding_array = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embedding_array.ndim == 1:
+            embedding_array = embedding_array.reshape(1, -1)
+        if not (len(embedding_array) == len(metadata) == len(doc_ids)):
+            raise ValueError(f"Got {len(doc_ids)} ids, {len(embedding_array)} embeddings and {len(metadata)} metadata entries")
+        if len(metadata) == 0 or not await self._ensure_vector_index():
+            return
+        
+        if staged and self._staging is None:
+            raise RuntimeError("No vector index rebuild in progress")
         
-        if not self.vector_index or len(self.vector_mapping) == 0:
+        routed: Dict[str, List[int]] = {}
+        for i, (doc_id, item) in enumerate(zip(doc_ids, metadata)):
+            routed.setdefault(self._shard_for(item.get("type"), str(doc_id)).name, []).append(i)
+        for name, positions in routed.items():
+            shard_doc_ids = [str(doc_ids[i]) for i in positions]
+            shard_metadata = [metadata[i] for i in positions]
+            if self._staging is not None:
+                # The rebuild must not miss live changes made while it runs
+                for sibling_name, id_index in self._staging.items():
+                    if sibling_name != name:
+                        id_index.remove(shard_doc_ids)
+                self._staging[name].upsert(shard_doc_ids, embedding_array[positions], shard_metadata)
+            if staged:
+                continue
+            shard = self.shards[name]
+            # Drop copies a sibling shard may still hold from an earlier shard count
+            for sibling in self.shards.values():
+                if sibling is not shard:
+                    sibling.remove(shard_doc_ids)
+            shard.upsert(shard_doc_ids, embedding_array[positions], shard_metadata)
+        if not staged:
+            await query_cache.invalidate()
+    
+    async def remove_vectors(self, doc_ids: List[str]) -> int:
+        """Remove vectors by document id. Nothing is persisted until flush_vector_index()"""
+        if not doc_ids or not await self._ensure_vector_index():
+            return 0
+        doc_ids = [str(doc_id) for doc_id in doc_ids]
+        if self._staging is not None:
+            for id_index in self._staging.values():
+                id_index.remove(doc_ids)
+        removed = sum(shard.remove(doc_ids) for shard in self.shards.values())
+        if removed:
+            await query_cache.invalidate()
+        return removed
+    
+    async def upsert_vector(self, doc_id: str, embedding: List[float], metadata: Dict[str, Any]):
+        await self.upsert_vectors([doc_id], np.array([embedding], dtype=np.float32), [metadata])
+        await self.flush_vector_index()
+    
+    async def remove_vector(self, doc_id: str) -> bool:
+        removed = await self.remove_vectors([doc_id])
+        await self.flush_vector_index()
+        return removed > 0
+    
+    async def add_to_vector_index(self, embedding: List[float], metadata: Dict[str, Any]):
+        await self.add_many_to_vector_index(np.array([embedding], dtype=np.float32), [metadata])
+        await self.flush_vector_index()
+    
+    async def add_many_to_vector_index(self, embeddings: np.ndarray, metadata: List[Dict[str, Any]], staged: bool = False):
+        """Add a batch of vectors keyed by metadata['id'], replacing earlier versions"""
+        doc_ids = [str(item["id"]) if item.get("id") else uuid.uuid4().hex for item in metadata]
+        await self.upsert_vectors(doc_ids, embeddings, metadata, staged=staged)
+    
+    async def begin_rebuild(self):
+        """Start building a replacement for every shard. Vectors upserted with staged=True go into it
+        and live changes are mirrored into it; searches keep using the current shards meanwhile"""
+        if not await self._ensure_vector_index():
+            raise Exception("Vector index is not initialized")
+        if self._staging is not None:
+            raise RuntimeError("A vector index rebuild is already in progress")
+        self._staging = {name: IdMappedIndex(self.index_config, self.vector_dimension) for name in self.shards}
+    
+    def abort_rebuild(self):
+        self._staging = None
+    
+    async def finish_rebuild(self):
+        """Swap the rebuilt indexes in and persist them as fresh snapshots"""
+        staging, self._staging = self._staging, None
+        if staging is None:
+            raise RuntimeError("No vector index rebuild in progress")
+        for name, id_index in staging.items():
+            if name in self.shards:
+                self.shards[name].replace_index(id_index)
+        await query_cache.invalidate()
+        await self.flush_vector_index()
+        for shard in self.shards.values():
+            shard.maybe_schedule_migration()
+    
+    async def clear_vector_index(self, entity_types: List[str] = None):
+        """Drop every vector, or only those of the given types. The next flush writes fresh snapshots"""
+        if not await self._ensure_vector_index():
+            return
+        for entity_type, group in self.shard_groups.items():
+            if entity_types is None or entity_type in entity_types:
+                for shard in group:
+                    shard.clear()
+        await query_cache.invalidate()
+    
+    async def flush_vector_index(self):
+        """Append pending changes of every shard to its log"""
+        if self.db is None:
+            if any(shard._pending_ops or shard._snapshot_required for shard in self.shards.values()):
+                print("Database connection is not established, vector index changes kept in memory")
+            return
+        await asyncio.gather(*(shard.flush() for shard in self.shards.values()))
+    
+    async def sync_vector_index(self) -> int:
+        """Apply what other processes appended to the shard logs. Returns the applied segment count"""
+        if self.db is None or not self.shards:
+            return 0
+        applied = sum(await asyncio.gather(*(shard.sync() for shard in self.shards.values())))
+        if applied:
+            await query_cache.invalidate()
+        return applied
+    
+    async def semantic_search(self, query: str, top_k: int = 5, nprobe: int = None, ef_search: int = None,
+                              filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Search by text. filters restrict the candidates before the search, e.g.
+        {"type": "product", "category": "Bottom Wear", "price_lt": 50, "is_published": True}
+        """
+        from .embeddings import get_embedding
+        
+        if self.vector_count() == 0:
             print("Vector index is empty")
             return []
-        query_embedding = await get_embedding(query)
-        query_array = np.array([query_embedding], dtype=np.float32)
-            
-        # Perform search
-        scores, indices = self.vector_index.search(query_array, top_k)
-            
+        
+        async def search():
+            query_embedding = await get_embedding(query)
+            return await self.semantic_search_by_vector(query_embedding, top_k, nprobe, ef_search, filters)
+        key = query_cache.key("semantic", query, top_k=top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)
+        return await self._cached_search(key, search)
+    
+    async def _cached_search(self, key: str, search) -> List[Dict[str, Any]]:
+        """Serve from the query cache, or run search() and cache what it returns.
+        Identical searches arriving meanwhile share the one run"""
+        cached = await query_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        async def run():
+            # Read before searching, so a write that lands meanwhile makes this entry stale
+            version = await query_cache.current_version()
+            results = await search()
+            await query_cache.set(key, results, version)
+            return results
+        return await single_flight.do(f"search:{key}", run)
+    
+    async def semantic_search_by_vector(self, query_embedding: List[float], top_k: int = 5, nprobe: int = None,
+                                        ef_search: int = None, filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Search with an embedding the caller already has, e.g. to avoid encoding a query twice"""
+        query_array = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        return (await self.search_vectors(query_array, top_k, nprobe, ef_search, filters))[0]
+    
+    async def semantic_search_many(self, queries: List[str], top_k: int = 5, nprobe: int = None, ef_search: int = None,
+                                   filters: Dict[str, Any] = None) -> List[List[Dict[str, Any]]]:
+        """Search many texts at once: one embedding batch and one FAISS search per shard. Results keep query order"""
+        from .embeddings import get_embeddings_array
+        
+        if not queries:
+            return []
+        if self.vector_count() == 0:
+            print("Vector index is empty")
+            return [[] for _ in queries]
+        query_array = await get_embeddings_array(queries)
+        return await self.search_vectors(query_array, top_k, nprobe, ef_search, filters)
+    
+    def _search_targets(self, filters: Dict[str, Any] = None) -> List[tuple]:
+        """(shard, filters for that shard) pairs worth searching"""
+        filters = dict(filters or {})
+        wanted_types = filters.pop("type", None)
+        if wanted_types is None:
+            targets = [(shard, filters) for shard in self.shards.values()]
+        else:
+            wanted_types = wanted_types if isinstance(wanted_types, (list, tuple, set)) else [wanted_types]
+            # A type filter picks shards, so the shards themselves only apply the other filters
+            targets = [
+                (shard, filters)
+                for entity_type in ENTITY_TYPES if entity_type in wanted_types
+                for shard in self.shard_groups.get(entity_type, [])
+            ]
+            other_types = [entity_type for entity_type in wanted_types if entity_type not in ENTITY_TYPES]
+            if other_types:
+                targets += [(shard, dict(filters, type=other_types)) for shard in self.shard_groups.get(OTHER_SHARD_TYPE, [])]
+        return [(shard, shard_filters) for shard, shard_filters in targets if len(shard)]
+    
+    async def lexical_search(self, query: str, top_k: int = 5, filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """BM25 keyword search over the indexed content, e.g. for order numbers, SKUs and brands"""
+        targets = self._search_targets(filters)
+        if not targets:
+            return []
+        loop = asyncio.get_running_loop()
+        shard_hits = await asyncio.gather(*(
+            loop.run_in_executor(self._search_pool, shard.lexical_search, query, top_k, shard_filters)
+            for shard, shard_filters in targets
+        ))
+        best = heapq.nlargest(top_k, (hit for hits in shard_hits for hit in hits), key=lambda hit: hit[0])
         results = []
-        for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx < len(self.vector_mapping):
-                result = self.vector_mapping[idx].copy()
-                result['score'] = float(score)
-                result['rank'] = i + 1
-                results.append(result)
-            
+        for score, metadata in best:
+            metadata['score'] = score
+            metadata['rank'] = len(results) + 1
+            results.append(metadata)
+        return results
+    
+    async def hybrid_search(self, query: str, top_k: int = 5, filters: Dict[str, Any] = None,
+                            query_embedding: List[float] = None, candidates: int = None) -> List[Dict[str, Any]]:
+        """Dense and BM25 results fused by reciprocal rank: score = sum of 1 / (RRF_K + rank).
+        Pass query_embedding if the caller already encoded the query"""
+        if self.vector_count() == 0:
+            return []
+        candidates = max(candidates or HYBRID_CANDIDATES, top_k)
+        key = query_cache.key("hybrid", query, top_k=top_k, filters=filters, candidates=candidates)
+        return await self._cached_search(key, lambda: self._hybrid_search(query, top_k, filters, query_embedding, candidates))
+    
+    async def _hybrid_search(self, query: str, top_k: int, filters: Dict[str, Any], query_embedding: List[float],
+                             candidates: int) -> List[Dict[str, Any]]:
+        from .embeddings import get_embedding
+        
+        if query_embedding is None:
+            query_embedding = await get_embedding(query)
+        dense, lexical = await asyncio.gather(
+            self.semantic_search_by_vector(query_embedding, candidates, filters=filters),
+            self.lexical_search(query, candidates, filters=filters),
+        )
+        
+        fused: Dict[str, Dict[str, Any]] = {}
+        for source, hits in (("dense_score", dense), ("lexical_score", lexical)):
+            for hit in hits:
+                key = f"{hit.get('type')}:{hit.get('id')}"
+                result = fused.setdefault(key, dict(hit, score=0.0))
+                result[source] = hit['score']
+                result['score'] += 1.0 / (RRF_K + hit['rank'])
+        results = sorted(fused.values(), key=lambda result: result['score'], reverse=True)[:top_k]
+        for rank, result in enumerate(results, 1):
+            result['rank'] = rank
         return results
+    
+    async def search_vectors(self, query_array: np.ndarray, top_k: int = 5, nprobe: int = None, ef_search: int = None,
+                             filters: Dict[str, Any] = None) -> List[List[Dict[str, Any]]]:
+        """Top-k hits per query row. The shards are searched in parallel on the search thread
+        pool, each with the whole query matrix, and their top-k merged per row"""
+        query_array = np.ascontiguousarray(query_array, dtype=np.float32)
+        targets = self._search_targets(filters)
+        if not targets or len(query_array) == 0:
+            return [[] for _ in range(len(query_array))]
         
-    async def get_products_for_indexing(self) -> List[Dict[str, Any]]:
-        if self.db is None:
-            raise Exception("Database connection is not established")
-        products = await self.db.products.find({}).to_list(length=None)
-        return products
-
-    async def get_orders_for_indexing(self) -> List[Dict[str, Any]]:
-        if self.db is None:
-            raise Exception("Database connection is not established")
-        orders = await self.db.orders.find({}).to_list(length=None)
-        return orders
+        loop = asyncio.get_running_loop()
+        shard_hits = await asyncio.gather(*(
+            loop.run_in_executor(self._search_pool, shard.search, query_array, top_k, nprobe, ef_search, shard_filters)
+            for shard, shard_filters in targets
+        ))
+        
+        all_results = []
+        for row in range(len(query_array)):
+            best = heapq.nlargest(top_k, (hit for hits in shard_hits for hit in hits[row]), key=lambda hit: hit[0])
+            results = []
+            for score, metadata in best:
+                # Rows are materialized per hit, so the dict is already ours
+                result = metadata
+                result['score'] = score
+                result['rank'] = len(results) + 1
+                results.append(result)
+            all_results.append(results)
+            
+        return all_results
+    
+    def doc_ids(self, entity_type: str) -> List[str]:
+        return [doc_id for shard in self._shards_of(entity_type) for doc_id in list(shard.id_index.doc_slots)]
+    
+    def _shards_of(self, entity_type: str) -> List[VectorShard]:
+        return self.shard_groups.get(entity_type) or self.shard_groups.get(OTHER_SHARD_TYPE, [])
+    
+    def get_indexed(self, entity_type: str, doc_ids: List[str], with_vectors: bool = True):
+        """(doc ids, vectors, metadata) of the given documents that are indexed, from the stored vectors"""
+        doc_ids = [str(doc_id) for doc_id in doc_ids]
+        found, vectors, metadata = [], [], []
+        for shard in self._shards_of(entity_type):
+            shard_found, shard_vectors, shard_metadata = shard.lookup(doc_ids, with_vectors)
+            found += shard_found
+            vectors.append(shard_vectors)
+            metadata += shard_metadata
+        vectors = np.concatenate(vectors) if vectors else np.zeros((0, self.vector_dimension), dtype=np.float32)
+        return found, vectors, metadata
+    
+    async def similar_items(self, entity_type: str, doc_id: str, k: int = 10,
+                            filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Nearest neighbours of an indexed item, or None if it is not indexed. No model inference"""
+        return (await self.similar_items_many(entity_type, [doc_id], k, filters)).get(str(doc_id))
+    
+    async def similar_items_many(self, entity_type: str, doc_ids: List[str], k: int = 10,
+                                 filters: Dict[str, Any] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Nearest neighbours of the same type per indexed item, searched with the stored vectors"""
+        found, vectors, _ = self.get_indexed(entity_type, doc_ids)
+        if not found:
+            return {}
+        # One extra hit, since every item finds itself first
+        rows = await self.search_vectors(vectors, k + 1, filters=dict(filters or {}, type=entity_type))
+        similar = {}
+        for doc_id, hits in zip(found, rows):
+            hits = [hit for hit in hits if str(hit.get('id')) != doc_id][:k]
+            for rank, hit in enumerate(hits, 1):
+                hit['rank'] = rank
+            similar[doc_id] = hits
+        return similar
     
-    async def get_users_for_indexing(self) -> List[Dict[str, Any]]:
+    async def iter_for_indexing(self, collection: str, batch_size: int = 256) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Stream a collection in fixed-size batches, fetching only the indexed fields"""
         if self.db is None:
             raise Exception("Database connection is not established")
-        users = await self.db.users.find({}).to_list(length=None)
-        return users
+        cursor = self.db[collection].find({}, INDEXING_PROJECTIONS.get(collection), batch_size=batch_size)
+        batch = []
+        async for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
     
     def _get_current_timestamp(self):
         from datetime import datetime
@@ -0,0 +1,115 @@
+import os
+import hashlib
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+SQLITE_MAX_VARIABLES = 500
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+class EmbeddingCache:
+    """Content-addressed embedding cache.
+
+    Keys are sha256(model name + normalized text). Lookups go to an in-process LRU first
+    and then to a SQLite file holding float32 blobs, so unchanged documents and repeated
+    queries skip the model entirely, also across restarts.
+    """
+
+    def __init__(self, model_name: str, path: Optional[str], max_entries: int):
+        self.model_name = model_name
+        self.path = path
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._connection = None
+        self._db_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    async def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        for key in keys:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                found[key] = vector
+        self.memory_hits += len(found)
+
+        remaining = [key for key in dict.fromkeys(keys) if key not in found]
+        if remaining and self.path:
+            from_disk = await asyncio.to_thread(self._read, remaining)
+            self.disk_hits += len(from_disk)
+            for key, vector in from_disk.items():
+                self._remember(key, vector)
+            found.update(from_disk)
+        self.misses += len([key for key in remaining if key not in found])
+        return found
+
+    async def put_many(self, entries: Dict[str, np.ndarray]):
+        for key, vector in entries.items():
+            self._remember(key, vector)
+        if entries and self.path:
+            await asyncio.to_thread(self._write, entries)
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "disk_path": self.path,
+        }
+
+    def _remember(self, key: str, vector: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _db(self) -> sqlite3.Connection:
+        # Caller holds _db_lock
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+        return self._connection
+
+    def _read(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self._db_lock:
+            connection = self._db()
+            for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                chunk = keys[start:start + SQLITE_MAX_VARIABLES]
+                rows = connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def _write(self, entries: Dict[str, np.ndarray]):
+        with self._db_lock:
+            connection = self._db()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in entries.items()]
+                )
@@ -1,31 +1,281 @@
 import os
 from sentence_transformers import SentenceTransformer
-from typing import List
+from typing import List, Dict, Any
 import numpy as np
 import asyncio
 # import google.generativeai as genai
 # genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
+from .embedding_cache import EmbeddingCache
+
+MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# torch (fp32), torch-int8 (dynamic quantization), onnx, onnx-int8 (ONNX Runtime, needs onnxruntime)
+BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", ".cache/onnx")
+ONNX_BATCH_SIZE = 32
+
 _model = None
 def get_model():
     global _model
     if _model is None:
-        model_name = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
-        print(f"Loading embedding model: {model_name}")
-        _model = SentenceTransformer(model_name)
+        print(f"Loading embedding model: {MODEL_NAME}")
+        _model = SentenceTransformer(MODEL_NAME)
         print("Embedding model loaded successfully")
     return _model
 
-async def get_embedding(text: str) -> List[float]:
+class OnnxEncoder:
+    """Runs the model's transformer through ONNX Runtime, with the same pooling/normalization"""
+    
+    def __init__(self, model: SentenceTransformer, quantize: bool = False):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("EMBEDDING_BACKEND=onnx needs the onnxruntime package")
+        from sentence_transformers.models import Pooling, Normalize
+        
+        self.tokenizer = model.tokenizer
+        self.max_length = model.max_seq_length
+        pooling = next((module for module in model if isinstance(module, Pooling)), None)
+        self.cls_pooling = bool(pooling and pooling.pooling_mode_cls_token)
+        self.normalize = any(isinstance(module, Normalize) for module in model)
+        
+        path = self._export(model, quantize)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+    
+    def _export(self, model: SentenceTransformer, quantize: bool) -> str:
+        import torch
+        
+        base_name = MODEL_NAME.replace("/", "__")
+        path = os.path.join(ONNX_DIR, f"{base_name}.onnx")
+        if not os.path.exists(path):
+            os.makedirs(ONNX_DIR, exist_ok=True)
+            print(f"Exporting {MODEL_NAME} to ONNX at {path}")
+            sample = self.tokenizer(["export"], return_tensors="pt")
+            names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+            dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+            dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+            with torch.no_grad():
+                torch.onnx.export(
+                    model[0].auto_model,
+                    tuple(sample[name] for name in names),
+                    path,
+                    input_names=names,
+                    output_names=["last_hidden_state"],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=14,
+                )
+        if not quantize:
+            return path
+        
+        quantized_path = os.path.join(ONNX_DIR, f"{base_name}.int8.onnx")
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+        return quantized_path
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if isinstance(texts, str):
+            return self.encode([texts])[0]
+        # Similar lengths together keep padding small
+        order = np.argsort([len(text) for text in texts])
+        embeddings = np.zeros((len(texts), 0), dtype=np.float32)
+        batches = []
+        for start in range(0, len(texts), ONNX_BATCH_SIZE):
+            batch = [texts[i] for i in order[start:start + ONNX_BATCH_SIZE]]
+            features = self.tokenizer(batch, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+            inputs = {name: value.astype(np.int64) for name, value in features.items() if name in self.input_names}
+            token_embeddings = self.session.run(["last_hidden_state"], inputs)[0]
+            batches.append(self._pool(token_embeddings, features["attention_mask"]))
+        if batches:
+            embeddings = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+            embeddings[order] = np.concatenate(batches)
+        return embeddings
+    
+    def _pool(self, token_embeddings: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        if self.cls_pooling:
+            pooled = token_embeddings[:, 0]
+        else:
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype(np.float32)
+
+def create_encoder(backend: str):
+    """Anything with a SentenceTransformer-style encode(texts) for the given backend"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown EMBEDDING_BACKEND {backend!r}, expected one of {BACKENDS}")
     model = get_model()
-    embedding = await asyncio.to_thread(model.encode, text)
-    return embedding.tolist()
+    if backend == "torch":
+        return model
+    if backend == "torch-int8":
+        import torch
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return OnnxEncoder(model, quantize=backend == "onnx-int8")
+
+_encoder = None
+def get_encoder():
+    global _encoder
+    if _encoder is None:
+        _encoder = create_encoder(BACKEND)
+        print(f"Embedding backend: {BACKEND}")
+    return _encoder
+
+def check_backend_parity(texts: List[str], backend: str = BACKEND, k: int = 10) -> Dict[str, Any]:
+    """Compare a backend against fp32 torch on the same texts.
+    
+    recall_at_k is the overlap of each text's top-k neighbours (within texts) under both
+    backends, which is what search quality depends on.
+    """
+    reference = np.asarray(get_model().encode(texts, normalize_embeddings=True), dtype=np.float32)
+    candidate = np.asarray(create_encoder(backend).encode(texts), dtype=np.float32)
+    candidate = candidate / np.clip(np.linalg.norm(candidate, axis=1, keepdims=True), 1e-12, None)
+    
+    k = min(k, len(texts) - 1)
+    if k < 1:
+        raise ValueError("Need at least two texts to compare neighbours")
+    
+    def neighbours(vectors: np.ndarray) -> np.ndarray:
+        similarities = vectors @ vectors.T
+        np.fill_diagonal(similarities, -np.inf)
+        return np.argsort(-similarities, axis=1)[:, :k]
+    
+    reference_neighbours = neighbours(reference)
+    candidate_neighbours = neighbours(candidate)
+    recall = np.mean([
+        len(set(ref_row) & set(cand_row)) / k
+        for ref_row, cand_row in zip(reference_neighbours.tolist(), candidate_neighbours.tolist())
+    ])
+    return {
+        "backend": backend,
+        "texts": len(texts),
+        "k": k,
+        "recall_at_k": float(recall),
+        "mean_cosine_to_fp32": float(np.mean(np.sum(reference * candidate, axis=1))),
+    }
+
+_cache = None
+def get_cache() -> EmbeddingCache:
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache(
+            f"{MODEL_NAME}:{BACKEND}",
+            os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3") or None,
+            int(os.getenv("EMBEDDING_CACHE_SIZE", "50000"))
+        )
+    return _cache
+
+def get_cache_stats() -> Dict[str, Any]:
+    return get_cache().get_stats()
+
+class EmbeddingBatcher:
+    """Coalesces concurrent encode calls into one model batch.
+    
+    Callers queue their texts with a future. A single worker takes whatever arrived within
+    max_wait_ms (up to max_batch_size texts), runs one forward pass off the event loop and
+    hands every caller its own rows. Requests that already fill a batch are not delayed.
+    """
+    
+    def __init__(self, max_batch_size: int, max_wait_ms: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.requests = 0
+        self._queue = None
+        self._worker = None
+        self._loop = None
+    
+    async def encode(self, texts: List[str]) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((texts, future))
+        return await future
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_requests_per_batch": self.requests / self.batches if self.batches else 0.0,
+        }
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            count = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while count < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                count += len(item[0])
+            
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                encoded = await asyncio.to_thread(get_encoder().encode, texts)
+                encoded = np.asarray(encoded, dtype=np.float32)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            self.batches += 1
+            self.requests += len(batch)
+            offset = 0
+            for item_texts, future in batch:
+                if not future.done():
+                    future.set_result(encoded[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+_batcher = None
+def get_batcher() -> EmbeddingBatcher:
+    global _batcher
+    if _batcher is None:
+        _batcher = EmbeddingBatcher(
+            int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "64")),
+            float(os.getenv("EMBEDDING_MAX_WAIT_MS", "5"))
+        )
+    return _batcher
+
+async def get_embedding(text: str) -> List[float]:
+    embeddings = await get_embeddings_array([text])
+    return embeddings[0].tolist()
 
 async def get_embeddings_batch(texts: List[str]) -> List[List[float]]:
-    model = get_model()
-    embeddings = await asyncio.to_thread(model.encode, texts)
+    embeddings = await get_embeddings_array(texts)
     return [e.tolist() for e in embeddings]
 
+async def get_embeddings_array(texts: List[str]) -> np.ndarray:
+    """Batch embeddings as one float32 matrix. Only texts missing from the cache are encoded"""
+    cache = get_cache()
+    keys = [cache.key(text) for text in texts]
+    found = await cache.get_many(keys)
+    
+    missing = {key: text for key, text in zip(keys, texts) if key not in found}
+    if missing:
+        encoded = await get_batcher().encode(list(missing.values()))
+        encoded = dict(zip(missing, encoded))
+        await cache.put_many(encoded)
+        found.update(encoded)
+    
+    if not keys:
+        return np.zeros((0, get_model().get_sentence_embedding_dimension()), dtype=np.float32)
+    return np.stack([found[key] for key in keys])
+
 def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
     vec1_array = np.array(vec1)
     vec2_array = np.array(vec2)
@@ -37,4 +287,11 @@ def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
     if norm1 == 0 or norm2 == 0:
         return 0.0
     
-    return dot_product / (norm1 * norm2) 
\ No newline at end of file
+    return dot_product / (norm1 * norm2) 
+
+if __name__ == "__main__":
+    # python -m ai_assistant.config.embeddings texts.txt [backend]  -- one text per line
+    import sys
+    with open(sys.argv[1], encoding="utf-8") as f:
+        sample = [line.strip() for line in f if line.strip()]
+    print(check_backend_parity(sample, sys.argv[2] if len(sys.argv) > 2 else BACKEND))
@@ -0,0 +1,140 @@
+import os
+from typing import Optional
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivfflat", "ivfpq", "hnsw")
+# efSearch multiplier when a filtered HNSW search is retried
+HNSW_RETRY_EF_FACTOR = 8
+
+class IndexConfig:
+    """ANN index settings, read from the environment"""
+
+    def __init__(self):
+        self.index_type = os.getenv("VECTOR_INDEX_TYPE", "flat").lower()
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown VECTOR_INDEX_TYPE {self.index_type!r}, expected one of {INDEX_TYPES}")
+        self.nlist = int(os.getenv("VECTOR_IVF_NLIST", "1024"))
+        self.pq_m = int(os.getenv("VECTOR_PQ_M", "48"))
+        self.pq_nbits = int(os.getenv("VECTOR_PQ_NBITS", "8"))
+        self.hnsw_m = int(os.getenv("VECTOR_HNSW_M", "32"))
+        self.hnsw_ef_construction = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", "80"))
+        self.nprobe = int(os.getenv("VECTOR_NPROBE", "16"))
+        self.ef_search = int(os.getenv("VECTOR_EF_SEARCH", "64"))
+        # faiss warns below 39 training points per centroid
+        self.min_train_points = max(int(os.getenv("VECTOR_TRAIN_MIN_POINTS", "0")), 39 * self.nlist)
+        self.max_train_points = 256 * self.nlist
+
+    @property
+    def needs_training(self) -> bool:
+        return self.index_type in ("ivfflat", "ivfpq")
+
+    def factory_string(self) -> str:
+        if self.index_type == "ivfflat":
+            return f"IVF{self.nlist},Flat"
+        if self.index_type == "ivfpq":
+            return f"IVF{self.nlist},PQ{self.pq_m}x{self.pq_nbits}"
+        if self.index_type == "hnsw":
+            return f"HNSW{self.hnsw_m}"
+        return "Flat"
+
+def create_index(config: IndexConfig, dimension: int, index_type: Optional[str] = None) -> faiss.Index:
+    """Create an empty inner-product index. IVF indexes come back untrained"""
+    if (index_type or config.index_type) == "flat":
+        return faiss.IndexFlatIP(dimension)
+    # index_factory already returns the concrete class. Downcasting its result would leave the
+    # only owning proxy unreferenced, freeing the index under the downcast one
+    index = faiss.index_factory(dimension, config.factory_string(), faiss.METRIC_INNER_PRODUCT)
+    if config.index_type == "hnsw":
+        index.hnsw.efConstruction = config.hnsw_ef_construction
+    if config.needs_training:
+        # Lets IVF reconstruct and remove vectors by id
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+def with_ids(index: faiss.Index) -> faiss.Index:
+    """Make the index addressable by our own int64 ids.
+
+    IVF indexes store ids natively. Flat and HNSW get an IndexIDMap2 wrapper; IVF must not,
+    because IVF does not renumber its internal ids on removal and the wrapper relies on that.
+    """
+    if _ivf_or_none(index) is not None:
+        return index
+    return faiss.IndexIDMap2(index)
+
+def create_initial_index(config: IndexConfig, dimension: int) -> faiss.Index:
+    # IVF variants cannot take vectors before training, so start flat and migrate later
+    if config.needs_training:
+        return with_ids(create_index(config, dimension, "flat"))
+    return with_ids(create_index(config, dimension))
+
+def index_type_of(index: faiss.Index) -> str:
+    index = faiss.downcast_index(index)
+    if hasattr(index, "id_map"):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVFFlat):
+        return "ivfflat"
+    if isinstance(index, faiss.IndexFlat):
+        return "flat"
+    return "unknown"
+
+def migration_threshold(config: IndexConfig) -> int:
+    return config.min_train_points if config.needs_training else 1
+
+def reconstruct_vectors(index: faiss.Index, start: int, end: int) -> np.ndarray:
+    if end <= start:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_n(start, end - start)
+
+def build_trained_index(config: IndexConfig, dimension: int, vectors: np.ndarray, ids: np.ndarray) -> faiss.Index:
+    """Build the configured index type over vectors. CPU heavy, run it off the event loop"""
+    index = with_ids(create_index(config, dimension))
+    if not index.is_trained:
+        sample = vectors
+        if len(vectors) > config.max_train_points:
+            rows = np.random.default_rng(0).choice(len(vectors), config.max_train_points, replace=False)
+            sample = vectors[np.sort(rows)]
+        index.train(sample)
+    if len(vectors):
+        index.add_with_ids(vectors, ids)
+    return index
+
+def search_parameters(index: faiss.Index, config: IndexConfig, nprobe: Optional[int] = None,
+                      ef_search: Optional[int] = None) -> Optional[faiss.SearchParameters]:
+    """Per-request search knobs. Passed to index.search, so concurrent requests don't share state"""
+    index_type = index_type_of(index)
+    if index_type in ("ivfflat", "ivfpq"):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = nprobe or config.nprobe
+        return params
+    if index_type == "hnsw":
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = ef_search or config.ef_search
+        return params
+    return None
+
+def widened_parameters(index: faiss.Index, config: IndexConfig,
+                       ef_search: Optional[int] = None) -> Optional[faiss.SearchParameters]:
+    """Parameters for retrying a filtered search that came back with fewer than k hits: every
+    IVF list is probed, HNSW walks a much wider beam. None for exact indexes"""
+    index_type = index_type_of(index)
+    if index_type in ("ivfflat", "ivfpq"):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = _ivf_or_none(index).nlist
+        return params
+    if index_type == "hnsw":
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = (ef_search or config.ef_search) * HNSW_RETRY_EF_FACTOR
+        return params
+    return None
+
+def _ivf_or_none(index: faiss.Index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
@@ -0,0 +1,86 @@
+import re
+import math
+import heapq
+from typing import List, Dict, Optional, Tuple, Iterable
+
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN = re.compile(r"[\w][\w\-./]*", re.UNICODE)
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words. Compound tokens (ORD-1042, 32/34, t-shirt) are kept whole and also split"""
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        token = token.rstrip("-./")
+        if not token:
+            continue
+        tokens.append(token)
+        parts = [part for part in re.split(r"[\-./]", token) if part]
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+class LexicalIndex:
+    """In-memory BM25 inverted index keyed by slot, updated per document.
+
+    Postings map each term to {slot: term frequency}. Scoring only touches the
+    postings of the query terms, so exact tokens like order numbers, SKUs and
+    sizes are found without a dense search.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.lengths: Dict[int, int] = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, slot: int, text: str):
+        tokens = tokenize(text or "")
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            self.postings.setdefault(token, {})[slot] = count
+        self.lengths[slot] = len(tokens)
+        self.total_length += len(tokens)
+
+    def add_many(self, items: Iterable[Tuple[int, str]]):
+        for slot, text in items:
+            self.add(slot, text)
+
+    def remove(self, slot: int, text: str):
+        length = self.lengths.pop(slot, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for token in set(tokenize(text or "")):
+            postings = self.postings.get(token)
+            if postings is not None:
+                postings.pop(slot, None)
+                if not postings:
+                    del self.postings[token]
+
+    def search(self, query: str, top_k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[float, int]]:
+        """(BM25 score, slot) pairs, best first. With allowed, only those slots are scored"""
+        count = len(self.lengths)
+        if count == 0:
+            return []
+        allowed_set = set(allowed.tolist()) if allowed is not None else None
+        average_length = self.total_length / count or 1.0
+        scores: Dict[int, float] = {}
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for slot, frequency in postings.items():
+                if allowed_set is not None and slot not in allowed_set:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[slot] / average_length)
+                scores[slot] = scores.get(slot, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return [(score, slot) for slot, score in heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])]
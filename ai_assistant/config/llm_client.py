@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import random
+import asyncio
+from typing import Dict, Any, AsyncIterator, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-pro")
+GEMINI_API_URL = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1beta")
+# Calls in flight at once per worker; the rest wait for a slot inside their deadline
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# Seconds a call may take in total, including queueing and retries
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+# Seconds before a second, identical request is raced against a slow one. 0 disables hedging
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "0"))
+# Consecutive failed calls that open the circuit, and seconds before a probe call is let through
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class LLMError(Exception):
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+class LLMUnavailable(LLMError):
+    """The circuit is open, the call was not attempted"""
+
+class CircuitBreaker:
+    """Opens after max_failures consecutive failed calls. While open every call fails fast;
+    after reset_timeout one probe call is allowed, and its outcome closes or reopens it."""
+
+    def __init__(self, max_failures: int, reset_timeout: float):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release_probe(self):
+        """The probe call ended without an outcome (cancelled, or a caller error)"""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.max_failures:
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+class GeminiClient:
+    """Async Gemini REST client on one pooled httpx connection set.
+
+    Every call has a deadline covering the wait for a concurrency slot, the retries
+    (exponential backoff with full jitter, only for timeouts, transport errors and
+    429/5xx) and, when enabled, a hedged duplicate request sent if the first is slow.
+    Failed calls feed a circuit breaker; while it is open calls raise LLMUnavailable
+    at once so callers can answer without the model.
+    """
+
+    def __init__(self, model: str = GEMINI_MODEL, api_key: Optional[str] = None,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY, timeout: float = LLM_TIMEOUT,
+                 max_retries: int = LLM_MAX_RETRIES, hedge_after: float = LLM_HEDGE_AFTER):
+        self.model = model
+        self.api_key = api_key or os.getenv("GOOGLE_API_KEY")
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET)
+        self._http: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedged = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+    def _client(self) -> httpx.AsyncClient:
+        # Created on first use so it binds to the running event loop
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=GEMINI_API_URL,
+                headers={"x-goog-api-key": self.api_key or ""},
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+                limits=httpx.Limits(max_connections=self.max_concurrency * 2,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def generate(self, prompt: str) -> str:
+        """Complete response text. Raises LLMError (LLMUnavailable if the circuit is open)"""
+        self._admit()
+        try:
+            text = await asyncio.wait_for(self._hedged(prompt), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._failed()
+            raise LLMError(f"Gemini call exceeded its {self.timeout}s deadline")
+        except LLMError as e:
+            if e.retryable:
+                self._failed()
+            raise
+        finally:
+            self.breaker.release_probe()
+        self.breaker.record_success()
+        return text
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        """Response text chunks. Retries only happen before the first chunk; the deadline
+        covers the whole stream"""
+        self._admit()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        yielded = False
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async for text in self._stream_once(prompt, deadline):
+                        yielded = True
+                        yield text
+                    break
+                except LLMError as e:
+                    if yielded or not e.retryable or attempt == self.max_retries:
+                        raise
+                await self._backoff(attempt, deadline)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._failed()
+            raise LLMError(f"Gemini stream exceeded its {self.timeout}s deadline")
+        except LLMError as e:
+            if e.retryable:
+                self._failed()
+            raise
+        finally:
+            self.breaker.release_probe()
+        self.breaker.record_success()
+
+    def _admit(self):
+        self.calls += 1
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise LLMUnavailable("Gemini circuit breaker is open")
+
+    def _failed(self):
+        self.failures += 1
+        self.breaker.record_failure()
+
+    async def _hedged(self, prompt: str) -> str:
+        tasks = [asyncio.create_task(self._with_retries(prompt))]
+        try:
+            if self.hedge_after > 0:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+                if not done:
+                    self.hedged += 1
+                    tasks.append(asyncio.create_task(self._with_retries(prompt)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _with_retries(self, prompt: str) -> str:
+        deadline = asyncio.get_running_loop().time() + self.timeout
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._generate_once(prompt)
+            except LLMError as e:
+                if not e.retryable or attempt == self.max_retries:
+                    raise
+            await self._backoff(attempt, deadline)
+
+    async def _backoff(self, attempt: int, deadline: float):
+        self.retries += 1
+        delay = random.uniform(0, LLM_RETRY_BASE_DELAY * 2 ** attempt)
+        remaining = deadline - asyncio.get_running_loop().time()
+        await asyncio.sleep(max(min(delay, remaining), 0))
+
+    async def _generate_once(self, prompt: str) -> str:
+        client = self._client()
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                response = await client.post(f"/models/{self.model}:generateContent", json=_request_body(prompt))
+            except httpx.HTTPError as e:
+                raise LLMError(f"Gemini request failed: {e!r}", retryable=True)
+            finally:
+                self.in_flight -= 1
+        _raise_for_status(response.status_code, response.text)
+        return _response_text(response.json())
+
+    async def _stream_once(self, prompt: str, deadline: float) -> AsyncIterator[str]:
+        client = self._client()
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(self._semaphore.acquire(), max(deadline - loop.time(), 0))
+        self.in_flight += 1
+        try:
+            async with client.stream("POST", f"/models/{self.model}:streamGenerateContent",
+                                     params={"alt": "sse"}, json=_request_body(prompt)) as response:
+                if response.status_code != 200:
+                    _raise_for_status(response.status_code, (await response.aread()).decode("utf-8", "replace"))
+                lines = response.aiter_lines()
+                while True:
+                    try:
+                        line = await asyncio.wait_for(lines.__anext__(), max(deadline - loop.time(), 0))
+                    except StopAsyncIteration:
+                        break
+                    if line.startswith("data:"):
+                        text = _response_text(json.loads(line[5:]))
+                        if text:
+                            yield text
+        except httpx.HTTPError as e:
+            raise LLMError(f"Gemini stream failed: {e!r}", retryable=True)
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "breaker": self.breaker.state,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "hedged": self.hedged,
+        }
+
+def _request_body(prompt: str) -> Dict[str, Any]:
+    return {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+
+def _raise_for_status(status_code: int, body: str):
+    if status_code != 200:
+        raise LLMError(f"Gemini returned {status_code}: {body[:200]}", retryable=status_code in RETRYABLE_STATUS)
+
+def _response_text(payload: Dict[str, Any]) -> str:
+    candidates = payload.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+llm_client = GeminiClient()
@@ -0,0 +1,68 @@
+import os
+import json
+import uuid
+import shutil
+from typing import List, Dict, Any, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from .metadata_table import MetadataTable
+
+# Local copies of the shard snapshots, shared by every worker on the host. Empty disables them
+LOCAL_SNAPSHOT_DIR = os.getenv("VECTOR_LOCAL_SNAPSHOT_DIR", ".cache/vector_index")
+
+INDEX_FILE = "index.faiss"
+CURRENT_FILE = "current.json"
+
+def _shard_dir(name: str) -> str:
+    return os.path.join(LOCAL_SNAPSHOT_DIR, name)
+
+def current_snapshot(name: str) -> Optional[Dict[str, Any]]:
+    """snapshot_id and last_seq of the local copy, if there is one"""
+    if not LOCAL_SNAPSHOT_DIR:
+        return None
+    try:
+        with open(os.path.join(_shard_dir(name), CURRENT_FILE), encoding="utf-8") as f:
+            current = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.exists(os.path.join(_shard_dir(name), current["snapshot_id"], INDEX_FILE)):
+        return None
+    return current
+
+def open_snapshot(name: str, snapshot_id: str) -> Tuple[faiss.Index, MetadataTable, str]:
+    """Open a local snapshot without copying it: IVF inverted lists and all metadata columns are mmapped"""
+    directory = os.path.join(_shard_dir(name), snapshot_id)
+    index_path = os.path.join(directory, INDEX_FILE)
+    return faiss.read_index(index_path, faiss.IO_FLAG_MMAP), MetadataTable.load(directory), index_path
+
+def write_snapshot(name: str, snapshot_id: str, last_seq: int, index_bytes: np.ndarray, rows: List[Dict[str, Any]]):
+    """Store a snapshot locally and make it current. Older local snapshots of the shard are removed"""
+    if not LOCAL_SNAPSHOT_DIR:
+        return
+    shard_dir = _shard_dir(name)
+    directory = os.path.join(shard_dir, snapshot_id)
+    if not os.path.exists(directory):
+        # Build under a private name and rename, so other workers never see half a snapshot
+        staging = os.path.join(shard_dir, f".{snapshot_id}.{uuid.uuid4().hex}")
+        os.makedirs(staging)
+        np.ascontiguousarray(index_bytes, dtype=np.uint8).tofile(os.path.join(staging, INDEX_FILE))
+
+        MetadataTable.from_rows(rows).save(staging)
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            # Another worker got there first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    current_path = os.path.join(shard_dir, CURRENT_FILE)
+    staging_path = os.path.join(shard_dir, f".current.{uuid.uuid4().hex}.json")
+    with open(staging_path, "w", encoding="utf-8") as f:
+        json.dump({"snapshot_id": snapshot_id, "last_seq": last_seq}, f)
+    os.replace(staging_path, current_path)
+
+    # Workers still mapping an old snapshot keep their pages until they reload
+    for entry in os.listdir(shard_dir):
+        if entry not in (snapshot_id, CURRENT_FILE) and not entry.startswith("."):
+            shutil.rmtree(os.path.join(shard_dir, entry), ignore_errors=True)
@@ -0,0 +1,446 @@
+import os
+import json
+from collections.abc import Mapping
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+import bson
+import numpy as np
+
+# String fields with few distinct values, stored as interned codes
+CATEGORICAL_FIELDS = {"type", "category", "brand", "gender", "status", "role"}
+# Range filters are written as <field>_<op>, e.g. price_lt
+RANGE_OPERATORS = {
+    "lt": np.less,
+    "lte": np.less_equal,
+    "gt": np.greater,
+    "gte": np.greater_equal,
+}
+# Rewrite the table once this many rows are dead (and they outnumber the live ones)
+COMPACT_MIN_DEAD_ROWS = 1024
+
+SCHEMA_FILE = "schema.json"
+
+def normalize(value: Any) -> Any:
+    return value.strip().lower() if isinstance(value, str) else value
+
+class _Array:
+    """Append-only numpy array with amortized growth. Read-only (mmapped) data is copied on first write"""
+
+    def __init__(self, dtype, data: Optional[np.ndarray] = None):
+        self.data = data if data is not None else np.zeros(16, dtype=dtype)
+        self.size = len(data) if data is not None else 0
+
+    def view(self) -> np.ndarray:
+        return self.data[:self.size]
+
+    def _writable(self, capacity: int):
+        if capacity > len(self.data):
+            grown = np.zeros(max(capacity, len(self.data) * 2, 16), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        elif not self.data.flags.writeable:
+            self.data = np.array(self.data)
+
+    def append(self, value):
+        self._writable(self.size + 1)
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values: np.ndarray):
+        self._writable(self.size + len(values))
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+    def set(self, position: int, value):
+        self._writable(self.size)
+        self.data[position] = value
+
+class _Interner:
+    def __init__(self, values: Optional[List[str]] = None):
+        self.values = values or []
+        self.codes = {value: code for code, value in enumerate(self.values)}
+        self._normalized = None
+
+    def code(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            self._normalized = None
+        return code
+
+    def matching(self, wanted: List[Any]) -> np.ndarray:
+        """Codes whose value equals one of wanted, ignoring case and surrounding spaces"""
+        if self._normalized is None:
+            self._normalized = [normalize(value) for value in self.values]
+        wanted = {normalize(value) for value in wanted}
+        return np.array([code for code, value in enumerate(self._normalized) if value in wanted], dtype=np.int32)
+
+class _Column:
+    """One field. Missing values are tracked in present; variable-length kinds use offsets"""
+
+    FIXED = {"number": np.float64, "bool": np.int8, "category": np.int32}
+
+    def __init__(self, kind: str, rows: int = 0):
+        self.kind = kind
+        self.integral = True
+        self.present = _Array(np.bool_, np.zeros(rows, dtype=np.bool_))
+        self.interner = _Interner() if kind in ("category", "categories") else None
+        if kind in self.FIXED:
+            self.values = _Array(self.FIXED[kind], np.zeros(rows, dtype=self.FIXED[kind]))
+        else:
+            self.values = _Array(np.int32 if kind == "categories" else np.uint8)
+            self.offsets = _Array(np.int64, np.zeros(rows + 1, dtype=np.int64))
+
+    @staticmethod
+    def kind_for(field: str, value: Any) -> str:
+        if isinstance(value, bool):
+            return "bool"
+        if isinstance(value, (int, float)):
+            return "number"
+        if isinstance(value, str):
+            return "category" if field in CATEGORICAL_FIELDS else "text"
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            return "categories"
+        return "object"
+
+    def accepts(self, value: Any) -> bool:
+        if self.kind == "object":
+            return True
+        kind = self.kind_for("", value)
+        if self.kind == "category":
+            return kind == "text"
+        return kind == self.kind
+
+    def append(self, value: Any):
+        self.present.append(True)
+        if self.kind == "number":
+            self.integral = self.integral and isinstance(value, int)
+            self.values.append(value)
+        elif self.kind == "bool":
+            self.values.append(1 if value else 0)
+        elif self.kind == "category":
+            self.values.append(self.interner.code(value))
+        else:
+            if self.kind == "categories":
+                encoded = np.array([self.interner.code(item) for item in value], dtype=np.int32)
+            elif self.kind == "text":
+                encoded = np.frombuffer(value.encode("utf-8"), dtype=np.uint8)
+            else:
+                encoded = np.frombuffer(bson.encode({"v": value}), dtype=np.uint8)
+            self.values.extend(encoded)
+            self.offsets.append(self.values.size)
+
+    def append_missing(self):
+        self.present.append(False)
+        if self.kind in self.FIXED:
+            self.values.append(0)
+        else:
+            self.offsets.append(self.values.size)
+
+    def get(self, row: int) -> Any:
+        if self.kind == "number":
+            value = float(self.values.data[row])
+            return int(value) if self.integral else value
+        if self.kind == "bool":
+            return bool(self.values.data[row])
+        if self.kind == "category":
+            return self.interner.values[self.values.data[row]]
+        start, end = self.offsets.data[row], self.offsets.data[row + 1]
+        raw = self.values.data[start:end]
+        if self.kind == "categories":
+            return [self.interner.values[code] for code in raw.tolist()]
+        if self.kind == "text":
+            return raw.tobytes().decode("utf-8")
+        return bson.decode(raw.tobytes())["v"]
+
+    def mask(self, rows: int, operator: Optional[str], wanted: List[Any]) -> Optional[np.ndarray]:
+        """Vectorized match of the first rows, or None when this kind needs a row-by-row check"""
+        present = self.present.view()[:rows]
+        if operator is not None:
+            if self.kind != "number":
+                return None
+            try:
+                bound = float(wanted[0])
+            except (TypeError, ValueError):
+                return np.zeros(rows, dtype=np.bool_)
+            return present & RANGE_OPERATORS[operator](self.values.view()[:rows], bound)
+        if self.kind == "category":
+            return present & np.isin(self.values.view()[:rows], self.interner.matching(wanted))
+        if self.kind == "categories":
+            offsets = self.offsets.view()[:rows + 1]
+            hits = np.isin(self.values.view()[:offsets[-1]], self.interner.matching(wanted))
+            owners = np.repeat(np.arange(rows), np.diff(offsets))
+            mask = np.zeros(rows, dtype=np.bool_)
+            mask[owners[hits]] = True
+            return mask
+        if self.kind == "bool":
+            wanted = [int(bool(value)) for value in wanted if isinstance(value, (bool, int))]
+            return present & np.isin(self.values.view()[:rows], wanted)
+        if self.kind == "number":
+            wanted = [value for value in wanted if isinstance(value, (int, float))]
+            return present & np.isin(self.values.view()[:rows], wanted)
+        return None
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {"present": self.present.view(), "values": self.values.view()}
+        if self.kind not in self.FIXED:
+            arrays["offsets"] = self.offsets.view()
+        return arrays
+
+class MetadataTable(Mapping):
+    """Array-backed slot -> metadata table.
+
+    Rows are appended in slot order, so lookups are a binary search on the slots column.
+    Each metadata field is a column: interned codes for categorical strings and string
+    lists, numpy arrays for numbers and booleans, and a byte blob with offsets for free
+    text (content, names). Values that don't fit their column, and fields of other types,
+    go to a BSON blob column. Dicts are only built for rows that are read, and filters and
+    type counts run vectorized over the columns.
+    """
+
+    def __init__(self):
+        self.slots = _Array(np.int64)
+        self.live = _Array(np.bool_)
+        self.doc_ids = _Column("text")
+        self.columns: Dict[str, _Column] = {}
+        # Same field, for the rows whose value didn't fit the main column
+        self.fallback: Dict[str, _Column] = {}
+        self.live_count = 0
+        self._sorted = True
+
+    @classmethod
+    def from_rows(cls, rows: List[Dict[str, Any]]) -> "MetadataTable":
+        table = cls()
+        for row in sorted(rows, key=lambda row: row["index"]):
+            table.append(row["index"], row["doc_id"], row["metadata"])
+        return table
+
+    def __len__(self) -> int:
+        return self.live_count
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.live_slots().tolist())
+
+    def __contains__(self, slot) -> bool:
+        return self._row(slot) >= 0
+
+    def __getitem__(self, slot) -> Dict[str, Any]:
+        row = self._row(slot)
+        if row < 0:
+            raise KeyError(slot)
+        return self._materialize(row)
+
+    def get_field(self, slot, field: str, default: Any = None) -> Any:
+        """One field of a row, without building the whole dict"""
+        row = self._row(slot)
+        value = self._value(row, field) if row >= 0 else _MISSING
+        return default if value is _MISSING else value
+
+    def iter_field(self, field: str) -> Iterator[Tuple[int, Any]]:
+        """(slot, value) of every live row that has the field"""
+        self._ensure_sorted()
+        for row in np.flatnonzero(self.live.view()).tolist():
+            value = self._value(row, field)
+            if value is not _MISSING:
+                yield int(self.slots.data[row]), value
+
+    def live_slots(self) -> np.ndarray:
+        self._ensure_sorted()
+        return self.slots.view()[self.live.view()]
+
+    def append(self, slot: int, doc_id: str, metadata: Dict[str, Any]):
+        rows = self.slots.size
+        if rows and slot <= self.slots.data[rows - 1]:
+            self._sorted = False
+        self.slots.append(slot)
+        self.live.append(True)
+        self.doc_ids.append(str(doc_id))
+        self.live_count += 1
+
+        for field, value in metadata.items():
+            column = self.columns.get(field)
+            if column is None:
+                column = self.columns[field] = _Column(_Column.kind_for(field, value), rows)
+            if not column.accepts(value):
+                column = self.fallback.get(field)
+                if column is None:
+                    column = self.fallback[field] = _Column("object", rows)
+            column.append(value)
+        for columns in (self.columns, self.fallback):
+            for column in columns.values():
+                if column.present.size == rows:
+                    column.append_missing()
+
+    def remove(self, slot) -> bool:
+        row = self._row(slot)
+        if row < 0:
+            return False
+        self.live.set(row, False)
+        self.live_count -= 1
+        dead = self.slots.size - self.live_count
+        if dead >= COMPACT_MIN_DEAD_ROWS and dead > self.live_count:
+            self._rebuild()
+        return True
+
+    def doc_slots(self) -> Dict[str, int]:
+        return {self.doc_ids.get(row): int(self.slots.data[row]) for row in np.flatnonzero(self.live.view()).tolist()}
+
+    def select(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Live slots matching every filter. A list value matches any of its items,
+        <field>_lt/_lte/_gt/_gte compare numbers, strings compare case-insensitively"""
+        self._ensure_sorted()
+        rows = self.slots.size
+        mask = self.live.view().copy()
+        for field, value in filters.items():
+            if value is None:
+                continue
+            name, _, operator = field.rpartition("_")
+            if field in self.columns or field in self.fallback or not name or operator not in RANGE_OPERATORS:
+                name, operator = field, None
+            wanted = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            mask &= self._field_mask(name, operator, wanted, rows, mask)
+        return self.slots.view()[mask]
+
+    def type_counts(self) -> Dict[str, int]:
+        column = self.columns.get("type")
+        counts = {}
+        if column is not None and column.kind == "category":
+            keep = self.live.view() & column.present.view()
+            for code, count in enumerate(np.bincount(column.values.view()[keep], minlength=len(column.interner.values)).tolist()):
+                if count:
+                    counts[column.interner.values[code]] = count
+        missing = self.live_count - sum(counts.values())
+        if missing:
+            counts["unknown"] = missing
+        return counts
+
+    def save(self, directory: str):
+        """Write the live rows as .npy columns that load() can memory-map"""
+        table = self if self.live_count == self.slots.size and self._sorted else self._compacted()
+        schema = {"rows": table.slots.size, "columns": []}
+        arrays = {"slots": table.slots.view(), "doc_ids.values": table.doc_ids.values.view(),
+                  "doc_ids.offsets": table.doc_ids.offsets.view()}
+        for group, columns in (("column", table.columns), ("fallback", table.fallback)):
+            for position, (field, column) in enumerate(columns.items()):
+                schema["columns"].append({
+                    "group": group,
+                    "field": field,
+                    "kind": column.kind,
+                    "integral": column.integral,
+                    "interned": column.interner.values if column.interner else None,
+                })
+                for part, values in column.arrays().items():
+                    arrays[f"{group}{position}.{part}"] = values
+        for name, values in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), values)
+        with open(os.path.join(directory, SCHEMA_FILE), "w", encoding="utf-8") as f:
+            json.dump(schema, f)
+
+    @classmethod
+    def load(cls, directory: str) -> "MetadataTable":
+        """Open columns written by save(), memory-mapped where possible"""
+        def array(name):
+            path = os.path.join(directory, f"{name}.npy")
+            try:
+                return np.load(path, mmap_mode="r")
+            except ValueError:
+                # Empty arrays cannot be mapped
+                return np.load(path)
+
+        with open(os.path.join(directory, SCHEMA_FILE), encoding="utf-8") as f:
+            schema = json.load(f)
+        table = cls()
+        table.slots = _Array(np.int64, array("slots"))
+        table.live = _Array(np.bool_, np.ones(schema["rows"], dtype=np.bool_))
+        table.live_count = schema["rows"]
+        table.doc_ids.values = _Array(np.uint8, array("doc_ids.values"))
+        table.doc_ids.offsets = _Array(np.int64, array("doc_ids.offsets"))
+        table.doc_ids.present = _Array(np.bool_, np.ones(schema["rows"], dtype=np.bool_))
+        positions = {"column": 0, "fallback": 0}
+        for spec in schema["columns"]:
+            group = spec["group"]
+            prefix = f"{group}{positions[group]}"
+            positions[group] += 1
+            column = _Column(spec["kind"])
+            column.integral = spec["integral"]
+            if spec["interned"] is not None:
+                column.interner = _Interner(spec["interned"])
+            column.present = _Array(np.bool_, array(f"{prefix}.present"))
+            column.values = _Array(column.values.data.dtype, array(f"{prefix}.values"))
+            if column.kind not in _Column.FIXED:
+                column.offsets = _Array(np.int64, array(f"{prefix}.offsets"))
+            (table.columns if group == "column" else table.fallback)[spec["field"]] = column
+        return table
+
+    def _field_mask(self, field: str, operator: Optional[str], wanted: List[Any], rows: int, candidates: np.ndarray) -> np.ndarray:
+        mask = np.zeros(rows, dtype=np.bool_)
+        unchecked = np.zeros(rows, dtype=np.bool_)
+        column, fallback = self.columns.get(field), self.fallback.get(field)
+        if column is not None:
+            vectorized = column.mask(rows, operator, wanted)
+            if vectorized is not None:
+                mask |= vectorized
+            else:
+                unchecked |= column.present.view()[:rows]
+        if fallback is not None:
+            unchecked |= fallback.present.view()[:rows]
+        # Row by row for whatever the columns can't answer, only among remaining candidates
+        for row in np.flatnonzero(candidates & unchecked).tolist():
+            value = self._value(row, field)
+            if value is not _MISSING and _matches(value, operator, wanted):
+                mask[row] = True
+        return mask
+
+    def _value(self, row: int, field: str) -> Any:
+        for column in (self.columns.get(field), self.fallback.get(field)):
+            if column is not None and column.present.data[row]:
+                return column.get(row)
+        return _MISSING
+
+    def _materialize(self, row: int) -> Dict[str, Any]:
+        metadata = {}
+        for field, column in self.columns.items():
+            if column.present.data[row]:
+                metadata[field] = column.get(row)
+            elif field in self.fallback and self.fallback[field].present.data[row]:
+                metadata[field] = self.fallback[field].get(row)
+        for field, column in self.fallback.items():
+            if field not in self.columns and column.present.data[row]:
+                metadata[field] = column.get(row)
+        return metadata
+
+    def _row(self, slot) -> int:
+        self._ensure_sorted()
+        slots = self.slots.view()
+        row = int(np.searchsorted(slots, slot))
+        if row < len(slots) and slots[row] == slot and self.live.data[row]:
+            return row
+        return -1
+
+    def _ensure_sorted(self):
+        if not self._sorted:
+            self._rebuild()
+
+    def _compacted(self) -> "MetadataTable":
+        table = MetadataTable()
+        live_rows = np.flatnonzero(self.live.view())
+        for row in live_rows[np.argsort(self.slots.view()[live_rows], kind="stable")].tolist():
+            table.append(int(self.slots.data[row]), self.doc_ids.get(row), self._materialize(row))
+        return table
+
+    def _rebuild(self):
+        """Drop dead rows and restore slot order"""
+        self.__dict__.update(self._compacted().__dict__)
+
+_MISSING = object()
+
+def _matches(value: Any, operator: Optional[str], wanted: List[Any]) -> bool:
+    try:
+        if operator is not None:
+            return bool(RANGE_OPERATORS[operator](value, wanted[0]))
+        items = value if isinstance(value, list) else [value]
+        wanted = {normalize(item) for item in wanted}
+        return any(normalize(item) in wanted for item in items if not isinstance(item, (dict, list)))
+    except TypeError:
+        return False
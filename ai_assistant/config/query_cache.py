@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+
+from .embedding_cache import normalize_text
+
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+# memory (per process) or redis (shared by every worker, at REDIS_URL)
+QUERY_CACHE_BACKEND = os.getenv("QUERY_CACHE_BACKEND", "memory").lower()
+
+VERSION_KEY = "query_cache:version"
+ENTRY_PREFIX = "query_cache:entry:"
+
+def normalize_query(query: str) -> str:
+    return normalize_text(query).lower().strip(" ?!.")
+
+class QueryCache:
+    """Search results keyed by (kind, normalized query, parameters).
+
+    Entries carry the index version they were computed at. Any index write bumps the
+    version, so older entries are ignored from then on; TTL bounds how long an entry
+    lives otherwise. With the redis backend the entries and the version counter are
+    shared by every worker, and a lookup is a single MGET of both.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, redis_url: Optional[str] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._redis = None
+        if redis_url:
+            import redis.asyncio as redis_asyncio
+            self._redis = redis_asyncio.from_url(redis_url)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def key(self, kind: str, query: str, **params) -> str:
+        params = {name: value for name, value in params.items() if value is not None}
+        raw = json.dumps([kind, normalize_query(query), params], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        if not self.enabled:
+            return None
+        payload = None
+        if self._redis is not None:
+            try:
+                version, raw = await self._redis.mget(VERSION_KEY, ENTRY_PREFIX + key)
+                if raw is not None:
+                    entry = json.loads(raw)
+                    if entry["version"] == int(version or 0):
+                        payload = entry["value"]
+            except Exception as e:
+                self._redis_failed(e)
+        else:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, version, payload = entry
+                if expires_at < time.monotonic() or version != self.version:
+                    del self._entries[key]
+                    payload = None
+                else:
+                    self._entries.move_to_end(key)
+
+        if payload is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Decoded per hit, so callers can't change the cached copy
+        return json.loads(payload)
+
+    async def set(self, key: str, value: List[Dict[str, Any]], version: int = None):
+        """Store value as computed at version (the version read before computing it)"""
+        if not self.enabled:
+            return
+        payload = json.dumps(value, default=str)
+        if self._redis is not None:
+            try:
+                entry = json.dumps({"version": version, "value": payload})
+                await self._redis.set(ENTRY_PREFIX + key, entry, ex=max(int(self.ttl), 1))
+            except Exception as e:
+                self._redis_failed(e)
+            return
+        if version != self.version:
+            # The index changed while this was computed
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, version, payload)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def current_version(self) -> int:
+        if self._redis is not None:
+            try:
+                return int(await self._redis.get(VERSION_KEY) or 0)
+            except Exception as e:
+                self._redis_failed(e)
+        return self.version
+
+    async def invalidate(self):
+        """Called on every index write: everything cached so far is stale"""
+        self.version += 1
+        self.invalidations += 1
+        self._entries.clear()
+        if self._redis is not None:
+            try:
+                await self._redis.incr(VERSION_KEY)
+            except Exception as e:
+                self._redis_failed(e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "redis" if self._redis is not None else "memory",
+            "enabled": self.enabled,
+            "entries": len(self._entries) if self._redis is None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "errors": self.errors,
+        }
+
+    def _redis_failed(self, error: Exception):
+        self.errors += 1
+        if self.errors == 1:
+            print(f"Query cache Redis error, serving without cache: {error}")
+
+query_cache = QueryCache(
+    QUERY_CACHE_TTL,
+    QUERY_CACHE_SIZE,
+    os.getenv("REDIS_URL", "redis://localhost:6379") if QUERY_CACHE_BACKEND == "redis" else None
+)
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+# Cosine similarity (embeddings are normalized) a new query needs to reuse a cached answer
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+
+def context_fingerprint(context: List[Dict[str, Any]]) -> str:
+    """Ids and content of the retrieved context, in rank order"""
+    raw = json.dumps(
+        [[item.get('type'), item.get('id'), item.get('content')] for item in context],
+        default=str
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Semantic cache of generated chat answers.
+
+    Entries are grouped by the fingerprint of the context they were generated from, so a
+    lookup only compares the query embedding against answers grounded in exactly the same
+    documents (same ids, same content). Within that group the closest cached query wins if
+    its similarity reaches the threshold. Entries expire after ttl seconds and the least
+    recently used ones are evicted past max_entries.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, threshold: float):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.threshold = threshold
+        # entry id -> (expires, fingerprint, embedding, response)
+        self._entries: "OrderedDict[int, Tuple[float, str, np.ndarray, str]]" = OrderedDict()
+        self._groups: Dict[str, List[int]] = {}
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, query_embedding: List[float], context: List[Dict[str, Any]]) -> Optional[Tuple[str, float]]:
+        """(cached response, similarity) of the closest matching query, or None"""
+        if not self.enabled:
+            return None
+        fingerprint = context_fingerprint(context)
+        entry_ids = self._live_entries(fingerprint)
+        if not entry_ids:
+            self.misses += 1
+            return None
+        query = np.asarray(query_embedding, dtype=np.float32)
+        similarities = np.stack([self._entries[entry_id][2] for entry_id in entry_ids]) @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            self.misses += 1
+            return None
+        entry_id = entry_ids[best]
+        self._entries.move_to_end(entry_id)
+        self.hits += 1
+        return self._entries[entry_id][3], float(similarities[best])
+
+    def set(self, query_embedding: List[float], context: List[Dict[str, Any]], response: str):
+        if not self.enabled:
+            return
+        fingerprint = context_fingerprint(context)
+        entry_id = self._next_id
+        self._next_id += 1
+        embedding = np.asarray(query_embedding, dtype=np.float32)
+        self._entries[entry_id] = (time.monotonic() + self.ttl, fingerprint, embedding, response)
+        self._groups.setdefault(fingerprint, []).append(entry_id)
+        while len(self._entries) > self.max_entries:
+            oldest, (_, oldest_fingerprint, _, _) = self._entries.popitem(last=False)
+            self._forget(oldest_fingerprint, oldest)
+
+    def _live_entries(self, fingerprint: str) -> List[int]:
+        entry_ids = self._groups.get(fingerprint)
+        if not entry_ids:
+            return []
+        now = time.monotonic()
+        for entry_id in [entry_id for entry_id in entry_ids if self._entries[entry_id][0] < now]:
+            del self._entries[entry_id]
+            self._forget(fingerprint, entry_id)
+        return self._groups.get(fingerprint, [])
+
+    def _forget(self, fingerprint: str, entry_id: int):
+        entry_ids = self._groups[fingerprint]
+        entry_ids.remove(entry_id)
+        if not entry_ids:
+            del self._groups[fingerprint]
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,155 @@
+import os
+import copy
+import json
+import uuid
+import asyncio
+from typing import Dict, Any, Callable, Awaitable, Optional
+
+# off, local (per process) or redis (also across workers, at REDIS_URL)
+SINGLE_FLIGHT_SCOPE = os.getenv("SINGLE_FLIGHT_SCOPE", "local").lower()
+# Seconds a cross-worker leader may hold the lock, and how long its result is kept for waiters
+SINGLE_FLIGHT_LOCK_TTL = float(os.getenv("SINGLE_FLIGHT_LOCK_TTL", "30"))
+# Seconds a worker waits for another worker's result before computing it itself
+SINGLE_FLIGHT_WAIT = float(os.getenv("SINGLE_FLIGHT_WAIT", "20"))
+POLL_INTERVAL = 0.05
+
+LOCK_PREFIX = "single_flight:lock:"
+RESULT_PREFIX = "single_flight:result:"
+
+class SingleFlight:
+    """Collapses concurrent identical work into one computation.
+
+    Callers that use the same key while a computation for it is running await that
+    computation's result (or exception) instead of starting their own. With the redis
+    scope the first worker to take a short-lived lock computes, publishes the result
+    under the key for a while and the other workers poll for it; if the leader doesn't
+    deliver in time they compute it themselves. Results must be JSON serializable then.
+    Every caller gets its own deep copy of the result, so callers may change it in place.
+    """
+
+    def __init__(self, scope: str = SINGLE_FLIGHT_SCOPE, redis_url: Optional[str] = None):
+        self.scope = scope
+        self._flights: Dict[str, asyncio.Future] = {}
+        self._redis = None
+        if scope == "redis":
+            import redis.asyncio as redis_asyncio
+            self._redis = redis_asyncio.from_url(redis_url or os.getenv("REDIS_URL", "redis://localhost:6379"))
+        self.leaders = 0
+        self.followers = 0
+        self.remote_followers = 0
+        self.remote_timeouts = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.scope != "off"
+
+    async def do(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.enabled:
+            return await compute()
+        flight = self._flights.get(key)
+        if flight is None:
+            # A task of its own, so the computation outlives the caller that started it
+            flight = asyncio.ensure_future(self._lead(key, compute))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda task: self._finished(key, task))
+        else:
+            self.followers += 1
+        # shield: a caller giving up must not cancel the shared computation
+        return copy.deepcopy(await asyncio.shield(flight))
+
+    def _finished(self, key: str, task: asyncio.Task):
+        self._flights.pop(key, None)
+        if not task.cancelled():
+            # Retrieved here so an exception every caller abandoned isn't logged as lost
+            task.exception()
+
+    async def _lead(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        if self._redis is None:
+            self.leaders += 1
+            return await compute()
+
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self._redis.set(LOCK_PREFIX + key, token, nx=True, px=int(SINGLE_FLIGHT_LOCK_TTL * 1000))
+        except Exception as e:
+            self._redis_failed(e)
+            acquired = True
+            token = None
+        if acquired:
+            self.leaders += 1
+            if token is None:
+                return await compute()
+            await self._discard_result(key)
+            try:
+                result = await compute()
+            except BaseException:
+                await self._release(key, token)
+                raise
+            await self._publish(key, token, result)
+            return result
+
+        self.remote_followers += 1
+        found, result = await self._wait_remote(key)
+        if found:
+            return result
+        self.remote_timeouts += 1
+        self.leaders += 1
+        return await compute()
+
+    async def _publish(self, key: str, token: str, result: Any):
+        try:
+            await self._redis.set(RESULT_PREFIX + key, json.dumps(result, default=str), px=int(SINGLE_FLIGHT_LOCK_TTL * 1000))
+        except Exception as e:
+            self._redis_failed(e)
+        await self._release(key, token)
+
+    async def _release(self, key: str, token: str):
+        try:
+            # Only if the lock is still ours, it may have expired and been taken meanwhile
+            if await self._redis.get(LOCK_PREFIX + key) == token.encode():
+                await self._redis.delete(LOCK_PREFIX + key)
+        except Exception as e:
+            self._redis_failed(e)
+
+    async def _discard_result(self, key: str):
+        # A result left by an earlier flight must not be served to this one's waiters
+        try:
+            await self._redis.delete(RESULT_PREFIX + key)
+        except Exception as e:
+            self._redis_failed(e)
+
+    async def _wait_remote(self, key: str):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SINGLE_FLIGHT_WAIT
+        while loop.time() < deadline:
+            try:
+                raw, lock = await self._redis.mget(RESULT_PREFIX + key, LOCK_PREFIX + key)
+            except Exception as e:
+                self._redis_failed(e)
+                return False, None
+            if raw is not None:
+                return True, json.loads(raw)
+            if lock is None:
+                # The leader gave up without a result
+                return False, None
+            await asyncio.sleep(POLL_INTERVAL)
+        return False, None
+
+    def _redis_failed(self, error: Exception):
+        self.errors += 1
+        if self.errors == 1:
+            print(f"Single-flight Redis error, coalescing per process only: {error}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "scope": self.scope,
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "remote_followers": self.remote_followers,
+            "remote_timeouts": self.remote_timeouts,
+            "errors": self.errors,
+        }
+
+single_flight = SingleFlight()
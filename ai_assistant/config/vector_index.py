@@ -0,0 +1,249 @@
+import os
+from typing import List, Dict, Any, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from .metadata_table import MetadataTable
+from .lexical_index import LexicalIndex
+from .index_factory import (
+    IndexConfig, create_initial_index, index_type_of, migration_threshold,
+    reconstruct_vectors, search_parameters, widened_parameters
+)
+
+# Rebuild HNSW indexes once this share of their vectors is dead
+TOMBSTONE_REBUILD_RATIO = 0.1
+# Filters matching at most this many vectors are scored exactly instead of searched
+FILTER_EXACT_MAX = int(os.getenv("VECTOR_FILTER_EXACT_MAX", "4096"))
+
+class IdMappedIndex:
+    """FAISS index keyed by document id (IndexIDMap2, or native ids for IVF).
+
+    Every stored vector gets a fresh int64 slot and doc_slots points each document id
+    at its current slot. Upserting or removing a document drops its old slot, so the
+    index never holds duplicates. Index types without remove_ids support (HNSW) keep
+    dead slots as tombstones that are excluded at search time until the next rebuild.
+    """
+
+    def __init__(self, config: IndexConfig, dimension: int, index: Optional[faiss.Index] = None):
+        self.config = config
+        self.dimension = dimension
+        self.index = index if index is not None else create_initial_index(config, dimension)
+        self.metadata = MetadataTable()
+        self._doc_slots: Optional[Dict[str, int]] = {}
+        self.next_slot = 0
+        self.tombstones = set()
+        self._tombstone_refs = None
+        # BM25 index over metadata['content'], built on first lexical search
+        self._lexical: Optional[LexicalIndex] = None
+        # Raw index operations recorded while a rebuild runs in the background
+        self._journal = None
+
+    @classmethod
+    def from_snapshot(cls, config: IndexConfig, dimension: int, index: faiss.Index, rows: List[Dict[str, Any]]) -> "IdMappedIndex":
+        if any("doc_id" not in row for row in rows):
+            # Positional snapshot from before ids existed: re-add as upserts, the last row per document wins
+            id_index = cls(config, dimension)
+            doc_ids = [row.get("doc_id") or str(row["metadata"].get("id") or f"legacy-{row['index']}") for row in rows]
+            vectors = reconstruct_vectors(index, 0, index.ntotal)
+            id_index.upsert(doc_ids, vectors[:len(rows)], [row["metadata"] for row in rows])
+            return id_index
+
+        id_index = cls(config, dimension, index)
+        for row in sorted(rows, key=lambda row: row["index"]):
+            id_index.metadata.append(row["index"], row["doc_id"], row["metadata"])
+            id_index.doc_slots[row["doc_id"]] = row["index"]
+        id_index._init_slots()
+        return id_index
+
+    @classmethod
+    def from_table(cls, config: IndexConfig, dimension: int, index: faiss.Index, table: MetadataTable) -> "IdMappedIndex":
+        """Open a snapshot whose metadata is already a (memory-mapped) table. doc_slots is built on first use"""
+        id_index = cls(config, dimension, index)
+        id_index.metadata = table
+        id_index._doc_slots = None
+        id_index._init_slots()
+        return id_index
+
+    def _init_slots(self):
+        index = faiss.downcast_index(self.index)
+        live = self.metadata.live_slots()
+        labels = faiss.vector_to_array(index.id_map) if hasattr(index, "id_map") else live
+        if len(labels):
+            self.next_slot = int(labels.max()) + 1
+            self.tombstones = set(np.setdiff1d(labels, live).tolist())
+
+    @property
+    def doc_slots(self) -> Dict[str, int]:
+        if self._doc_slots is None:
+            self._doc_slots = self.metadata.doc_slots()
+        return self._doc_slots
+
+    @property
+    def lexical(self) -> LexicalIndex:
+        if self._lexical is None:
+            self._lexical = LexicalIndex()
+            self._lexical.add_many(self.metadata.iter_field("content"))
+        return self._lexical
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def snapshot_rows(self) -> List[Dict[str, Any]]:
+        return [
+            {"index": slot, "doc_id": doc_id, "metadata": self.metadata[slot]}
+            for doc_id, slot in self.doc_slots.items()
+        ]
+
+    def upsert(self, doc_ids: List[str], vectors: np.ndarray,
+               metadata: List[Dict[str, Any]]) -> Tuple[List[str], np.ndarray, np.ndarray, List[Dict[str, Any]]]:
+        """Insert or replace documents under fresh slots. Returns what was applied, for the log"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        last_position = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        if len(last_position) != len(doc_ids):
+            keep = sorted(last_position.values())
+            doc_ids = [doc_ids[i] for i in keep]
+            vectors = vectors[keep]
+            metadata = [metadata[i] for i in keep]
+
+        slots = np.arange(self.next_slot, self.next_slot + len(doc_ids), dtype=np.int64)
+        self.next_slot += len(doc_ids)
+
+        stale = [self.doc_slots[doc_id] for doc_id in doc_ids if doc_id in self.doc_slots]
+        if stale:
+            self._remove_slots(stale)
+
+        self.index.add_with_ids(vectors, slots)
+        if self._journal is not None:
+            self._journal.append(("add", slots, vectors))
+        for doc_id, slot, meta in zip(doc_ids, slots.tolist(), metadata):
+            self.metadata.append(slot, doc_id, meta)
+            self.doc_slots[doc_id] = slot
+            if self._lexical is not None:
+                self._lexical.add(slot, meta.get("content", ""))
+        return doc_ids, slots, vectors, metadata
+
+    def remove(self, doc_ids: List[str]) -> List[str]:
+        """Remove documents. Returns the ids that were actually indexed"""
+        removed = [doc_id for doc_id in doc_ids if doc_id in self.doc_slots]
+        if removed:
+            self._remove_slots([self.doc_slots.pop(doc_id) for doc_id in removed])
+        return removed
+
+    def _remove_slots(self, slots: List[int]):
+        for slot in slots:
+            if self._lexical is not None:
+                self._lexical.remove(slot, self.metadata.get_field(slot, "content", ""))
+            self.metadata.remove(slot)
+        slot_array = np.array(slots, dtype=np.int64)
+        if self._journal is not None:
+            self._journal.append(("remove", slot_array, None))
+        if not _remove_ids(self.index, slot_array):
+            self.tombstones.update(slots)
+            self._tombstone_refs = None
+
+    def filter_slots(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Live slots whose metadata matches every filter, see MetadataTable.select"""
+        return self.metadata.select(filters)
+
+    def lexical_search(self, query: str, top_k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[float, int]]:
+        return self.lexical.search(query, top_k, allowed)
+
+    def search(self, query_vectors: np.ndarray, top_k: int, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k (scores, slots). With allowed, only those slots can be returned"""
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+        if allowed is not None and len(allowed) <= FILTER_EXACT_MAX:
+            return self._search_exact(query_vectors, top_k, allowed)
+
+        params = search_parameters(self.index, self.config, nprobe, ef_search)
+        # Allowed slots are all live, so they already exclude the tombstones
+        selector = _allow_selector(allowed) if allowed is not None else self._tombstone_selector() if self.tombstones else None
+        if selector is None:
+            return self.index.search(query_vectors, top_k, params=params)
+        if params is None:
+            params = faiss.SearchParameters()
+        params.sel = selector
+        scores, labels = self.index.search(query_vectors, top_k, params=params)
+
+        # IVF probes and HNSW walks only see part of the index, and the selector can reject
+        # most of what they reach: rows with fewer than k hits are searched again, wider
+        expected = min(top_k, len(allowed) if allowed is not None else len(self))
+        short = np.flatnonzero((labels >= 0).sum(axis=1) < expected)
+        if len(short):
+            widened = widened_parameters(self.index, self.config, ef_search)
+            if widened is not None:
+                widened.sel = selector
+                scores[short], labels[short] = self.index.search(query_vectors[short], top_k, params=widened)
+                short = short[(labels[short] >= 0).sum(axis=1) < expected]
+        if len(short):
+            candidates = allowed if allowed is not None else self.metadata.live_slots()
+            scores[short], labels[short] = self._search_exact(query_vectors[short], top_k, candidates)
+        return scores, labels
+
+    def _search_exact(self, query_vectors: np.ndarray, top_k: int, allowed: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # A small partition is cheaper to score directly, and approximate indexes
+        # (IVF probes, HNSW graph walks) can miss most of it under a selective filter
+        scores = np.full((len(query_vectors), top_k), -np.inf, dtype=np.float32)
+        labels = np.full((len(query_vectors), top_k), -1, dtype=np.int64)
+        if len(allowed) == 0:
+            return scores, labels
+        similarities = query_vectors @ self.index.reconstruct_batch(allowed).T
+        k = min(top_k, len(allowed))
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        for row, columns in enumerate(top):
+            columns = columns[np.argsort(-similarities[row, columns])]
+            scores[row, :k] = similarities[row, columns]
+            labels[row, :k] = allowed[columns]
+        return scores, labels
+
+    def _tombstone_selector(self):
+        if self._tombstone_refs is None:
+            ids = np.array(sorted(self.tombstones), dtype=np.int64)
+            batch = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+            # The selectors only hold raw pointers, keep everything alive together
+            self._tombstone_refs = (ids, batch, faiss.IDSelectorNot(batch))
+        return self._tombstone_refs[2]
+
+    def needs_rebuild(self) -> bool:
+        ntotal = self.index.ntotal
+        if index_type_of(self.index) != self.config.index_type and len(self) >= migration_threshold(self.config):
+            return True
+        return ntotal > 0 and len(self.tombstones) > TOMBSTONE_REBUILD_RATIO * ntotal
+
+    def begin_rebuild(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Live slots and vectors to build a replacement index from"""
+        labels = self.metadata.live_slots()
+        vectors = self.index.reconstruct_batch(labels) if len(labels) else np.zeros((0, self.dimension), dtype=np.float32)
+        self._journal = []
+        return labels, vectors
+
+    def finish_rebuild(self, index: faiss.Index):
+        """Swap in the rebuilt index after replaying what changed while it was built"""
+        tombstones = set()
+        for op, slots, vectors in self._journal or []:
+            if op == "add":
+                index.add_with_ids(vectors, slots)
+            elif not _remove_ids(index, slots):
+                tombstones.update(slots.tolist())
+        self._journal = None
+        self.index = index
+        self.tombstones = tombstones
+        self._tombstone_refs = None
+
+    def abort_rebuild(self):
+        self._journal = None
+
+def _allow_selector(allowed: np.ndarray):
+    allowed = np.ascontiguousarray(allowed, dtype=np.int64)
+    selector = faiss.IDSelectorBatch(len(allowed), faiss.swig_ptr(allowed))
+    # The selector only holds a raw pointer to the ids
+    selector.referenced_ids = allowed
+    return selector
+
+def _remove_ids(index: faiss.Index, slots: np.ndarray) -> bool:
+    try:
+        index.remove_ids(slots)
+        return True
+    except RuntimeError:
+        return False
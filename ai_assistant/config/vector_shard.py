@@ -0,0 +1,345 @@
+import os
+import time
+import asyncio
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from .vector_store import VectorLogStore
+from .vector_index import IdMappedIndex
+from .index_factory import IndexConfig, build_trained_index, index_type_of
+from . import local_snapshot
+
+COMPACT_AFTER_SEGMENTS = int(os.getenv("VECTOR_COMPACT_AFTER_SEGMENTS", "50"))
+# Seconds a missing seq may hold back syncing before it is taken as a failed append and skipped
+SEGMENT_GAP_WAIT = float(os.getenv("VECTOR_SEGMENT_GAP_WAIT", "60"))
+
+class VectorShard:
+    """One independently persisted part of the vector index.
+
+    Each shard has its own IdMappedIndex, its own snapshot + segment log (stored under its
+    name) and its own compaction and rebuild, so heavy writes to one shard never touch
+    another. Searches run on worker threads, so the FAISS index is guarded by a thread
+    lock; event loop writes hold it only for the in-memory update.
+
+    Every snapshot is also kept on local disk. When it is still current in MongoDB the
+    shard opens it memory-mapped instead of downloading it, and workers on the same host
+    share its pages. Memory-mapped IVF lists are read-only, so the first write loads a
+    private copy of the index.
+
+    Other processes append to the same log; sync() applies their segments in seq order
+    (and reloads when a snapshot replaced segments this shard never saw, or the index was
+    cleared elsewhere), skipping the ones this shard appended itself.
+    """
+
+    def __init__(self, name: str, db, config: IndexConfig, dimension: int):
+        self.name = name
+        self.config = config
+        self.dimension = dimension
+        self.store = VectorLogStore(db, name)
+        self.id_index = IdMappedIndex(config, dimension)
+        # Operations applied to the index but not yet appended to the log
+        self._pending_ops = []
+        self._snapshot_required = False
+        self._reset_required = False
+        # Every segment up to _last_seq is applied; own segments past it wait in _own_seqs
+        self._last_seq = 0
+        self._own_seqs = set()
+        self._gap = None
+        self._epoch = None
+        self._segments_since_snapshot = 0
+        # Set while the index is a read-only memory map of this file
+        self._mapped_index_path = None
+        self._index_lock = threading.Lock()
+        self._persist_lock = asyncio.Lock()
+        self._compaction_lock = asyncio.Lock()
+        self._compaction_task = None
+        self._migration_task = None
+
+    def __len__(self):
+        return len(self.id_index)
+
+    async def load(self):
+        """Rebuild the shard from its last snapshot plus the segments logged after it"""
+        local = local_snapshot.current_snapshot(self.name)
+        snapshot = await self.store.load_snapshot(local["snapshot_id"] if local else None)
+        self._mapped_index_path = None
+        if snapshot and snapshot["cached"]:
+            index, table, path = await asyncio.to_thread(local_snapshot.open_snapshot, self.name, snapshot["snapshot_id"])
+            id_index = IdMappedIndex.from_table(self.config, self.dimension, index, table)
+            if index_type_of(index) in ("ivfflat", "ivfpq"):
+                self._mapped_index_path = path
+        elif snapshot and snapshot["index_bytes"] is not None:
+            index = faiss.deserialize_index(snapshot["index_bytes"])
+            id_index = IdMappedIndex.from_snapshot(self.config, self.dimension, index, snapshot["rows"])
+            if snapshot["snapshot_id"] and all("doc_id" in row for row in snapshot["rows"]):
+                await self._write_local(snapshot["snapshot_id"], snapshot["last_seq"], snapshot["index_bytes"], snapshot["rows"])
+        else:
+            id_index = IdMappedIndex(self.config, self.dimension)
+        self._last_seq = snapshot["last_seq"] if snapshot else 0
+        self._epoch = snapshot["epoch"] if snapshot else None
+        self._own_seqs = set()
+
+        replayed = 0
+        async for seq, op in self.store.iter_segments(self._last_seq):
+            self._ensure_writable(id_index)
+            self._apply(id_index, op)
+            self._last_seq = seq
+            replayed += 1
+        self._segments_since_snapshot = replayed
+        with self._index_lock:
+            self.id_index = id_index
+        source = "local disk" if snapshot and snapshot["cached"] else "MongoDB"
+        print(f"Loaded vector shard {self.name} from {source} with {len(id_index)} entries ({replayed} log segments replayed)")
+
+    def _apply(self, id_index: IdMappedIndex, op: Dict[str, Any]):
+        if op["op"] == "remove":
+            id_index.remove(op["doc_ids"])
+        else:
+            id_index.upsert(op["doc_ids"], op["vectors"], op["metadata"])
+
+    async def sync(self) -> int:
+        """Apply the segments other processes appended since this shard last read the log.
+        Returns how many were applied"""
+        async with self._compaction_lock:
+            async with self._persist_lock:
+                manifest = await self.store.manifest()
+                if manifest and (manifest.get("epoch") != self._epoch or manifest.get("last_seq", 0) > self._last_seq):
+                    # Cleared elsewhere, or a snapshot truncated segments we haven't applied
+                    if self._pending_ops or self._snapshot_required:
+                        return 0
+                    await self.load()
+                    return 1
+                applied = 0
+                async for seq, op in self.store.iter_segments(self._last_seq):
+                    if seq != self._last_seq + 1 and not self._gap_expired():
+                        # An earlier seq is allocated but not written yet
+                        break
+                    if seq in self._own_seqs:
+                        self._own_seqs.discard(seq)
+                    else:
+                        with self._index_lock:
+                            self._ensure_writable(self.id_index)
+                            self._apply(self.id_index, op)
+                        applied += 1
+                    self._last_seq = seq
+                self._advance_own_seqs()
+        if applied:
+            self.maybe_schedule_migration()
+        return applied
+
+    def _gap_expired(self) -> bool:
+        now = time.monotonic()
+        if self._gap is None or self._gap[0] != self._last_seq:
+            self._gap = (self._last_seq, now)
+        return now - self._gap[1] >= SEGMENT_GAP_WAIT
+
+    def _advance_own_seqs(self):
+        while self._last_seq + 1 in self._own_seqs:
+            self._last_seq += 1
+            self._own_seqs.discard(self._last_seq)
+
+    def _ensure_writable(self, id_index: IdMappedIndex):
+        # Caller holds _index_lock or owns id_index exclusively
+        if self._mapped_index_path:
+            id_index.index = faiss.read_index(self._mapped_index_path)
+            self._mapped_index_path = None
+
+    async def _write_local(self, snapshot_id: str, last_seq: int, index_bytes: np.ndarray, rows: List[Dict[str, Any]]):
+        try:
+            await asyncio.to_thread(local_snapshot.write_snapshot, self.name, snapshot_id, last_seq, index_bytes, rows)
+        except Exception as e:
+            print(f"Error writing local snapshot of vector shard {self.name}: {e}")
+
+    def export(self) -> Tuple[List[str], np.ndarray, List[Dict[str, Any]]]:
+        """Every live document as (doc ids, vectors, metadata)"""
+        return self.lookup(list(self.id_index.doc_slots))
+
+    def lookup(self, doc_ids: List[str], with_vectors: bool = True) -> Tuple[List[str], np.ndarray, List[Dict[str, Any]]]:
+        """Stored (doc ids, vectors, metadata) of the given documents that are indexed here.
+        Vectors are reconstructed from the index, nothing is re-encoded"""
+        with self._index_lock:
+            doc_slots = self.id_index.doc_slots
+            found = [doc_id for doc_id in doc_ids if doc_id in doc_slots]
+            slots = np.array([doc_slots[doc_id] for doc_id in found], dtype=np.int64)
+            vectors = np.zeros((0, self.dimension), dtype=np.float32)
+            if with_vectors and len(slots):
+                vectors = self.id_index.index.reconstruct_batch(slots)
+            metadata = [self.id_index.metadata[slot] for slot in slots.tolist()]
+        return found, vectors, metadata
+
+    def upsert(self, doc_ids: List[str], vectors: np.ndarray, metadata: List[Dict[str, Any]]):
+        with self._index_lock:
+            self._ensure_writable(self.id_index)
+            doc_ids, _, vectors, metadata = self.id_index.upsert(doc_ids, vectors, metadata)
+        if not self._reset_required:
+            self._pending_ops.append({"op": "upsert", "doc_ids": doc_ids, "vectors": vectors, "metadata": metadata})
+        self.maybe_schedule_migration()
+
+    def remove(self, doc_ids: List[str]) -> int:
+        if not any(doc_id in self.id_index.doc_slots for doc_id in doc_ids):
+            return 0
+        with self._index_lock:
+            self._ensure_writable(self.id_index)
+            removed = self.id_index.remove(doc_ids)
+        if removed and not self._reset_required:
+            self._pending_ops.append({"op": "remove", "doc_ids": removed})
+            self.maybe_schedule_migration()
+        return len(removed)
+
+    def clear(self):
+        """Drop every vector. Until the next flush writes a fresh snapshot, changes are not
+        queued for the log: the snapshot contains them"""
+        self.replace_index(IdMappedIndex(self.config, self.dimension))
+
+    def replace_index(self, id_index: IdMappedIndex):
+        """Swap in an index built elsewhere (a full reindex). Persisted like a clear, as a fresh snapshot"""
+        with self._index_lock:
+            self.id_index = id_index
+            self._mapped_index_path = None
+        self._pending_ops = []
+        self._snapshot_required = True
+        self._reset_required = True
+
+    def type_counts(self) -> Dict[str, int]:
+        with self._index_lock:
+            return self.id_index.metadata.type_counts()
+
+    def search(self, query_array: np.ndarray, top_k: int, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None, filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[float, Dict[str, Any]]]]:
+        """(score, metadata) pairs per query row, best first. Safe to call from a worker thread"""
+        no_hits = [[] for _ in range(len(query_array))]
+        with self._index_lock:
+            id_index = self.id_index
+            if len(id_index) == 0:
+                return no_hits
+            allowed = None
+            if filters:
+                allowed = id_index.filter_slots(filters)
+                if len(allowed) == 0:
+                    return no_hits
+            scores, labels = id_index.search(query_array, top_k, nprobe, ef_search, allowed=allowed)
+            hits = []
+            for score_row, label_row in zip(scores, labels):
+                row_hits = []
+                for score, label in zip(score_row, label_row):
+                    metadata = id_index.metadata.get(int(label))
+                    if metadata is not None:
+                        row_hits.append((float(score), metadata))
+                hits.append(row_hits)
+        return hits
+
+    def lexical_search(self, query: str, top_k: int, filters: Optional[Dict[str, Any]] = None) -> List[Tuple[float, Dict[str, Any]]]:
+        """BM25 (score, metadata) pairs, best first. Safe to call from a worker thread"""
+        with self._index_lock:
+            id_index = self.id_index
+            if len(id_index) == 0:
+                return []
+            allowed = id_index.filter_slots(filters) if filters else None
+            if allowed is not None and len(allowed) == 0:
+                return []
+            return [(score, id_index.metadata[slot]) for score, slot in id_index.lexical_search(query, top_k, allowed)]
+
+    async def flush(self):
+        """Append pending changes to the log, once per logical operation. Cost scales with the delta"""
+        if self._snapshot_required:
+            await self.compact()
+            return
+        if not self._pending_ops:
+            return
+        async with self._persist_lock:
+            while self._pending_ops:
+                if not await self._append_pending():
+                    return
+        self._maybe_schedule_compaction()
+
+    async def compact(self):
+        """Write a full snapshot and truncate the log"""
+        async with self._compaction_lock:
+            async with self._persist_lock:
+                if self._reset_required:
+                    # Everything since the clear is in the snapshot, logging it too would write it twice
+                    self._pending_ops = []
+                # Otherwise the snapshot must not contain changes that are missing from the log
+                while self._pending_ops:
+                    if not await self._append_pending():
+                        return
+                with self._index_lock:
+                    # A mapped IVF index would serialize as a reference to its file
+                    self._ensure_writable(self.id_index)
+                    index_bytes = faiss.serialize_index(self.id_index.index)
+                    rows = self.id_index.snapshot_rows()
+                last_seq = self._last_seq
+                covered_segments = self._segments_since_snapshot
+                reset = self._reset_required
+                self._snapshot_required = False
+                self._reset_required = False
+
+            # Uploading happens outside the persist lock so flushes keep appending meanwhile
+            try:
+                snapshot_id = await self.store.write_snapshot(index_bytes, rows, last_seq, self.dimension, reset=reset)
+                if reset:
+                    self._epoch = snapshot_id
+                self._segments_since_snapshot -= covered_segments
+                print(f"Vector shard {self.name} compacted to a snapshot with {len(rows)} entries")
+            except Exception as e:
+                self._snapshot_required = True
+                self._reset_required = self._reset_required or reset
+                print(f"Error saving vector shard {self.name} snapshot to MongoDB: {e}")
+                return
+            await self._write_local(snapshot_id, last_seq, index_bytes, rows)
+
+    async def wait_idle(self):
+        for task in (self._compaction_task, self._migration_task):
+            if task and not task.done():
+                await task
+
+    def _maybe_schedule_compaction(self):
+        if self._segments_since_snapshot < COMPACT_AFTER_SEGMENTS:
+            return
+        if self._compaction_task and not self._compaction_task.done():
+            return
+        self._compaction_task = asyncio.create_task(self.compact())
+
+    async def _append_pending(self) -> bool:
+        # Caller holds _persist_lock
+        ops, self._pending_ops = self._pending_ops, []
+        try:
+            seqs = await self.store.append_ops(ops)
+        except Exception as e:
+            print(f"Error appending vector shard {self.name} segments to MongoDB: {e}")
+            self._pending_ops[:0] = ops
+            return False
+        if seqs:
+            # Other processes may have appended in between; sync() applies those and moves past them
+            self._own_seqs.update(seqs)
+            self._advance_own_seqs()
+            self._segments_since_snapshot += len(seqs)
+        return True
+
+    def maybe_schedule_migration(self):
+        if self._migration_task and not self._migration_task.done():
+            return
+        if self.id_index.needs_rebuild():
+            self._migration_task = asyncio.create_task(self._migrate())
+
+    async def _migrate(self):
+        """Rebuild the live index as the configured type, training it if needed"""
+        id_index = self.id_index
+        with self._index_lock:
+            slots, vectors = id_index.begin_rebuild()
+        try:
+            index = await asyncio.to_thread(build_trained_index, self.config, self.dimension, vectors, slots)
+        except Exception as e:
+            id_index.abort_rebuild()
+            print(f"Error building {self.config.index_type} index for vector shard {self.name}: {e}")
+            return
+        if self.id_index is not id_index:
+            # Cleared while we were building
+            return
+        with self._index_lock:
+            id_index.finish_rebuild(index)
+        print(f"Vector shard {self.name} rebuilt as {self.config.index_type} with {index.ntotal} entries")
+        await self.compact()
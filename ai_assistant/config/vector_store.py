@@ -0,0 +1,222 @@
+import os
+import uuid
+import base64
+from datetime import datetime
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
+
+import numpy as np
+from bson.binary import Binary
+from pymongo import ASCENDING, ReturnDocument
+
+# Keep every document well below the 16 MB BSON limit
+SNAPSHOT_CHUNK_BYTES = int(os.getenv("VECTOR_SNAPSHOT_CHUNK_BYTES", str(8 * 1024 * 1024)))
+SEGMENT_MAX_VECTORS = int(os.getenv("VECTOR_SEGMENT_MAX_VECTORS", "1024"))
+REMOVE_SEGMENT_MAX_IDS = 10000
+MAPPING_INSERT_BATCH = 1000
+
+class VectorLogStore:
+    """Snapshot + append-only segment log for a FAISS index in MongoDB.
+
+    Collections:
+      vector_index            manifest per index (snapshot id, last compacted seq, seq counter)
+      vector_snapshot_chunks  serialized FAISS index split into raw binary chunks
+      vector_mapping          (slot, doc id, metadata) rows belonging to a snapshot
+      vector_segments         upsert/remove operations appended since the snapshot, in seq order
+
+    Segments carry document ids but no slots. Several processes may append to the same log,
+    each allocating slots on its own, so slots are assigned again locally on replay.
+    """
+
+    def __init__(self, db, name: str = "main_index"):
+        self.db = db
+        self.name = name
+
+    async def ensure_indexes(self):
+        await self.db.vector_segments.create_index([("name", ASCENDING), ("seq", ASCENDING)], unique=True)
+        await self.db.vector_snapshot_chunks.create_index(
+            [("name", ASCENDING), ("snapshot_id", ASCENDING), ("n", ASCENDING)]
+        )
+        await self.db.vector_mapping.create_index(
+            [("name", ASCENDING), ("snapshot_id", ASCENDING), ("index", ASCENDING)]
+        )
+
+    async def load_snapshot(self, local_snapshot_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Download the current snapshot. If it is local_snapshot_id, only its manifest fields are returned"""
+        manifest = await self.db.vector_index.find_one({"name": self.name})
+        if not manifest:
+            return None
+
+        snapshot_id = manifest.get("snapshot_id")
+        if snapshot_id and snapshot_id == local_snapshot_id:
+            return {"snapshot_id": snapshot_id, "cached": True, "last_seq": manifest.get("last_seq", 0),
+                    "epoch": manifest.get("epoch")}
+        if snapshot_id:
+            chunks = await self.db.vector_snapshot_chunks.find(
+                {"name": self.name, "snapshot_id": snapshot_id}
+            ).sort("n", ASCENDING).to_list(length=None)
+            if len(chunks) != manifest.get("chunk_count", len(chunks)):
+                raise Exception(f"Snapshot {snapshot_id} of {self.name} is incomplete")
+            index_bytes = b"".join(chunk["data"] for chunk in chunks)
+            rows = await self.db.vector_mapping.find(
+                {"name": self.name, "snapshot_id": snapshot_id}
+            ).sort("index", ASCENDING).to_list(length=None)
+        elif manifest.get("index_data"):
+            # Legacy format: whole index as one base64 string, mapping rows without snapshot id
+            index_bytes = base64.b64decode(manifest["index_data"])
+            rows = await self.db.vector_mapping.find(
+                {"snapshot_id": {"$exists": False}}
+            ).sort("index", ASCENDING).to_list(length=None)
+        else:
+            # Only the seq counter exists, everything lives in the log
+            index_bytes = None
+            rows = []
+
+        return {
+            "snapshot_id": snapshot_id,
+            "cached": False,
+            "index_bytes": np.frombuffer(index_bytes, dtype=np.uint8) if index_bytes else None,
+            "rows": rows,
+            "last_seq": manifest.get("last_seq", 0),
+            "epoch": manifest.get("epoch"),
+        }
+
+    async def manifest(self) -> Optional[Dict[str, Any]]:
+        """Current snapshot id, the seq it covers and its epoch, without the snapshot itself"""
+        return await self.db.vector_index.find_one({"name": self.name}, {"snapshot_id": 1, "last_seq": 1, "epoch": 1})
+
+    async def iter_segments(self, after_seq: int = 0) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        cursor = self.db.vector_segments.find(
+            {"name": self.name, "seq": {"$gt": after_seq}}
+        ).sort("seq", ASCENDING)
+        async for doc in cursor:
+            if doc.get("op") == "remove":
+                yield doc["seq"], {"op": "remove", "doc_ids": doc["doc_ids"]}
+                continue
+            vectors = np.frombuffer(doc["vectors"], dtype=np.float32).reshape(doc["count"], doc["dimension"])
+            if "doc_ids" in doc:
+                doc_ids = doc["doc_ids"]
+            else:
+                # Segments written before ids existed
+                doc_ids = [str(metadata.get("id")) for metadata in doc["metadata"]]
+            # Older segments also stored the writer's slots; they may collide with another writer's
+            yield doc["seq"], {
+                "op": "upsert",
+                "doc_ids": doc_ids,
+                "vectors": vectors,
+                "metadata": doc["metadata"],
+            }
+
+    async def _allocate_seqs(self, count: int) -> List[int]:
+        manifest = await self.db.vector_index.find_one_and_update(
+            {"name": self.name},
+            {"$inc": {"next_seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        last = manifest["next_seq"]
+        return list(range(last - count + 1, last + 1))
+
+    async def append_ops(self, ops: List[Dict[str, Any]]) -> List[int]:
+        """Append upsert/remove operations to the log, split into segments. Returns the allocated seqs"""
+        now = datetime.utcnow()
+        docs = []
+        for op in ops:
+            if op["op"] == "remove":
+                for start in range(0, len(op["doc_ids"]), REMOVE_SEGMENT_MAX_IDS):
+                    docs.append({
+                        "name": self.name,
+                        "op": "remove",
+                        "doc_ids": op["doc_ids"][start:start + REMOVE_SEGMENT_MAX_IDS],
+                        "created_at": now,
+                    })
+                continue
+            vectors = np.ascontiguousarray(op["vectors"], dtype=np.float32)
+            for start in range(0, len(op["doc_ids"]), SEGMENT_MAX_VECTORS):
+                end = start + SEGMENT_MAX_VECTORS
+                chunk = vectors[start:end]
+                docs.append({
+                    "name": self.name,
+                    "op": "upsert",
+                    "count": len(chunk),
+                    "dimension": chunk.shape[1],
+                    "doc_ids": op["doc_ids"][start:end],
+                    "vectors": Binary(chunk.tobytes()),
+                    "metadata": op["metadata"][start:end],
+                    "created_at": now,
+                })
+        if not docs:
+            return []
+
+        seqs = await self._allocate_seqs(len(docs))
+        for seq, doc in zip(seqs, docs):
+            doc["seq"] = seq
+        await self.db.vector_segments.insert_many(docs, ordered=True)
+        return seqs
+
+    async def write_snapshot(self, index_bytes: np.ndarray, rows: List[Dict[str, Any]], last_seq: int, dimension: int,
+                             reset: bool = False):
+        """Write a full snapshot covering the log up to last_seq, then drop what it replaces.
+        A reset snapshot (the index was cleared) starts a new epoch, readers must reload it"""
+        snapshot_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        buffer = memoryview(np.ascontiguousarray(index_bytes, dtype=np.uint8)).cast("B")
+
+        chunk_count = 0
+        for offset in range(0, len(buffer), SNAPSHOT_CHUNK_BYTES):
+            await self.db.vector_snapshot_chunks.insert_one({
+                "name": self.name,
+                "snapshot_id": snapshot_id,
+                "n": chunk_count,
+                "data": Binary(bytes(buffer[offset:offset + SNAPSHOT_CHUNK_BYTES])),
+            })
+            chunk_count += 1
+
+        for start in range(0, len(rows), MAPPING_INSERT_BATCH):
+            await self.db.vector_mapping.insert_many([
+                {
+                    "name": self.name,
+                    "snapshot_id": snapshot_id,
+                    "index": row["index"],
+                    "doc_id": row["doc_id"],
+                    "metadata": row["metadata"],
+                    "created_at": now,
+                }
+                for row in rows[start:start + MAPPING_INSERT_BATCH]
+            ])
+
+        # Switching the manifest is what makes the new snapshot visible
+        await self.db.vector_index.update_one(
+            {"name": self.name},
+            {
+                "$set": {
+                    "name": self.name,
+                    "format": 2,
+                    "snapshot_id": snapshot_id,
+                    "chunk_count": chunk_count,
+                    "last_seq": last_seq,
+                    "ntotal": len(rows),
+                    "dimension": dimension,
+                    "updated_at": now,
+                    **({"epoch": snapshot_id} if reset else {}),
+                },
+                "$unset": {"index_data": ""},
+            },
+            upsert=True,
+        )
+
+        await self.db.vector_snapshot_chunks.delete_many({"name": self.name, "snapshot_id": {"$ne": snapshot_id}})
+        await self.db.vector_mapping.delete_many({
+            "$or": [
+                {"name": self.name, "snapshot_id": {"$ne": snapshot_id}},
+                {"snapshot_id": {"$exists": False}},
+            ]
+        })
+        await self.db.vector_segments.delete_many({"name": self.name, "seq": {"$lte": last_seq}})
+        return snapshot_id
+
+    async def drop(self):
+        """Delete the manifest, snapshot and log of this index"""
+        await self.db.vector_index.delete_one({"name": self.name})
+        await self.db.vector_snapshot_chunks.delete_many({"name": self.name})
+        await self.db.vector_mapping.delete_many({"name": self.name})
+        await self.db.vector_segments.delete_many({"name": self.name})
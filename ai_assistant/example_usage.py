@@ -3,14 +3,14 @@ import sys
 import os
 from datetime import datetime
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from config.database import db_manager
-from services.chat_service import chat_service
-from services.vector_indexer import vector_indexer
-from services.notification_service import notification_service
-from services.notification_service import NotificationType, NotificationPriority
-from services.rag_service import rag_service
+from ai_assistant.config.database import db_manager
+from ai_assistant.services.chat_service import chat_service
+from ai_assistant.services.vector_indexer import vector_indexer
+from ai_assistant.services.notification_service import notification_service
+from ai_assistant.services.notification_service import NotificationType, NotificationPriority
+from ai_assistant.services.rag_service import rag_service
 
 async def example_chat_conversation():
     print("Example Chat Conversation")
@@ -183,7 +183,7 @@ async def example_embedding_generation():
     print("Generating embeddings for product descriptions...")
     
     for text in test_texts:
-        embedding = rag_service.create_embedding(text)
+        embedding = await rag_service.create_embedding(text)
         print(f"'{text}': {len(embedding)}-dimensional vector")
         print(f"  First 5 values: {embedding[:5]}")
         print()
@@ -19,6 +19,8 @@ class ChatRequest(BaseModel):
     user_id: str
     session_id: int
     context: Optional[Dict[str, Any]] = None
+    # False always generates a fresh answer for this user
+    use_cache: bool = True
 
 class ChatResponse(BaseModel):
     response: str
@@ -26,6 +28,8 @@ class ChatResponse(BaseModel):
     confidence: float = Field(ge=0.0, le=1.0)
     session_id: str
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    cached: bool = False
+    cache_similarity: Optional[float] = None
 
 class ChatSession(BaseModel):
     session_id: str
@@ -42,6 +46,11 @@ class SearchResult(BaseModel):
     score: float
     metadata: Dict[str, Any]
 
+class BatchSearchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=100)
+    top_k: int = Field(default=5, ge=1, le=100)
+    filters: Optional[Dict[str, Any]] = None
+
 class ConversationContext(BaseModel):
     user_preferences: Dict[str, Any] = Field(default_factory=dict)
     recent_products: List[str] = Field(default_factory=list)
@@ -1,6 +1,6 @@
 import asyncio
-from typing import Dict, Any, List, Optional
-from config.database import db_manager
+from typing import Dict, Any, List, Optional, AsyncIterator
+from ..config.database import db_manager
 import logging
 from datetime import datetime
 from .rag_service import rag_service
@@ -11,12 +11,11 @@ logger = logging.getLogger(__name__)
 class ChatService:
     def __init__(self):
         self.db_manager = db_manager
-        self.conversation_history = {}
         
-    async def process_message(self, message: str, user_id: str, session_id: str) -> Dict[str, Any]:
+    async def process_message(self, message: str, user_id: str, session_id: str, use_cache: bool = True) -> Dict[str, Any]:
         try:
             # Use the RAG system with Gemini
-            response = await rag_service.process_chat_message(message, user_id, session_id)
+            response = await rag_service.process_chat_message(message, user_id, session_id, use_cache=use_cache)
             return response
             
         except Exception as e:
@@ -28,6 +27,14 @@ class ChatService:
                 'session_id': session_id
             }
     
+    async def stream_message(self, message: str, user_id: str, session_id: str, use_cache: bool = True) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            async for event in rag_service.stream_chat_message(message, user_id, session_id, use_cache=use_cache):
+                yield event
+        except Exception as e:
+            logger.error(f"Error streaming message: {e}")
+            yield {'type': 'error', 'error': "I'm having trouble processing your request right now. Please try again later."}
+    
     async def get_chat_history(self, session_id: str, user_id: str) -> List[Dict[str, Any]]:
         if not hasattr(self.db_manager, 'db') or self.db_manager.db is None:
             logger.error("Database connection is not initialized.")
@@ -0,0 +1,313 @@
+import os
+import uuid
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Dict, Any
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+from ..config.database import db_manager
+from ..config.embeddings import get_embeddings_array
+from .vector_indexer import vector_indexer, DOCUMENT_BUILDERS
+from .neighbor_table import neighbor_table
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INDEXER_BATCH_SIZE = int(os.getenv("INDEXER_BATCH_SIZE", "256"))
+INDEXER_MAX_WAIT_MS = int(os.getenv("INDEXER_MAX_WAIT_MS", "500"))
+INDEXER_POLL_INTERVAL = float(os.getenv("INDEXER_POLL_INTERVAL", "5"))
+INDEXER_WATERMARK_FIELD = os.getenv("INDEXER_WATERMARK_FIELD", "updatedAt")
+# Seconds the leader's lease lasts without renewal; it is renewed every third of that
+INDEXER_LEASE_SECONDS = float(os.getenv("INDEXER_LEASE_SECONDS", "30"))
+# Seconds between reads of the vector log for segments other workers appended
+INDEXER_SYNC_INTERVAL = float(os.getenv("INDEXER_SYNC_INTERVAL", "2"))
+
+# Server answers that mean "no change streams here" (standalone server, unsupported storage engine)
+CHANGE_STREAM_UNSUPPORTED = {40573, 40324, 115}
+# Resume token too old or unusable
+RESUME_TOKEN_LOST = {260, 280, 286}
+
+STATE_ID = "vector_indexer"
+LEASE_ID = "vector_indexer"
+
+class IncrementalIndexer:
+    """Keeps the vector index in sync with products/orders/users.
+
+    Tails a MongoDB change stream and applies inserts, updates and deletes in batches of
+    one embedding call, one upsert and one flush. The resume token is stored in the
+    indexer_state collection after every batch, so restarts pick up where they left off.
+    Without change streams it polls on an updatedAt watermark instead (deletes are then
+    only picked up by index_specific_* calls or a full reindex).
+
+    Every API worker starts one, but only the holder of a lease document in
+    indexer_leases (renewed while it runs, expiring through a TTL index) indexes; the
+    others take over when it lapses. Every worker syncs its in-memory shards from the
+    vector log, so changes indexed by the leader show up in all of them.
+    """
+
+    def __init__(self):
+        self.db_manager = db_manager
+        self.batch_size = INDEXER_BATCH_SIZE
+        self.max_wait = INDEXER_MAX_WAIT_MS / 1000
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self.mode = None
+        self.last_batch_at = None
+        self.processed_events = 0
+        self._task = None
+        self._lease_task = None
+        self._sync_task = None
+
+    async def start(self):
+        if self._lease_task and not self._lease_task.done():
+            return
+        await self.db_manager.db.indexer_leases.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+        self._lease_task = asyncio.create_task(self._hold_lease())
+        self._sync_task = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        for task in (self._lease_task, self._sync_task):
+            await _cancel(task)
+        self._lease_task = self._sync_task = None
+        await self._stop_indexing()
+        try:
+            await self.db_manager.db.indexer_leases.delete_one({'_id': LEASE_ID, 'owner': self.owner})
+        except PyMongoError as e:
+            logger.error(f"Error releasing the incremental indexer lease: {e}")
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'running': bool(self._task and not self._task.done()),
+            'leader': self.leader,
+            'owner': self.owner,
+            'mode': self.mode,
+            'processed_events': self.processed_events,
+            'last_batch_at': self.last_batch_at,
+        }
+
+    async def _hold_lease(self):
+        """Take the lease when it is free, renew it while indexing, stop indexing once it is lost"""
+        loop = asyncio.get_running_loop()
+        held_until = 0.0
+        while True:
+            try:
+                acquired = await self._acquire_lease()
+                if acquired:
+                    held_until = loop.time() + INDEXER_LEASE_SECONDS
+            except PyMongoError as e:
+                logger.error(f"Error renewing the incremental indexer lease: {e}")
+                # Keep indexing only while the last renewal is still valid
+                acquired = self.leader and loop.time() < held_until
+            if acquired and (self._task is None or self._task.done()):
+                if not self.leader:
+                    logger.info(f"Incremental indexer lease taken by {self.owner}")
+                self.leader = True
+                self._task = asyncio.create_task(self._run())
+            elif not acquired and self.leader:
+                logger.warning(f"Incremental indexer lease lost by {self.owner}, stopping")
+                await self._stop_indexing()
+            await asyncio.sleep(INDEXER_LEASE_SECONDS / 3)
+
+    async def _acquire_lease(self) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.db_manager.db.indexer_leases.update_one(
+                {'_id': LEASE_ID, '$or': [{'owner': self.owner}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'owner': self.owner, 'expires_at': now + timedelta(seconds=INDEXER_LEASE_SECONDS)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Held by another worker and not expired
+            return False
+        return True
+
+    async def _stop_indexing(self):
+        self.leader = False
+        await _cancel(self._task)
+        self._task = None
+
+    async def _sync(self):
+        while True:
+            await asyncio.sleep(INDEXER_SYNC_INTERVAL)
+            try:
+                await self.db_manager.sync_vector_index()
+            except Exception as e:
+                logger.error(f"Error syncing vector shards from the log: {e}")
+
+    async def _run(self):
+        state = await self._load_state()
+        # Nothing to resume from and nothing indexed: build the index once, in the background
+        bootstrap = not state.get('resume_token') and not state.get('watermarks') and self.db_manager.vector_count() == 0
+        while True:
+            try:
+                self.mode = 'change_stream'
+                await self._tail_change_stream(state.get('resume_token'), bootstrap)
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED:
+                    logger.info("Change streams unavailable, polling for changes instead")
+                    self.mode = 'polling'
+                    await self._poll(state.get('watermarks') or {}, bootstrap)
+                    return
+                if e.code in RESUME_TOKEN_LOST:
+                    # Changes since the token may be missed: rebuild while search keeps the current index
+                    logger.warning("Change stream resume token is no longer valid, resyncing the index")
+                    state['resume_token'] = None
+                    bootstrap = True
+                    continue
+                logger.error(f"Change stream failed: {e}")
+            except PyMongoError as e:
+                logger.error(f"Change stream failed: {e}")
+            except Exception as e:
+                logger.error(f"Incremental indexer error: {e}")
+            # Resume from the last stored token after a short pause; a resync that failed is retried
+            state = await self._load_state()
+            bootstrap = bootstrap and not state.get('resume_token')
+            await asyncio.sleep(INDEXER_POLL_INTERVAL)
+
+    async def _tail_change_stream(self, resume_token, bootstrap: bool):
+        pipeline = [{
+            '$match': {
+                'ns.coll': {'$in': list(DOCUMENT_BUILDERS)},
+                'operationType': {'$in': ['insert', 'update', 'replace', 'delete']},
+            }
+        }]
+        async with self.db_manager.db.watch(
+            pipeline,
+            full_document='updateLookup',
+            resume_after=resume_token,
+            max_await_time_ms=INDEXER_MAX_WAIT_MS,
+        ) as stream:
+            # The first read opens the cursor (and fails here if change streams are unsupported).
+            # Opening it before the bootstrap means edits made during the reindex are not lost.
+            loop = asyncio.get_running_loop()
+            event = await stream.try_next()
+            if bootstrap:
+                await self._resync()
+                await self._save_state({'resume_token': stream.resume_token})
+
+            events = []
+            first_event_at = None
+            while stream.alive:
+                if event is not None:
+                    events.append(event)
+                    first_event_at = first_event_at or loop.time()
+                if events and (
+                    event is None
+                    or len(events) >= self.batch_size
+                    or loop.time() - first_event_at >= self.max_wait
+                ):
+                    await self._apply_events(events)
+                    await self._save_state({'resume_token': stream.resume_token})
+                    events, first_event_at = [], None
+                event = await stream.try_next()
+
+    async def _resync(self):
+        """Reindex everything into fresh shards; searches use the current index until they are swapped in"""
+        result = await vector_indexer.full_reindex()
+        if result.get('status') != 'success':
+            raise Exception(f"Full reindex failed: {result.get('error')}")
+
+    async def _apply_events(self, events: List[Dict[str, Any]]):
+        # Later events for the same document win
+        latest = {}
+        for event in events:
+            collection = event['ns']['coll']
+            doc_id = str(event['documentKey']['_id'])
+            latest[(collection, doc_id)] = event.get('fullDocument') if event['operationType'] != 'delete' else None
+
+        upserts = [(collection, document) for (collection, _), document in latest.items() if document is not None]
+        deletes = [doc_id for (_, doc_id), document in latest.items() if document is None]
+        await self._index_documents(upserts, deletes)
+        self.processed_events += len(events)
+
+    async def _index_documents(self, upserts: List[tuple], deletes: List[str]):
+        if upserts:
+            texts, metadata_list = [], []
+            for collection, document in upserts:
+                text_content, metadata = DOCUMENT_BUILDERS[collection](document)
+                texts.append(text_content)
+                metadata_list.append(metadata)
+            embeddings = await get_embeddings_array(texts)
+            await self.db_manager.upsert_vectors(
+                [metadata['id'] for metadata in metadata_list],
+                embeddings,
+                metadata_list
+            )
+        if deletes:
+            await self.db_manager.remove_vectors(deletes)
+        await self.db_manager.flush_vector_index()
+        await self._refresh_neighbors(metadata_list if upserts else [], deletes)
+        self.last_batch_at = datetime.utcnow()
+        logger.info(f"Incremental index: {len(upserts)} upserted, {len(deletes)} removed")
+
+    async def _refresh_neighbors(self, metadata_list: List[Dict[str, Any]], deletes: List[str]):
+        try:
+            await neighbor_table.remove(deletes)
+            by_type = {}
+            for metadata in metadata_list:
+                by_type.setdefault(metadata['type'], []).append(metadata['id'])
+            for entity_type, doc_ids in by_type.items():
+                await neighbor_table.refresh(entity_type, doc_ids)
+        except Exception as e:
+            logger.error(f"Error refreshing neighbor table: {e}")
+
+    async def _poll(self, watermarks: Dict[str, Any], bootstrap: bool):
+        field = INDEXER_WATERMARK_FIELD
+        if bootstrap:
+            # Everything changed from now on is picked up by polling
+            started_at = datetime.utcnow()
+            await self._resync()
+            watermarks = {collection: {'value': started_at, 'id': None} for collection in DOCUMENT_BUILDERS}
+            await self._save_state({'watermarks': watermarks})
+
+        while True:
+            changed = False
+            for collection in DOCUMENT_BUILDERS:
+                mark = watermarks.get(collection)
+                query = {field: {'$exists': True}}
+                if mark:
+                    after = [{field: {'$gt': mark['value']}}]
+                    if mark.get('id') is not None:
+                        after.append({field: mark['value'], '_id': {'$gt': mark['id']}})
+                    query = {'$or': after}
+                documents = await self.db_manager.db[collection].find(query).sort(
+                    [(field, 1), ('_id', 1)]
+                ).limit(self.batch_size).to_list(length=self.batch_size)
+                if not documents:
+                    continue
+
+                await self._index_documents([(collection, document) for document in documents], [])
+                self.processed_events += len(documents)
+                watermarks[collection] = {'value': documents[-1][field], 'id': documents[-1]['_id']}
+                await self._save_state({'watermarks': watermarks})
+                changed = changed or len(documents) == self.batch_size
+            if not changed:
+                await asyncio.sleep(INDEXER_POLL_INTERVAL)
+
+    async def _load_state(self) -> Dict[str, Any]:
+        state = await self.db_manager.db.indexer_state.find_one({'_id': STATE_ID})
+        return state or {}
+
+    async def _save_state(self, fields: Dict[str, Any]):
+        await self.db_manager.db.indexer_state.update_one(
+            {'_id': STATE_ID},
+            {'$set': {**fields, 'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
+
+async def _cancel(task):
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+incremental_indexer = IncrementalIndexer()
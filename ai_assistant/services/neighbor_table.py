@@ -0,0 +1,150 @@
+import os
+import logging
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+from pymongo import ASCENDING, UpdateOne
+
+from ..config.database import db_manager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Neighbours kept per item. 0 disables the table and /similar always searches the index
+NEIGHBOR_TABLE_K = int(os.getenv("NEIGHBOR_TABLE_K", "0"))
+NEIGHBOR_TABLE_TYPES = [item.strip() for item in os.getenv("NEIGHBOR_TABLE_TYPES", "product").split(",") if item.strip()]
+REBUILD_BATCH_SIZE = 256
+
+class NeighborTable:
+    """Precomputed top-k similar items, stored in the vector_neighbors collection.
+
+    Refreshed incrementally after indexing: changed items get their list recomputed
+    from their stored vectors, and since inner product similarity is symmetric they are
+    also pushed into the lists of their own neighbours (kept sorted, capped at k). Lists
+    that held a changed or removed item are recomputed as well, so none is left short.
+    """
+
+    def __init__(self):
+        self.db_manager = db_manager
+        self.k = NEIGHBOR_TABLE_K
+        self.entity_types = NEIGHBOR_TABLE_TYPES
+        self._indexes_ready = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.k > 0
+
+    @property
+    def collection(self):
+        return self.db_manager.db.vector_neighbors
+
+    async def get(self, entity_type: str, doc_id: str, k: int) -> Optional[List[Dict[str, Any]]]:
+        """Stored neighbours with their current metadata, or None if the table can't answer"""
+        if not self.enabled or entity_type not in self.entity_types or k > self.k:
+            return None
+        entry = await self.collection.find_one({'_id': _key(entity_type, doc_id)})
+        if not entry:
+            return None
+        neighbors = entry['neighbors']
+        found, _, metadata = self.db_manager.get_indexed(entity_type, [item['id'] for item in neighbors], with_vectors=False)
+        metadata_by_id = dict(zip(found, metadata))
+        results = []
+        for item in neighbors:
+            result = metadata_by_id.get(item['id'])
+            if result is not None:
+                result['score'] = item['score']
+                result['rank'] = len(results) + 1
+                results.append(result)
+                if len(results) == k:
+                    return results
+        # Short list (e.g. neighbours no longer indexed): the live index answers instead
+        return None
+
+    async def refresh(self, entity_type: str, doc_ids: List[str], propagate: bool = True):
+        """Recompute the lists of the given items and, with propagate, insert them into their neighbours' lists"""
+        if not self.enabled or entity_type not in self.entity_types or not doc_ids:
+            return
+        await self._ensure_indexes()
+        similar = await self.db_manager.similar_items_many(entity_type, doc_ids, self.k)
+        if not similar:
+            return
+        operations = self._set_lists(entity_type, similar)
+        if propagate:
+            changed = list(similar)
+            # Lists holding a changed item have a stale score for it, and may lose it: recompute them
+            recomputed = set(changed)
+            for holder_ids in await self._holders(entity_type, changed):
+                holders = await self.db_manager.similar_items_many(entity_type, holder_ids, self.k)
+                operations.extend(self._set_lists(entity_type, holders))
+                recomputed.update(holder_ids)
+            for doc_id, hits in similar.items():
+                for hit in hits:
+                    if str(hit['id']) in recomputed:
+                        # Its list was just recomputed and already ranks doc_id against everything
+                        continue
+                    operations.append(UpdateOne(
+                        {'_id': _key(entity_type, str(hit['id']))},
+                        {'$push': {'neighbors': {
+                            '$each': [{'id': doc_id, 'score': hit['score']}],
+                            '$sort': {'score': -1},
+                            '$slice': self.k,
+                        }}}
+                    ))
+        await self.collection.bulk_write(operations, ordered=True)
+
+    async def remove(self, doc_ids: List[str]):
+        """Drop the lists of removed items and recompute the lists they were in"""
+        if not self.enabled or not doc_ids:
+            return
+        await self.collection.delete_many({'doc_id': {'$in': doc_ids}})
+        for entity_type in self.entity_types:
+            for holder_ids in await self._holders(entity_type, doc_ids):
+                holders = await self.db_manager.similar_items_many(entity_type, holder_ids, self.k)
+                operations = self._set_lists(entity_type, holders)
+                if operations:
+                    await self.collection.bulk_write(operations, ordered=False)
+
+    def _set_lists(self, entity_type: str, similar: Dict[str, List[Dict[str, Any]]]) -> List[UpdateOne]:
+        now = datetime.utcnow()
+        return [
+            UpdateOne(
+                {'_id': _key(entity_type, doc_id)},
+                {'$set': {
+                    'type': entity_type,
+                    'doc_id': doc_id,
+                    'neighbors': [{'id': str(hit['id']), 'score': hit['score']} for hit in hits],
+                    'updated_at': now,
+                }},
+                upsert=True
+            )
+            for doc_id, hits in similar.items()
+        ]
+
+    async def _holders(self, entity_type: str, doc_ids: List[str]) -> List[List[str]]:
+        """Ids of the other items whose lists contain any of doc_ids, in batches"""
+        holder_ids = await self.collection.distinct(
+            'doc_id', {'type': entity_type, 'neighbors.id': {'$in': doc_ids}, 'doc_id': {'$nin': doc_ids}}
+        )
+        return [holder_ids[start:start + REBUILD_BATCH_SIZE] for start in range(0, len(holder_ids), REBUILD_BATCH_SIZE)]
+
+    async def rebuild(self):
+        """Recompute the whole table from the index, e.g. after a full reindex"""
+        if not self.enabled:
+            return
+        for entity_type in self.entity_types:
+            doc_ids = self.db_manager.doc_ids(entity_type)
+            await self.collection.delete_many({'type': entity_type, 'doc_id': {'$nin': doc_ids}})
+            for start in range(0, len(doc_ids), REBUILD_BATCH_SIZE):
+                await self.refresh(entity_type, doc_ids[start:start + REBUILD_BATCH_SIZE], propagate=False)
+            logger.info(f"Neighbor table rebuilt for {len(doc_ids)} {entity_type} items")
+
+    async def _ensure_indexes(self):
+        if not self._indexes_ready:
+            await self.collection.create_index([('type', ASCENDING), ('neighbors.id', ASCENDING)])
+            await self.collection.create_index([('doc_id', ASCENDING)])
+            self._indexes_ready = True
+
+def _key(entity_type: str, doc_id: str) -> str:
+    return f"{entity_type}:{doc_id}"
+
+neighbor_table = NeighborTable()
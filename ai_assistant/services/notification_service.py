@@ -8,6 +8,7 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import httpx
 import redis
+from bson import ObjectId
 from celery import Celery
 
 from ..config.database import db_manager
@@ -17,10 +18,27 @@ from ..models.notification import (
     NotificationStatus, NotificationPriority
 )
 
+# Recipients whose preferences and users are loaded with one $in query
+NOTIFICATION_CHUNK_SIZE = int(os.getenv("NOTIFICATION_CHUNK_SIZE", "1000"))
+# Chunks processed at once per notification
+NOTIFICATION_CHUNK_CONCURRENCY = int(os.getenv("NOTIFICATION_CHUNK_CONCURRENCY", "4"))
+# Per-recipient sends (email, SMS, push, webhook) in flight at once per chunk
+NOTIFICATION_SEND_CONCURRENCY = int(os.getenv("NOTIFICATION_SEND_CONCURRENCY", "20"))
+
+# Passed as user_data for recipients the bulk load didn't find, so they are skipped without a lookup
+USER_NOT_FOUND: Dict[str, Any] = {}
+
+def user_id_query(recipient_ids: List[str]) -> Dict[str, Any]:
+    """Users _id filter for recipient ids given as strings; user _ids are ObjectIds, string ids are kept too"""
+    ids = [ObjectId(recipient_id) for recipient_id in recipient_ids if ObjectId.is_valid(recipient_id)]
+    return {"$in": ids + list(recipient_ids)}
+
 class NotificationService:
     def __init__(self):
         self.redis_client = None
         self.celery_app = None
+        # Fan-out progress of notifications being processed by this worker
+        self.progress: Dict[str, Dict[str, Any]] = {}
         self._initialize_services()
     
     def _initialize_services(self):
@@ -126,21 +144,177 @@ class NotificationService:
             await self._process_notification(notification)
     
     async def _process_notification(self, notification: Notification):
-        for recipient_id in notification.recipients:
-            preferences = await self._get_user_preferences(recipient_id)
-            if not preferences:
+        """Fan a notification out to its recipients.
+
+        Recipients are split into chunks; each chunk loads its preferences (and users, for
+        email) with one $in query, applies quiet hours and channel rules in memory, writes
+        in-app rows and delivery records with insert_many and sends the other channels with
+        bounded concurrency. Chunks run a few at a time and progress is kept per notification.
+        """
+        if db_manager.db is None:
+            raise RuntimeError("Database connection is not initialized.")
+        notification_id = notification.id or ""
+        recipients = list(dict.fromkeys(notification.recipients))
+        progress = {
+            "total": len(recipients),
+            "processed": 0,
+            "skipped": 0,
+            "sent": 0,
+            "failed": 0,
+            "done": False,
+            "started_at": datetime.utcnow(),
+        }
+        self.progress[notification_id] = progress
+        # Same clock for every recipient's quiet hours
+        now = datetime.now().time()
+        semaphore = asyncio.Semaphore(NOTIFICATION_CHUNK_CONCURRENCY)
+        
+        async def process_chunk(recipient_ids: List[str]):
+            async with semaphore:
+                try:
+                    counts = await self._process_chunk(notification, recipient_ids, now)
+                except Exception as e:
+                    print(f"Error processing notification {notification_id} chunk: {e}")
+                    counts = {"skipped": 0, "sent": 0, "failed": len(recipient_ids)}
+                progress["processed"] += len(recipient_ids)
+                for name, count in counts.items():
+                    progress[name] += count
+                await self._save_progress(notification_id, progress)
+        
+        await asyncio.gather(*[
+            process_chunk(recipients[start:start + NOTIFICATION_CHUNK_SIZE])
+            for start in range(0, len(recipients), NOTIFICATION_CHUNK_SIZE)
+        ])
+        progress["done"] = True
+        progress["finished_at"] = datetime.utcnow()
+        status = NotificationStatus.FAILED if progress["failed"] and not progress["sent"] else NotificationStatus.SENT
+        await self._save_progress(notification_id, progress, status)
+        self.progress.pop(notification_id, None)
+    
+    async def _process_chunk(self, notification: Notification, recipient_ids: List[str], now: time) -> Dict[str, int]:
+        """Deliveries for one chunk of recipients. Counts are per delivery, skipped per recipient"""
+        cursor = db_manager.db.notification_preferences.find({"user_id": {"$in": recipient_ids}})
+        preferences = {
+            prefs_data["user_id"]: NotificationPreferences(**prefs_data)
+            async for prefs_data in cursor
+        }
+        users = {}
+        if NotificationChannel.EMAIL in notification.channels:
+            cursor = db_manager.db.users.find({"_id": user_id_query(recipient_ids)}, {"email": 1, "name": 1})
+            users = {str(user_data["_id"]): user_data async for user_data in cursor}
+        
+        targets: Dict[NotificationChannel, List[str]] = {channel: [] for channel in notification.channels}
+        skipped = 0
+        for recipient_id in recipient_ids:
+            recipient_preferences = preferences.get(recipient_id)
+            if not recipient_preferences:
+                skipped += 1
+                continue
+            if notification.priority != NotificationPriority.URGENT and self._is_quiet_hours(recipient_preferences, now):
+                skipped += 1
                 continue
-            
-            if self._is_quiet_hours(preferences):
-                if notification.priority != NotificationPriority.URGENT:
-                    continue
-            
-            # Send through enabled channels
             for channel in notification.channels:
-                if self._is_channel_enabled(channel, preferences, notification.type):
-                    await self._send_notification_channel(
-                        notification, recipient_id, channel
-                    )
+                if self._is_channel_enabled(channel, recipient_preferences, notification.type):
+                    targets[channel].append(recipient_id)
+        
+        deliveries: List[NotificationDelivery] = []
+        for channel, channel_recipients in targets.items():
+            if not channel_recipients:
+                continue
+            if channel == NotificationChannel.IN_APP:
+                deliveries.extend(await self._send_in_app_bulk(notification, channel_recipients))
+            else:
+                deliveries.extend(await self._send_each(notification, channel_recipients, channel, users))
+        if deliveries:
+            await db_manager.db.notification_deliveries.insert_many(
+                [delivery.dict() for delivery in deliveries], ordered=False
+            )
+        sent = sum(1 for delivery in deliveries if delivery.status == NotificationStatus.SENT)
+        return {"skipped": skipped, "sent": sent, "failed": len(deliveries) - sent}
+    
+    async def _send_in_app_bulk(self, notification: Notification, recipient_ids: List[str]) -> List[NotificationDelivery]:
+        created_at = datetime.utcnow()
+        rows = [
+            {
+                "user_id": recipient_id,
+                "title": notification.title,
+                "message": notification.message,
+                "type": notification.type,
+                "created_at": created_at,
+                "read": False,
+                "metadata": notification.metadata
+            }
+            for recipient_id in recipient_ids
+        ]
+        try:
+            await db_manager.db.in_app_notifications.insert_many(rows, ordered=False)
+        except Exception as e:
+            print(f"Error sending {NotificationChannel.IN_APP} notifications: {e}")
+            return [
+                self._delivery(notification.id or "", recipient_id, NotificationChannel.IN_APP, NotificationStatus.FAILED, str(e))
+                for recipient_id in recipient_ids
+            ]
+        
+        # Send to WebSocket if available, one round trip for the whole chunk
+        if self.redis_client:
+            try:
+                pipeline = self.redis_client.pipeline(transaction=False)
+                for row in rows:
+                    pipeline.publish(f"notifications:{row['user_id']}", json.dumps(row, default=str))
+                await asyncio.to_thread(pipeline.execute)
+            except Exception as e:
+                print(f"Error publishing in-app notifications: {e}")
+        return [
+            self._delivery(notification.id or "", recipient_id, NotificationChannel.IN_APP, NotificationStatus.SENT)
+            for recipient_id in recipient_ids
+        ]
+    
+    async def _send_each(
+        self,
+        notification: Notification,
+        recipient_ids: List[str],
+        channel: NotificationChannel,
+        users: Dict[str, Dict[str, Any]]
+    ) -> List[NotificationDelivery]:
+        semaphore = asyncio.Semaphore(NOTIFICATION_SEND_CONCURRENCY)
+        
+        async def send(recipient_id: str) -> NotificationDelivery:
+            async with semaphore:
+                try:
+                    if channel == NotificationChannel.EMAIL:
+                        await self._send_email_notification(notification, recipient_id, users.get(recipient_id, USER_NOT_FOUND))
+                    else:
+                        await self._send_to_channel(notification, recipient_id, channel)
+                except Exception as e:
+                    print(f"Error sending {channel} notification: {e}")
+                    return self._delivery(notification.id or "", recipient_id, channel, NotificationStatus.FAILED, str(e))
+                return self._delivery(notification.id or "", recipient_id, channel, NotificationStatus.SENT)
+        
+        return await asyncio.gather(*[send(recipient_id) for recipient_id in recipient_ids])
+    
+    async def _save_progress(self, notification_id: str, progress: Dict[str, Any], status: Optional[NotificationStatus] = None):
+        if not ObjectId.is_valid(notification_id):
+            return
+        update = {"progress": progress}
+        if status is not None:
+            update["status"] = status
+        try:
+            await db_manager.db.notifications.update_one({"_id": ObjectId(notification_id)}, {"$set": update})
+        except Exception as e:
+            print(f"Error saving notification {notification_id} progress: {e}")
+    
+    async def get_progress(self, notification_id: str) -> Optional[Dict[str, Any]]:
+        """Fan-out progress, live from this worker or as last saved by any worker"""
+        if notification_id in self.progress:
+            return dict(self.progress[notification_id])
+        if db_manager.db is None or not ObjectId.is_valid(notification_id):
+            return None
+        notification_data = await db_manager.db.notifications.find_one(
+            {"_id": ObjectId(notification_id)}, {"progress": 1, "status": 1}
+        )
+        if not notification_data:
+            return None
+        return dict(notification_data.get("progress") or {}, status=notification_data.get("status"))
     
     async def _get_user_preferences(self, user_id: str) -> Optional[NotificationPreferences]:
         if db_manager.db is None:
@@ -150,12 +324,12 @@ class NotificationService:
             return NotificationPreferences(**prefs_data)
         return None
     
-    def _is_quiet_hours(self, preferences: NotificationPreferences) -> bool:
+    def _is_quiet_hours(self, preferences: NotificationPreferences, current_time: Optional[time] = None) -> bool:
         """Check if current time is in quiet hours"""
         if not preferences.quiet_hours_start or not preferences.quiet_hours_end:
             return False
         
-        current_time = datetime.now().time()
+        current_time = current_time or datetime.now().time()
         start_time = time.fromisoformat(preferences.quiet_hours_start)
         end_time = time.fromisoformat(preferences.quiet_hours_end)
         
@@ -199,17 +373,7 @@ class NotificationService:
         channel: NotificationChannel
     ):
         try:
-            if channel == NotificationChannel.EMAIL:
-                await self._send_email_notification(notification, recipient_id)
-            elif channel == NotificationChannel.SMS:
-                await self._send_sms_notification(notification, recipient_id)
-            elif channel == NotificationChannel.PUSH:
-                await self._send_push_notification(notification, recipient_id)
-            elif channel == NotificationChannel.IN_APP:
-                await self._send_in_app_notification(notification, recipient_id)
-            elif channel == NotificationChannel.WEBHOOK:
-                await self._send_webhook_notification(notification, recipient_id)
-            
+            await self._send_to_channel(notification, recipient_id, channel)
             await self._record_delivery(notification.id or "", recipient_id, channel, NotificationStatus.SENT)
             
         except Exception as e:
@@ -219,11 +383,24 @@ class NotificationService:
                 NotificationStatus.FAILED, error_message=str(e)
             )
     
-    async def _send_email_notification(self, notification: Notification, recipient_id: str):
-        # Get user email
-        if db_manager.db is None:
-            raise RuntimeError("Database connection is not initialized.")
-        user_data = await db_manager.db.users.find_one({"_id": recipient_id})
+    async def _send_to_channel(self, notification: Notification, recipient_id: str, channel: NotificationChannel):
+        if channel == NotificationChannel.EMAIL:
+            await self._send_email_notification(notification, recipient_id)
+        elif channel == NotificationChannel.SMS:
+            await self._send_sms_notification(notification, recipient_id)
+        elif channel == NotificationChannel.PUSH:
+            await self._send_push_notification(notification, recipient_id)
+        elif channel == NotificationChannel.IN_APP:
+            await self._send_in_app_notification(notification, recipient_id)
+        elif channel == NotificationChannel.WEBHOOK:
+            await self._send_webhook_notification(notification, recipient_id)
+    
+    async def _send_email_notification(self, notification: Notification, recipient_id: str, user_data: Dict[str, Any] = None):
+        # Get user email, unless the caller already loaded it
+        if user_data is None:
+            if db_manager.db is None:
+                raise RuntimeError("Database connection is not initialized.")
+            user_data = await db_manager.db.users.find_one({"_id": user_id_query([recipient_id])})
         if not user_data or not user_data.get("email"):
             return
         
@@ -253,11 +430,13 @@ class NotificationService:
         
         msg.attach(MIMEText(body, 'plain'))
         
-        # Send email
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(msg)
+        # Send email, off the event loop since smtplib blocks
+        def send():
+            with smtplib.SMTP(smtp_server, smtp_port) as server:
+                server.starttls()
+                server.login(smtp_username, smtp_password)
+                server.send_message(msg)
+        await asyncio.to_thread(send)
     
     async def _send_sms_notification(self, notification: Notification, recipient_id: str):
         """Send SMS notification (placeholder)"""
@@ -316,7 +495,18 @@ class NotificationService:
         status: NotificationStatus,
         error_message: Optional[str] = None
     ):
-        delivery = NotificationDelivery(
+        delivery = self._delivery(notification_id, recipient_id, channel, status, error_message)
+        await db_manager.db.notification_deliveries.insert_one(delivery.dict())
+    
+    def _delivery(
+        self,
+        notification_id: str,
+        recipient_id: str,
+        channel: NotificationChannel,
+        status: NotificationStatus,
+        error_message: Optional[str] = None
+    ) -> NotificationDelivery:
+        return NotificationDelivery(
             notification_id=notification_id,
             recipient_id=recipient_id,
             channel=channel,
@@ -324,8 +514,6 @@ class NotificationService:
             sent_at=datetime.utcnow() if status == NotificationStatus.SENT else None,
             error_message=error_message
         )
-        
-        await db_manager.db.notification_deliveries.insert_one(delivery.dict())
     
     async def get_user_notifications(
         self, 
@@ -0,0 +1,156 @@
+import os
+import re
+from typing import List, Dict, Any, Optional
+
+# Prompt size limit in estimated tokens (instructions, history, products and question together)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1500"))
+# Longest product description text kept per item, in characters
+CONTEXT_TEXT_CHARS = int(os.getenv("PROMPT_CONTEXT_TEXT_CHARS", "300"))
+HISTORY_TURNS = 3
+HISTORY_TEXT_CHARS = 300
+SUMMARY_CHARS = 800
+QUERY_CHARS = 1000
+# Items whose word sets overlap this much with an earlier item add nothing new
+DUPLICATE_OVERLAP = 0.9
+
+CONTEXT_FIELDS = ['name', 'brand', 'category', 'price', 'gender', 'collections', 'sizes', 'colors', 'material']
+
+# Static parts, built once at import
+SYSTEM_PREAMBLE = (
+    "You are an expert fashion consultant and customer service representative for a premium clothing brand. "
+    "Give helpful, accurate and engaging answers about our products, policies and services."
+)
+GUIDELINES = "\n".join([
+    "Guidelines:",
+    "- Help the customer find the right products for their needs; recommend relevant items from the list when appropriate",
+    "- Be accurate about product features, materials and sizing, and explain policies (shipping, returns, sizing) clearly",
+    "- If the products listed don't cover the question, say so and give general guidance",
+    "- For follow-up questions keep the earlier conversation in mind; if the question is unclear, ask for clarification",
+    "- Be professional yet friendly, and give actionable advice",
+])
+CLOSING = "Answer:"
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English); no tokenizer needed"""
+    return (len(text) + 3) // 4
+
+# Preamble, guidelines, closing, the products header and the section separators
+FIXED_TOKENS = estimate_tokens("\n\n".join([SYSTEM_PREAMBLE, "Products:", GUIDELINES, CLOSING])) + 8
+
+def clean_text(text: Any) -> str:
+    return " ".join(str(text).split())
+
+def shorten(text: str, max_chars: int) -> str:
+    """Leading sentences that fit max_chars, or the leading words if the first sentence doesn't"""
+    if len(text) <= max_chars:
+        return text
+    kept = ""
+    for sentence in _SENTENCE_END.split(text):
+        candidate = f"{kept} {sentence}".strip()
+        if len(candidate) > max_chars:
+            break
+        kept = candidate
+    if not kept:
+        kept = text[:max_chars].rsplit(" ", 1)[0]
+    return kept + "…"
+
+def format_item(item: Dict[str, Any], text_chars: int) -> str:
+    """One compact line per product: "name; brand: x; sizes: S, M; about: ..." """
+    parts = []
+    for field in CONTEXT_FIELDS:
+        value = item.get(field)
+        if value in (None, "", []):
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ", ".join(clean_text(entry) for entry in value)
+        value = clean_text(value)
+        parts.append(value if field == 'name' else f"{field}: {value}")
+    about = _item_text(item)
+    if about and text_chars > 0:
+        parts.append(f"about: {shorten(about, text_chars)}")
+    return "- " + "; ".join(parts)
+
+def _item_text(item: Dict[str, Any]) -> str:
+    # The indexed content starts with the name and repeats category and brand; keep what it adds
+    text = clean_text(item.get('content') or item.get('description') or "")
+    name = clean_text(item.get('name') or "")
+    if name and text.startswith(name):
+        text = text[len(name):].strip()
+    repeated = clean_text(" ".join(str(item.get(field) or "") for field in ('category', 'brand', 'material')))
+    position = text.rfind(repeated) if repeated else -1
+    if position > 0:
+        text = clean_text(text[:position] + text[position + len(repeated):])
+    return text
+
+class PromptBuilder:
+    """Assembles the chat prompt within a token budget.
+
+    The instructions are fixed; the question comes next (capped), then the conversation
+    summary and as many recent turns as fit, then retrieved products in rank order. Products are
+    deduplicated by id and by word overlap, rendered one compact line each, and an item
+    that doesn't fit with its description is tried without it before building stops.
+    """
+
+    def __init__(self, token_budget: int = PROMPT_TOKEN_BUDGET, text_chars: int = CONTEXT_TEXT_CHARS):
+        self.token_budget = token_budget
+        self.text_chars = text_chars
+
+    def build(self, query: str, context: List[Dict[str, Any]],
+              conversation_history: Optional[List[Dict[str, Any]]] = None, summary: Optional[str] = None) -> str:
+        question = f"Customer question: {shorten(clean_text(query), QUERY_CHARS)}"
+        remaining = self.token_budget - FIXED_TOKENS - estimate_tokens(question)
+
+        summary_text = ""
+        if summary:
+            summary_text = f"Earlier in this conversation: {shorten(clean_text(summary), SUMMARY_CHARS)}"
+            cost = estimate_tokens(summary_text) + 1
+            if cost > remaining:
+                summary_text = ""
+            else:
+                remaining -= cost
+
+        history_lines = []
+        for message in reversed((conversation_history or [])[-HISTORY_TURNS:]):
+            turn = (f"Customer: {shorten(clean_text(message.get('content', '')), HISTORY_TEXT_CHARS)}\n"
+                    f"Assistant: {shorten(clean_text(message.get('response', '')), HISTORY_TEXT_CHARS)}")
+            cost = estimate_tokens(turn) + 1
+            if cost > remaining:
+                break
+            history_lines.insert(0, turn)
+            remaining -= cost
+
+        product_lines = []
+        for item in self._dedupe(context):
+            for text_chars in (self.text_chars, 0):
+                line = format_item(item, text_chars)
+                cost = estimate_tokens(line) + 1
+                if cost <= remaining:
+                    product_lines.append(line)
+                    remaining -= cost
+                    break
+            else:
+                break
+
+        sections = [SYSTEM_PREAMBLE]
+        if summary_text or history_lines:
+            sections.append("\n".join(["Conversation so far:"] + ([summary_text] if summary_text else []) + history_lines))
+        sections.append("Products:\n" + ("\n".join(product_lines) if product_lines else "(none found)"))
+        sections.extend([question, GUIDELINES, CLOSING])
+        return "\n\n".join(sections)
+
+    def _dedupe(self, context: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        kept, seen_ids, seen_words = [], set(), []
+        for item in context:
+            key = (item.get('type'), item.get('id'))
+            if item.get('id') is not None and key in seen_ids:
+                continue
+            words = set(_WORD.findall(f"{item.get('name', '')} {item.get('content', '')}".lower()))
+            if words and any(len(words & other) / len(words | other) >= DUPLICATE_OVERLAP for other in seen_words):
+                continue
+            seen_ids.add(key)
+            seen_words.append(words)
+            kept.append(item)
+        return kept
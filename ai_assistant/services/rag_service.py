@@ -1,139 +1,196 @@
-from sentence_transformers import SentenceTransformer
-import google.generativeai as genai
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator
 import os
+import asyncio
 from dotenv import load_dotenv
 from datetime import datetime
-import json
 import logging
-from config.database import db_manager
+from ..config.database import db_manager
+from ..config.embeddings import get_embedding
+from ..config.llm_client import llm_client
+from ..config.response_cache import ResponseCache, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_THRESHOLD, context_fingerprint
+from ..config.query_cache import normalize_query
+from ..config.single_flight import single_flight
+from .prompt_builder import PromptBuilder
+from .session_memory import session_memory
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-gemini = genai.GenerativeModel('gemini-pro')
-
-CACHE_TTL = 3600
+# Lifetime of cached answers in seconds, 0 disables the response cache
+CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# Chat answers are grounded in the catalogue only; orders and users never reach the prompt
+CHAT_CONTEXT_FILTERS = {"type": "product", "is_published": True}
+FALLBACK_RESPONSE = "I'm having trouble processing your request right now. Please try again later or contact our customer support team for assistance."
 
 class RAGService:
     def __init__(self):
         self.db_manager = db_manager
-        self.model = model
-        self.gemini = gemini
+        self.llm = llm_client
+        self.prompt_builder = PromptBuilder()
+        self.session_memory = session_memory
+        self.response_cache = ResponseCache(CACHE_TTL, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_THRESHOLD)
     
-    def create_embedding(self, text: str) -> List[float]:
-       # embedding using sentence transformers
-        return self.model.encode(text).tolist()
+    async def create_embedding(self, text: str) -> List[float]:
+        # Shared model, batcher and cache from config.embeddings
+        return await get_embedding(text)
     
-    def create_prompt(self, query: str, context: List[Dict[str, Any]], conversation_history: List[Dict[str, Any]] = None) -> str:
-        # context and conversation history
-
-        def sanitize_text(text: str) -> str:
-            return text.replace("\n", " ").replace("\r", " ").strip()
-        
-        query = sanitize_text(query)
-        history_context = ""
-        if conversation_history:
-            history_context = "\nPrevious conversation context:\n" + "\n".join(
-                f"User: {msg['content']}\nAssistant: {msg['response']}"
-                for msg in conversation_history[-3:]
-            )
-        
-        context_json = json.dumps([
-            {k: sanitize_text(str(v)) for k, v in item.items() if k in ['name', 'description', 'category', 'brand', 'price', 'gender', 'collections', 'sizes', 'colors', 'material', 'content']}
-            for item in context
-        ], indent=2)
-
-        return f"""You are an expert fashion consultant and customer service representative for a premium clothing brand. Your role is to provide helpful, accurate, and engaging responses about our products, policies, and services.
-
-{history_context}
-Available Product Information:
-{context_json}
-User Question: {query}
-
-Guidelines for your response:
-1. Focus on helping customers find the right products for their needs
-2. Provide accurate information about product features, materials, and sizing
-3. Explain our policies (shipping, returns, sizing) clearly
-4. If the context doesn't provide enough information, acknowledge this and provide general guidance
-5. Keep the response helpful and informative
-6. Include relevant product recommendations when appropriate
-7. Maintain a professional yet friendly tone
-8. If this is a follow-up question, maintain context from the previous conversation
-9. If the question is unclear, ask for clarification
-10. Always prioritize customer satisfaction and provide actionable advice
-
-Please provide a comprehensive and helpful response:"""
+    def create_prompt(self, query: str, context: List[Dict[str, Any]], conversation_history: List[Dict[str, Any]] = None,
+                      summary: str = None) -> str:
+        # Compact, deduplicated and capped at PROMPT_TOKEN_BUDGET
+        return self.prompt_builder.build(query, context, conversation_history, summary)
     
-    async def generate_response(self, query: str, context: List[Dict[str, Any]], conversation_history: List[Dict[str, Any]] = None) -> str:
-        prompt = self.create_prompt(query, context, conversation_history)
+    async def generate_response(self, query: str, context: List[Dict[str, Any]], conversation_history: List[Dict[str, Any]] = None,
+                                summary: str = None) -> str:
+        prompt = self.create_prompt(query, context, conversation_history, summary)
         
         try:
-            response = await self.gemini.generate_content(prompt)
-            return response.text
+            return await self.llm.generate(prompt)
         except Exception as e:
             logger.error(f"Error generating response: {e}")
-            # Fallback response
-            return "I'm having trouble processing your request right now. Please try again later or contact our customer support team for assistance."
+            return self.retrieval_only_response(context)
+    
+    def retrieval_only_response(self, context: List[Dict[str, Any]]) -> str:
+        """Answer built from the retrieved products alone, for when the model is unavailable"""
+        if not context:
+            return FALLBACK_RESPONSE
+        lines = []
+        for item in context:
+            details = ", ".join(str(item[field]) for field in ('brand', 'category') if item.get(field))
+            line = f"- {item.get('name') or item.get('content', '')[:80]}"
+            if details:
+                line += f" ({details})"
+            if item.get('price') is not None:
+                line += f": {item['price']}"
+            lines.append(line)
+        return ("I can't put together a detailed answer right now, but these products match your question:\n"
+                + "\n".join(lines))
+    
+    async def generate_response_stream(self, query: str, context: List[Dict[str, Any]],
+                                       conversation_history: List[Dict[str, Any]] = None, summary: str = None) -> AsyncIterator[str]:
+        """Response text chunks as Gemini produces them. Errors are raised to the caller"""
+        prompt = self.create_prompt(query, context, conversation_history, summary)
+        async for text in self.llm.stream(prompt):
+            yield text
     
-    async def get_relevant_context(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+    async def _shared_response_stream(self, query: str, context: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """Like generate_response_stream, but identical questions asked meanwhile (same
+        normalized text and context) wait for this generation instead of starting their own.
+        The first one streams; the others get the whole answer as one chunk"""
+        chunks = asyncio.Queue()
+        
+        async def generate():
+            parts = []
+            async for text in self.generate_response_stream(query, context):
+                parts.append(text)
+                chunks.put_nowait(text)
+            return "".join(parts)
+        
+        key = f"chat:{normalize_query(query)}:{context_fingerprint(context)}"
+        flight = asyncio.ensure_future(single_flight.do(key, generate))
+        streamed = False
         try:
-            query_embedding = self.create_embedding(query)
-            results = await self.db_manager.semantic_search(query, top_k)
+            while True:
+                getter = asyncio.ensure_future(chunks.get())
+                await asyncio.wait({getter, flight}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    break
+                streamed = True
+                yield getter.result()
+            while not chunks.empty():
+                streamed = True
+                yield chunks.get_nowait()
+            response_text = flight.result()
+            if not streamed:
+                yield response_text
+        finally:
+            # Only stops waiting: the shared generation carries on for the others
+            flight.cancel()
+    
+    async def get_relevant_context(self, query: str, top_k: int = 5, filters: Dict[str, Any] = None,
+                                   query_embedding: List[float] = None) -> List[Dict[str, Any]]:
+        try:
+            # One off-loop encode per message, reused for the search
+            if query_embedding is None:
+                query_embedding = await self.create_embedding(query)
+            # Keyword hits (order numbers, brands, sizes) fused with the dense ones
+            results = await self.db_manager.hybrid_search(query, top_k, filters=filters, query_embedding=query_embedding)
             return results
         except Exception as e:
             logger.error(f"Error getting context: {e}")
             return []
     
-    async def process_chat_message(self, query: str, user_id: str, session_id: str = None) -> Dict[str, Any]:
+    async def process_chat_message(self, query: str, user_id: str, session_id: str = None, use_cache: bool = True) -> Dict[str, Any]:
         try:
-            context = await self.get_relevant_context(query, top_k=3)
-            conversation_history = []
-            response_text = await self.generate_response(query, context, conversation_history)
-            chat_session = {
-                'session_id': session_id or f"session_{user_id}_{int(datetime.now().timestamp())}",
-                'user_id': user_id,
-                'messages': [
-                    {
-                        'role': 'user',
-                        'content': query,
-                        'timestamp': datetime.now()
-                    },
-                    {
-                        'role': 'assistant',
-                        'content': response_text,
-                        'timestamp': datetime.now()
-                    }
-                ],
-                'created_at': datetime.now(),
-                'updated_at': datetime.now()
-            }
-            
-            # Save to db
-            if self.db_manager.db is not None:
-                await self.db_manager.db.chat_sessions.update_one(
-                    {'session_id': chat_session['session_id']},
-                    {'$set': chat_session},
-                    upsert=True
-                )
-            
-            return {
-                'response': response_text,
-                'confidence': 0.9,  
-                'sources': context,
-                'session_id': chat_session['session_id']
-            }
-            
+            async for event in self.stream_chat_message(query, user_id, session_id, use_cache):
+                if event['type'] == 'done':
+                    return event['message']
         except Exception as e:
             logger.error(f"Error processing chat message: {e}")
-            return {
-                'response': "I'm having trouble processing your request right now. Please try again later.",
-                'confidence': 0.0,
-                'sources': [],
-                'session_id': session_id
+        return {
+            'response': "I'm having trouble processing your request right now. Please try again later.",
+            'confidence': 0.0,
+            'sources': [],
+            'session_id': session_id
+        }
+    
+    async def stream_chat_message(self, query: str, user_id: str, session_id: str = None,
+                                  use_cache: bool = True) -> AsyncIterator[Dict[str, Any]]:
+        """Chat events in order: one 'sources', a 'token' per response chunk, then one 'done'
+        carrying the complete message, which is saved to the session before it is yielded"""
+        session_id = session_id or f"session_{user_id}_{int(datetime.now().timestamp())}"
+        query_embedding = await self.create_embedding(query)
+        context = await self.get_relevant_context(query, top_k=3, filters=CHAT_CONTEXT_FILTERS, query_embedding=query_embedding)
+        # Recent turns and the summary of older ones, from memory for an active session
+        memory = await self.session_memory.get(session_id, user_id)
+        conversation_history = list(memory.turns)
+        
+        # Follow-ups depend on the conversation, not only on the query and context
+        cacheable = use_cache and not conversation_history and not memory.summary
+        cached = self.response_cache.get(query_embedding, context) if cacheable else None
+        if not cacheable:
+            self.response_cache.bypassed += 1
+        yield {'type': 'sources', 'session_id': session_id, 'sources': context}
+        
+        if cached is not None:
+            response_text, cache_similarity = cached
+            yield {'type': 'token', 'text': response_text}
+        else:
+            cache_similarity = None
+            chunks = []
+            try:
+                if cacheable:
+                    # No history, so the answer only depends on the question and context: share it
+                    stream = self._shared_response_stream(query, context)
+                else:
+                    stream = self.generate_response_stream(query, context, conversation_history, memory.summary)
+                async for text in stream:
+                    chunks.append(text)
+                    yield {'type': 'token', 'text': text}
+                complete = True
+            except Exception as e:
+                logger.error(f"Error generating response: {e}")
+                complete = False
+                if not chunks:
+                    chunks.append(self.retrieval_only_response(context))
+                    yield {'type': 'token', 'text': chunks[0]}
+            response_text = "".join(chunks)
+            if complete and cacheable:
+                self.response_cache.set(query_embedding, context, response_text)
+        
+        await self.session_memory.append(session_id, user_id, query, response_text)
+        yield {
+            'type': 'done',
+            'message': {
+                'response': response_text,
+                'confidence': 0.9,
+                'sources': context,
+                'session_id': session_id,
+                'cached': cache_similarity is not None,
+                'cache_similarity': cache_similarity
             }
+        }
+
 rag_service = RAGService() 
\ No newline at end of file
@@ -0,0 +1,159 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+from ..config.database import db_manager
+from ..config.llm_client import llm_client
+from .prompt_builder import shorten, clean_text
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Turns kept verbatim per session; older ones are rolled into the summary
+SESSION_RECENT_TURNS = int(os.getenv("SESSION_RECENT_TURNS", "3"))
+SESSION_SUMMARY_CHARS = int(os.getenv("SESSION_SUMMARY_CHARS", "800"))
+# Sessions kept in memory per worker
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))
+
+class SessionState:
+    def __init__(self, user_id: str, turns: List[Dict[str, str]], summary: str = ""):
+        self.user_id = user_id
+        # {'content': user message, 'response': assistant message}, oldest first
+        self.turns = turns
+        self.summary = summary
+        # Turns that left the window and are not in the summary yet
+        self.rolled: List[Dict[str, str]] = []
+        self.summary_task: Optional[asyncio.Task] = None
+
+class SessionMemory:
+    """Conversation memory of chat sessions.
+
+    Hot sessions live in an in-process LRU, so a turn in an active conversation reads
+    nothing from MongoDB; a cold session is loaded once with just its last messages and
+    summary. Each turn is appended to chat_sessions with $push. Only the last
+    SESSION_RECENT_TURNS turns are kept verbatim; older ones are folded into a rolling
+    summary by the LLM in the background (a trimmed extract if the model is unavailable),
+    so the history handed to the prompt has a constant size.
+    """
+
+    def __init__(self, recent_turns: int = SESSION_RECENT_TURNS, max_sessions: int = SESSION_CACHE_SIZE):
+        self.db_manager = db_manager
+        self.recent_turns = recent_turns
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, SessionState]" = OrderedDict()
+        self.hits = 0
+        self.loads = 0
+        self.summaries = 0
+
+    async def get(self, session_id: str, user_id: str) -> SessionState:
+        state = self._sessions.get(session_id)
+        if state is not None and state.user_id == user_id:
+            self._sessions.move_to_end(session_id)
+            self.hits += 1
+            return state
+        state = await self._load(session_id, user_id)
+        self._remember(session_id, state)
+        return state
+
+    async def append(self, session_id: str, user_id: str, query: str, response_text: str):
+        """Record one exchange, in MongoDB and in the session window"""
+        state = await self.get(session_id, user_id)
+        now = datetime.now()
+        if self.db_manager.db is not None:
+            # Scoped to the user: a session id of another user's conversation starts a separate one
+            await self.db_manager.db.chat_sessions.update_one(
+                {'session_id': session_id, 'user_id': user_id},
+                {
+                    '$push': {'messages': {'$each': [
+                        {'role': 'user', 'content': query, 'timestamp': now},
+                        {'role': 'assistant', 'content': response_text, 'timestamp': now},
+                    ]}},
+                    '$set': {'updated_at': now},
+                    '$setOnInsert': {'created_at': now},
+                },
+                upsert=True
+            )
+
+        state.turns.append({'content': query, 'response': response_text})
+        while len(state.turns) > self.recent_turns:
+            state.rolled.append(state.turns.pop(0))
+        if state.rolled and (state.summary_task is None or state.summary_task.done()):
+            state.summary_task = asyncio.create_task(self._roll_up(session_id, state))
+
+    def forget(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    async def _load(self, session_id: str, user_id: str) -> SessionState:
+        self.loads += 1
+        if self.db_manager.db is None:
+            return SessionState(user_id, [])
+        document = await self.db_manager.db.chat_sessions.find_one(
+            {'session_id': session_id, 'user_id': user_id},
+            {'messages': {'$slice': -2 * self.recent_turns}, 'summary': 1}
+        )
+        if not document:
+            return SessionState(user_id, [])
+        turns, question = [], None
+        for message in document.get('messages', []):
+            if message.get('role') == 'user':
+                question = message.get('content', '')
+            elif message.get('role') == 'assistant' and question is not None:
+                turns.append({'content': question, 'response': message.get('content', '')})
+                question = None
+        return SessionState(user_id, turns[-self.recent_turns:], document.get('summary', ''))
+
+    def _remember(self, session_id: str, state: SessionState):
+        self._sessions[session_id] = state
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    async def _roll_up(self, session_id: str, state: SessionState):
+        while state.rolled:
+            turns, state.rolled = state.rolled, []
+            state.summary = await self._summarize(state.summary, turns)
+            self.summaries += 1
+            if self.db_manager.db is not None:
+                try:
+                    await self.db_manager.db.chat_sessions.update_one(
+                        {'session_id': session_id, 'user_id': state.user_id},
+                        {'$set': {'summary': state.summary, 'summary_updated_at': datetime.now()}}
+                    )
+                except Exception as e:
+                    logger.error(f"Error saving summary of chat session {session_id}: {e}")
+
+    async def _summarize(self, summary: str, turns: List[Dict[str, str]]) -> str:
+        transcript = "\n".join(
+            f"Customer: {clean_text(turn['content'])}\nAssistant: {shorten(clean_text(turn['response']), 600)}"
+            for turn in turns
+        )
+        prompt = (
+            "Update the summary of a conversation between a customer and a fashion store assistant. "
+            f"Keep it under {SESSION_SUMMARY_CHARS // 6} words and keep products, sizes, preferences, "
+            "order details and open questions.\n\n"
+            f"Summary so far: {summary or '(empty)'}\n\nNew messages:\n{transcript}\n\nUpdated summary:"
+        )
+        try:
+            return shorten(clean_text(await llm_client.generate(prompt)), SESSION_SUMMARY_CHARS)
+        except Exception as e:
+            logger.warning(f"Summarizing chat session without the LLM: {e}")
+        extract = " ".join(
+            f"Customer asked: {shorten(clean_text(turn['content']), 150)} Assistant: {shorten(clean_text(turn['response']), 200)}"
+            for turn in turns
+        )
+        combined = f"{summary} {extract}".strip()
+        # Newest information wins when the extract outgrows the limit
+        return combined[-SESSION_SUMMARY_CHARS:]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "hits": self.hits,
+            "loads": self.loads,
+            "summaries": self.summaries,
+        }
+
+session_memory = SessionMemory()
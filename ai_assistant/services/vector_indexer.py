@@ -1,212 +1,195 @@
 import asyncio
-from typing import List, Dict, Any
-from config.database import db_manager
-from config.embeddings import get_embeddings_batch, get_embedding
+from typing import List, Dict, Any, Tuple
+from bson import ObjectId
+from ..config.database import db_manager
+from ..config.embeddings import get_embeddings_array, get_embedding
+from .neighbor_table import neighbor_table
 import logging
+import os
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+INDEX_BATCH_SIZE = int(os.getenv("VECTOR_INDEX_BATCH_SIZE", "256"))
+# Batches buffered between pipeline stages
+PIPELINE_QUEUE_SIZE = int(os.getenv("VECTOR_INDEX_QUEUE_SIZE", "2"))
+
+async def _run_pipeline(*stages):
+    """Run pipeline stages together. The first failure cancels the rest and is re-raised"""
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+def id_filter(document_id: Any) -> Dict[str, Any]:
+    """Match a document by an id given as a string, whether _id is an ObjectId or a string"""
+    if isinstance(document_id, str) and ObjectId.is_valid(document_id):
+        return {'_id': {'$in': [ObjectId(document_id), document_id]}}
+    return {'_id': document_id}
+
+def product_document(product: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Text to embed and metadata to store for a product"""
+    # Create text representation for embedding
+    text_content = f"{product.get('name', '')} {product.get('description', '')} {product.get('category', '')} {product.get('brand', '')} {product.get('material', '')} {' '.join(product.get('tags', []))}"
+    
+    # Create metadata
+    metadata = {
+        'type': 'product',
+        'id': str(product['_id']),
+        'name': product.get('name', ''),
+        'category': product.get('category', ''),
+        'brand': product.get('brand', ''),
+        'price': product.get('price', 0),
+        'gender': product.get('gender', ''),
+        'collections': product.get('collections', []),
+        'sizes': product.get('sizes', []),
+        'colors': product.get('colors', []),
+        'is_featured': product.get('isFeatured', False),
+        'is_published': product.get('isPublished', True),
+        'content': text_content
+    }
+    return text_content, metadata
+
+def order_document(order: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Text to embed and metadata to store for an order"""
+    # Create text representation for embedding
+    items_text = ' '.join([f"{item.get('name', '')} {item.get('size', '')} {item.get('color', '')}" for item in order.get('orderItems', [])])
+    text_content = f"Order {order.get('orderNumber', '')} {order.get('status', '')} {order.get('shippingAddress', {}).get('address', '')} {items_text}"
+    
+    # Create metadata
+    metadata = {
+        'type': 'order',
+        'id': str(order['_id']),
+        'order_number': order.get('orderNumber', ''),
+        'status': order.get('status', ''),
+        'total_price': order.get('totalPrice', 0),
+        'user_id': str(order.get('user', '')),
+        'items_count': len(order.get('orderItems', [])),
+        'created_at': order.get('createdAt', ''),
+        'content': text_content
+    }
+    return text_content, metadata
+
+def user_document(user: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Text to embed and metadata to store for a user"""
+    # Create text representation for embedding
+    text_content = f"{user.get('name', '')} {user.get('email', '')} {user.get('role', '')}"
+    
+    # Create metadata
+    metadata = {
+        'type': 'user',
+        'id': str(user['_id']),
+        'name': user.get('name', ''),
+        'email': user.get('email', ''),
+        'role': user.get('role', 'user'),
+        'is_admin': user.get('role') == 'admin',
+        'content': text_content
+    }
+    return text_content, metadata
+
+# Indexed collections and how to turn their documents into vectors
+DOCUMENT_BUILDERS = {
+    'products': product_document,
+    'orders': order_document,
+    'users': user_document,
+}
+
 class VectorIndexer:
     def __init__(self):
         self.db_manager = db_manager
     
-    async def index_products(self) -> Dict[str, Any]:
-        """Index all products for semantic search"""
-        try:
-            products = await self.db_manager.get_products_for_indexing()
-            indexed_count = 0
-            
-            # Prepare texts for batch processing
-            texts = []
-            metadata_list = []
-            
-            for product in products:
-                # Create text representation for embedding
-                text_content = f"{product.get('name', '')} {product.get('description', '')} {product.get('category', '')} {product.get('brand', '')} {product.get('material', '')} {' '.join(product.get('tags', []))}"
-                
-                # Create metadata
-                metadata = {
-                    'type': 'product',
-                    'id': str(product['_id']),
-                    'name': product.get('name', ''),
-                    'category': product.get('category', ''),
-                    'brand': product.get('brand', ''),
-                    'price': product.get('price', 0),
-                    'gender': product.get('gender', ''),
-                    'collections': product.get('collections', []),
-                    'sizes': product.get('sizes', []),
-                    'colors': product.get('colors', []),
-                    'is_featured': product.get('isFeatured', False),
-                    'is_published': product.get('isPublished', True),
-                    'content': text_content
-                }
-                
-                texts.append(text_content)
-                metadata_list.append(metadata)
-            
-            # Get embeddings in batch
-            if texts:
-                embeddings = await get_embeddings_batch(texts)
-                
-                # Add to vector index
-                for embedding, metadata in zip(embeddings, metadata_list):
-                    await self.db_manager.add_to_vector_index(embedding, metadata)
-                    indexed_count += 1
-            
-            logger.info(f"Indexed {indexed_count} products")
-            return {
-                'status': 'success',
-                'indexed_count': indexed_count,
-                'data_type': 'products'
-            }
-        except Exception as e:
-            logger.error(f"Error indexing products: {e}")
-            return {
-                'status': 'error',
-                'error': str(e),
-                'data_type': 'products'
-            }
+    async def index_products(self, commit: bool = True) -> Dict[str, Any]:
+        """Index all products for semantic search. With commit=False the caller must flush the index"""
+        return await self._index_collection('products', commit)
     
-    async def index_orders(self) -> Dict[str, Any]:
-        """Index all orders for semantic search"""
-        try:
-            orders = await self.db_manager.get_orders_for_indexing()
-            indexed_count = 0
-            
-            # Prepare texts for batch processing
-            texts = []
-            metadata_list = []
-            
-            for order in orders:
-                # Create text representation for embedding
-                items_text = ' '.join([f"{item.get('name', '')} {item.get('size', '')} {item.get('color', '')}" for item in order.get('orderItems', [])])
-                text_content = f"Order {order.get('orderNumber', '')} {order.get('status', '')} {order.get('shippingAddress', {}).get('address', '')} {items_text}"
-                
-                # Create metadata
-                metadata = {
-                    'type': 'order',
-                    'id': str(order['_id']),
-                    'order_number': order.get('orderNumber', ''),
-                    'status': order.get('status', ''),
-                    'total_price': order.get('totalPrice', 0),
-                    'user_id': str(order.get('user', '')),
-                    'items_count': len(order.get('orderItems', [])),
-                    'created_at': order.get('createdAt', ''),
-                    'content': text_content
-                }
-                
-                texts.append(text_content)
-                metadata_list.append(metadata)
-            
-            # Get embeddings in batch
-            if texts:
-                embeddings = await get_embeddings_batch(texts)
-                
-                # Add to vector index
-                for embedding, metadata in zip(embeddings, metadata_list):
-                    await self.db_manager.add_to_vector_index(embedding, metadata)
-                    indexed_count += 1
-            
-            logger.info(f"Indexed {indexed_count} orders")
-            return {
-                'status': 'success',
-                'indexed_count': indexed_count,
-                'data_type': 'orders'
-            }
-        except Exception as e:
-            logger.error(f"Error indexing orders: {e}")
-            return {
-                'status': 'error',
-                'error': str(e),
-                'data_type': 'orders'
-            }
+    async def index_orders(self, commit: bool = True) -> Dict[str, Any]:
+        """Index all orders for semantic search. With commit=False the caller must flush the index"""
+        return await self._index_collection('orders', commit)
     
-    async def index_users(self) -> Dict[str, Any]:
-        """Index all users for semantic search"""
+    async def index_users(self, commit: bool = True) -> Dict[str, Any]:
+        """Index all users for semantic search. With commit=False the caller must flush the index"""
+        return await self._index_collection('users', commit)
+    
+    async def _index_collection(self, collection: str, commit: bool = True, staged: bool = False) -> Dict[str, Any]:
+        """Stream a collection through fetch -> encode -> index stages.
+        
+        The stages run concurrently and are joined by bounded queues, so Mongo I/O overlaps
+        with CPU encoding and peak memory depends on the batch size, not the collection size.
+        With staged the vectors go into the rebuild in progress instead of the live index.
+        """
         try:
-            users = await self.db_manager.get_users_for_indexing()
+            build_document = DOCUMENT_BUILDERS[collection]
+            to_encode = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            to_index = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
             indexed_count = 0
             
-            # Prepare texts for batch processing
-            texts = []
-            metadata_list = []
+            async def fetch():
+                async for documents in self.db_manager.iter_for_indexing(collection, INDEX_BATCH_SIZE):
+                    texts, metadata_list = [], []
+                    for document in documents:
+                        text_content, metadata = build_document(document)
+                        texts.append(text_content)
+                        metadata_list.append(metadata)
+                    await to_encode.put((texts, metadata_list))
+                await to_encode.put(None)
             
-            for user in users:
-                # Create text representation for embedding
-                text_content = f"{user.get('name', '')} {user.get('email', '')} {user.get('role', '')}"
-                
-                # Create metadata
-                metadata = {
-                    'type': 'user',
-                    'id': str(user['_id']),
-                    'name': user.get('name', ''),
-                    'email': user.get('email', ''),
-                    'role': user.get('role', 'user'),
-                    'is_admin': user.get('role') == 'admin',
-                    'content': text_content
-                }
-                
-                texts.append(text_content)
-                metadata_list.append(metadata)
+            async def encode():
+                while (batch := await to_encode.get()) is not None:
+                    texts, metadata_list = batch
+                    await to_index.put((await get_embeddings_array(texts), metadata_list))
+                await to_index.put(None)
             
-            # Get embeddings in batch
-            if texts:
-                embeddings = await get_embeddings_batch(texts)
-                
-                # Add to vector index
-                for embedding, metadata in zip(embeddings, metadata_list):
-                    await self.db_manager.add_to_vector_index(embedding, metadata)
-                    indexed_count += 1
+            async def index():
+                nonlocal indexed_count
+                while (batch := await to_index.get()) is not None:
+                    embeddings, metadata_list = batch
+                    await self.db_manager.add_many_to_vector_index(embeddings, metadata_list, staged=staged)
+                    indexed_count += len(metadata_list)
             
-            logger.info(f"Indexed {indexed_count} users")
+            await _run_pipeline(fetch(), encode(), index())
+            if commit:
+                await self.db_manager.flush_vector_index()
+            
+            logger.info(f"Indexed {indexed_count} {collection}")
             return {
                 'status': 'success',
                 'indexed_count': indexed_count,
-                'data_type': 'users'
+                'data_type': collection
             }
         except Exception as e:
-            logger.error(f"Error indexing users: {e}")
+            logger.error(f"Error indexing {collection}: {e}")
             return {
                 'status': 'error',
                 'error': str(e),
-                'data_type': 'users'
+                'data_type': collection
             }
     
     async def index_specific_product(self, product_id: str) -> Dict[str, Any]:
         """Index a specific product"""
         try:
-            product = await self.db_manager.db.products.find_one({'_id': product_id})
+            product = await self.db_manager.db.products.find_one(id_filter(product_id))
             if not product:
+                # Deleted upstream, drop the stale vector
+                await self.db_manager.remove_vector(str(product_id))
+                await neighbor_table.remove([str(product_id)])
                 return {
                     'status': 'error',
                     'error': 'Product not found',
                     'data_type': 'product'
                 }
             
-            # Create text representation for embedding
-            text_content = f"{product.get('name', '')} {product.get('description', '')} {product.get('category', '')} {product.get('brand', '')} {product.get('material', '')} {' '.join(product.get('tags', []))}"
-            
-            # Create metadata
-            metadata = {
-                'type': 'product',
-                'id': str(product['_id']),
-                'name': product.get('name', ''),
-                'category': product.get('category', ''),
-                'brand': product.get('brand', ''),
-                'price': product.get('price', 0),
-                'gender': product.get('gender', ''),
-                'collections': product.get('collections', []),
-                'sizes': product.get('sizes', []),
-                'colors': product.get('colors', []),
-                'is_featured': product.get('isFeatured', False),
-                'is_published': product.get('isPublished', True),
-                'content': text_content
-            }
+            text_content, metadata = product_document(product)
             
             # Get embedding
             embedding = await get_embedding(text_content)
-            await self.db_manager.add_to_vector_index(embedding, metadata)
+            await self.db_manager.upsert_vector(metadata['id'], embedding, metadata)
+            await neighbor_table.refresh('product', [metadata['id']])
             
             logger.info(f"Indexed product: {product.get('name', '')}")
             return {
@@ -226,34 +209,21 @@ class VectorIndexer:
     async def index_specific_order(self, order_id: str) -> Dict[str, Any]:
         """Index a specific order"""
         try:
-            order = await self.db_manager.db.orders.find_one({'_id': order_id})
+            order = await self.db_manager.db.orders.find_one(id_filter(order_id))
             if not order:
+                # Deleted upstream, drop the stale vector
+                await self.db_manager.remove_vector(str(order_id))
                 return {
                     'status': 'error',
                     'error': 'Order not found',
                     'data_type': 'order'
                 }
             
-            # Create text representation for embedding
-            items_text = ' '.join([f"{item.get('name', '')} {item.get('size', '')} {item.get('color', '')}" for item in order.get('orderItems', [])])
-            text_content = f"Order {order.get('orderNumber', '')} {order.get('status', '')} {order.get('shippingAddress', {}).get('address', '')} {items_text}"
-            
-            # Create metadata
-            metadata = {
-                'type': 'order',
-                'id': str(order['_id']),
-                'order_number': order.get('orderNumber', ''),
-                'status': order.get('status', ''),
-                'total_price': order.get('totalPrice', 0),
-                'user_id': str(order.get('user', '')),
-                'items_count': len(order.get('orderItems', [])),
-                'created_at': order.get('createdAt', ''),
-                'content': text_content
-            }
+            text_content, metadata = order_document(order)
             
             # Get embedding
             embedding = await get_embedding(text_content)
-            await self.db_manager.add_to_vector_index(embedding, metadata)
+            await self.db_manager.upsert_vector(metadata['id'], embedding, metadata)
             
             logger.info(f"Indexed order: {order.get('orderNumber', '')}")
             return {
@@ -271,27 +241,36 @@ class VectorIndexer:
             }
     
     async def full_reindex(self) -> Dict[str, Any]:
-        """Perform full reindex of all data"""
+        """Perform full reindex of all data.
+        
+        Everything is indexed into fresh shards while searches keep using the current ones,
+        which are replaced only if every collection was indexed.
+        """
         try:
             logger.info("Starting full reindex...")
-            
-            # Clear existing index
-            await self.db_manager.save_vector_index()
+            await self.db_manager.begin_rebuild()
             
             # Index all data types
             results = {}
+            try:
+                for collection in DOCUMENT_BUILDERS:
+                    results[collection] = await self._index_collection(collection, commit=False, staged=True)
+            except BaseException:
+                self.db_manager.abort_rebuild()
+                raise
+            failed = [collection for collection, result in results.items() if result.get('status') != 'success']
+            if failed:
+                self.db_manager.abort_rebuild()
+                logger.error(f"Full reindex failed for {', '.join(failed)}, keeping the current index")
+                return {
+                    'status': 'error',
+                    'error': f"Indexing failed for {', '.join(failed)}",
+                    'results': results
+                }
             
-            # Index products
-            product_result = await self.index_products()
-            results['products'] = product_result
-            
-            # Index orders
-            order_result = await self.index_orders()
-            results['orders'] = order_result
-            
-            # Index users
-            user_result = await self.index_users()
-            results['users'] = user_result
+            # Swap in and persist everything once
+            await self.db_manager.finish_rebuild()
+            await neighbor_table.rebuild()
             
             # Calculate totals
             total_indexed = sum(
@@ -317,26 +296,24 @@ class VectorIndexer:
     async def get_index_stats(self) -> Dict[str, Any]:
         """Get statistics about the vector index"""
         try:
-            if not self.db_manager.vector_index:
+            if not self.db_manager.shards:
                 return {
                     'status': 'error',
                     'error': 'Vector index not initialized'
                 }
             
-            total_vectors = self.db_manager.vector_index.ntotal
+            total_vectors = self.db_manager.vector_count()
             dimension = self.db_manager.vector_dimension
             
             # Get counts by type
-            type_counts = {}
-            for metadata in self.db_manager.vector_mapping:
-                data_type = metadata.get('type', 'unknown')
-                type_counts[data_type] = type_counts.get(data_type, 0) + 1
+            type_counts = self.db_manager.type_counts()
             
             return {
                 'status': 'success',
                 'total_vectors': total_vectors,
                 'dimension': dimension,
                 'type_counts': type_counts,
+                'shards': {name: len(shard) for name, shard in self.db_manager.shards.items()},
                 'index_size_mb': total_vectors * dimension * 4 / (1024 * 1024),  # Approximate size in MB
                 'embedding_method': 'sentence_transformers'
             }
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the package as ai_assistant.*, the way the app runs it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
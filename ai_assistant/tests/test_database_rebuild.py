@@ -0,0 +1,43 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from ai_assistant.config.database import DatabaseManager
+
+DIMENSION = 8
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", "flat")
+    db_manager = DatabaseManager()
+    db_manager.vector_dimension = DIMENSION
+    db_manager._create_shards()
+    return db_manager
+
+def products(*doc_ids):
+    vectors = np.random.default_rng(len(doc_ids)).standard_normal((len(doc_ids), DIMENSION)).astype(np.float32)
+    return list(doc_ids), vectors, [{"id": doc_id, "type": "product"} for doc_id in doc_ids]
+
+def test_rebuild_serves_the_old_index_until_it_is_swapped_in(manager):
+    async def scenario():
+        await manager.upsert_vectors(*products("old", "kept"))
+        await manager.begin_rebuild()
+        await manager.upsert_vectors(*products("kept", "new"), staged=True)
+        # A live change while the rebuild runs reaches both
+        await manager.upsert_vectors(*products("live"))
+        assert sorted(manager.doc_ids("product")) == ["kept", "live", "old"]
+        await manager.finish_rebuild()
+
+    asyncio.run(scenario())
+    assert sorted(manager.doc_ids("product")) == ["kept", "live", "new"]
+
+def test_aborted_rebuild_keeps_the_current_index(manager):
+    async def scenario():
+        await manager.upsert_vectors(*products("old"))
+        await manager.begin_rebuild()
+        await manager.upsert_vectors(*products("new"), staged=True)
+        manager.abort_rebuild()
+
+    asyncio.run(scenario())
+    assert manager.doc_ids("product") == ["old"]
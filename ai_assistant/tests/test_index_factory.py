@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from ai_assistant.config.index_factory import (
+    INDEX_TYPES, IndexConfig, build_trained_index, create_initial_index, index_type_of, search_parameters
+)
+
+DIMENSION = 16
+
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((400, DIMENSION)).astype(np.float32)
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+def make_config(monkeypatch, index_type: str) -> IndexConfig:
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", index_type)
+    monkeypatch.setenv("VECTOR_IVF_NLIST", "4")
+    monkeypatch.setenv("VECTOR_PQ_M", "4")
+    monkeypatch.setenv("VECTOR_NPROBE", "4")
+    return IndexConfig()
+
+def assert_finds_itself(index, config, vectors, ids):
+    scores, labels = index.search(vectors[:10], 1, params=search_parameters(index, config))
+    assert labels[:, 0].tolist() == ids[:10].tolist()
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+def test_initial_index_adds_and_searches(monkeypatch, vectors, index_type):
+    config = make_config(monkeypatch, index_type)
+    index = create_initial_index(config, DIMENSION)
+    ids = np.arange(100, 100 + len(vectors), dtype=np.int64)
+    index.add_with_ids(vectors, ids)
+    assert index.ntotal == len(vectors)
+    expected = "flat" if config.needs_training else index_type
+    assert index_type_of(index) == expected
+    assert_finds_itself(index, config, vectors, ids)
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+def test_trained_index_builds_adds_and_searches(monkeypatch, vectors, index_type):
+    config = make_config(monkeypatch, index_type)
+    ids = np.arange(len(vectors), dtype=np.int64) * 2
+    index = build_trained_index(config, DIMENSION, vectors, ids)
+    assert index.ntotal == len(vectors)
+    assert index_type_of(index) == index_type
+    if index_type == "ivfpq":
+        # PQ codes are lossy, the exact vector need not rank first
+        scores, labels = index.search(vectors[:10], 10, params=search_parameters(index, config))
+        assert all(ids[i] in labels[i] for i in range(10))
+    else:
+        assert_finds_itself(index, config, vectors, ids)
+    # IVF indexes need the direct map for reconstruct and remove by id
+    assert np.allclose(index.reconstruct(int(ids[3])), vectors[3], atol=0.2)
+    if index_type != "hnsw":
+        # HNSW can't remove; IdMappedIndex tombstones its dead slots instead
+        assert index.remove_ids(np.array([ids[0]], dtype=np.int64)) == 1
@@ -0,0 +1,104 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from ai_assistant.services.neighbor_table import NeighborTable
+
+class MemoryCollection:
+    """The parts of a motor collection the neighbor table uses, over a dict of documents"""
+
+    def __init__(self):
+        self.documents = {}
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def find_one(self, query):
+        return self.documents.get(query['_id'])
+
+    async def distinct(self, field, query):
+        ids = set(query['neighbors.id']['$in'])
+        excluded = set(query['doc_id']['$nin'])
+        return [
+            document[field] for document in self.documents.values()
+            if document['type'] == query['type'] and document['doc_id'] not in excluded
+            and ids & {item['id'] for item in document['neighbors']}
+        ]
+
+    async def delete_many(self, query):
+        for key in [key for key, document in self.documents.items() if document['doc_id'] in query['doc_id']['$in']]:
+            del self.documents[key]
+
+    async def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            key, update = operation._filter['_id'], operation._doc
+            if '$set' in update:
+                self.documents[key] = dict(self.documents.get(key, {}), **update['$set'])
+            elif key in self.documents:
+                push = update['$push']['neighbors']
+                neighbors = self.documents[key]['neighbors'] + push['$each']
+                neighbors.sort(key=lambda item: -item['score'])
+                self.documents[key]['neighbors'] = neighbors[:push['$slice']]
+
+class MemoryIndex:
+    """Stands in for db_manager: items on a line, closer means more similar"""
+
+    def __init__(self, positions):
+        self.positions = dict(positions)
+        self.db = type("Db", (), {"vector_neighbors": MemoryCollection()})()
+
+    def get_indexed(self, entity_type, doc_ids, with_vectors=True):
+        found = [doc_id for doc_id in doc_ids if doc_id in self.positions]
+        return found, None, [{'id': doc_id, 'type': entity_type} for doc_id in found]
+
+    async def similar_items_many(self, entity_type, doc_ids, k):
+        similar = {}
+        for doc_id in doc_ids:
+            if doc_id not in self.positions:
+                continue
+            others = sorted(
+                (other for other in self.positions if other != doc_id),
+                key=lambda other: abs(self.positions[other] - self.positions[doc_id])
+            )[:k]
+            similar[doc_id] = [
+                {'id': other, 'score': -abs(self.positions[other] - self.positions[doc_id])} for other in others
+            ]
+        return similar
+
+@pytest.fixture
+def table():
+    neighbor_table = NeighborTable()
+    neighbor_table.k = 2
+    neighbor_table.entity_types = ['product']
+    neighbor_table.db_manager = MemoryIndex({'a': 0, 'b': 1, 'c': 2, 'd': 10, 'e': 11})
+    return neighbor_table
+
+def neighbor_ids(table, doc_id):
+    return [item['id'] for item in table.collection.documents[f"product:{doc_id}"]['neighbors']]
+
+def test_moved_item_leaves_full_lists_behind(table):
+    async def scenario():
+        await table.refresh('product', list(table.db_manager.positions), propagate=False)
+        # c moves next to d and e; a and b must find a new second neighbour
+        table.db_manager.positions['c'] = 12
+        await table.refresh('product', ['c'])
+
+    asyncio.run(scenario())
+    assert neighbor_ids(table, 'a') == ['b', 'd']
+    assert neighbor_ids(table, 'b') == ['a', 'd']
+    assert sorted(neighbor_ids(table, 'c')) == ['d', 'e']
+    assert all(len(item['neighbors']) == 2 for item in table.collection.documents.values())
+    for doc_id in table.db_manager.positions:
+        ids = neighbor_ids(table, doc_id)
+        assert len(ids) == len(set(ids))
+
+def test_get_falls_back_when_neighbours_are_gone(table):
+    async def scenario():
+        await table.refresh('product', list(table.db_manager.positions), propagate=False)
+        assert [item['id'] for item in await table.get('product', 'a', 2)] == ['b', 'c']
+        # Removed from the index but not from the table yet
+        del table.db_manager.positions['c']
+        return await table.get('product', 'a', 2)
+
+    assert asyncio.run(scenario()) is None
@@ -0,0 +1,27 @@
+import asyncio
+
+from ai_assistant.config.single_flight import SingleFlight
+
+def test_callers_sharing_a_flight_get_their_own_results():
+    single_flight = SingleFlight(scope="local")
+    runs = []
+
+    async def search():
+        runs.append(1)
+        await asyncio.sleep(0.01)
+        return [{"id": "p1", "score": 0.9}]
+
+    async def caller(rank):
+        hits = await single_flight.do("search:shirt", search)
+        # Callers annotate hits in place, e.g. with a fused rank
+        hits[0]["rank"] = rank
+        await asyncio.sleep(0)
+        return hits
+
+    async def scenario():
+        return await asyncio.gather(*(caller(rank) for rank in range(3)))
+
+    results = asyncio.run(scenario())
+    assert len(runs) == 1
+    assert [hits[0]["rank"] for hits in results] == [0, 1, 2]
+    assert single_flight.followers == 2
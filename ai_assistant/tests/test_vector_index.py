@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from ai_assistant.config.index_factory import IndexConfig, build_trained_index, index_type_of
+from ai_assistant.config.vector_index import IdMappedIndex
+
+DIMENSION = 8
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", "flat")
+    return IndexConfig()
+
+def unit_vectors(count: int, seed: int) -> np.ndarray:
+    data = np.random.default_rng(seed).standard_normal((count, DIMENSION)).astype(np.float32)
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+def test_replaying_ops_from_two_writers_keeps_documents_apart(config):
+    # Two processes append to the same log, each numbering slots from zero
+    logged = []
+    for writer, doc_ids in enumerate((["p0", "p1"], ["p2", "p3"])):
+        id_index = IdMappedIndex(config, DIMENSION)
+        applied_ids, _, vectors, metadata = id_index.upsert(
+            doc_ids, unit_vectors(2, writer), [{"id": doc_id} for doc_id in doc_ids]
+        )
+        logged.append((applied_ids, vectors, metadata))
+
+    replayed = IdMappedIndex(config, DIMENSION)
+    for doc_ids, vectors, metadata in logged:
+        replayed.upsert(doc_ids, vectors, metadata)
+
+    assert sorted(replayed.doc_slots.values()) == [0, 1, 2, 3]
+    _, vectors, _ = logged[1]
+    scores, labels = replayed.search(vectors[:1], 1, None, None)
+    assert replayed.metadata[int(labels[0][0])]["id"] == "p2"
+
+def test_upsert_replaces_previous_vector(config):
+    id_index = IdMappedIndex(config, DIMENSION)
+    first, second = unit_vectors(2, 7)
+    id_index.upsert(["a"], first[None], [{"id": "a", "version": 1}])
+    id_index.upsert(["a"], second[None], [{"id": "a", "version": 2}])
+    assert len(id_index) == 1
+    scores, labels = id_index.search(second[None], 2, None, None)
+    assert [id_index.metadata[int(label)]["version"] for label in labels[0] if label >= 0] == [2]
+
+@pytest.mark.parametrize("index_type", ["ivfflat", "ivfpq", "hnsw"])
+def test_selective_filter_still_returns_k_hits(monkeypatch, index_type):
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", index_type)
+    monkeypatch.setenv("VECTOR_IVF_NLIST", "4")
+    monkeypatch.setenv("VECTOR_PQ_M", "4")
+    monkeypatch.setenv("VECTOR_NPROBE", "1")
+    monkeypatch.setenv("VECTOR_EF_SEARCH", "4")
+    # Force the approximate path, the filter is "large"
+    monkeypatch.setattr("ai_assistant.config.vector_index.FILTER_EXACT_MAX", 0)
+    config = IndexConfig()
+    id_index = IdMappedIndex(config, DIMENSION)
+    doc_ids = [f"p{i}" for i in range(400)]
+    id_index.upsert(doc_ids, unit_vectors(400, 3), [{"id": doc_id, "rare": i % 40 == 0} for i, doc_id in enumerate(doc_ids)])
+    slots, vectors = id_index.begin_rebuild()
+    id_index.finish_rebuild(build_trained_index(config, DIMENSION, vectors, slots))
+    assert index_type_of(id_index.index) == index_type
+
+    allowed = id_index.filter_slots({"rare": True})
+    assert len(allowed) == 10
+    scores, labels = id_index.search(unit_vectors(5, 4), 10, None, None, allowed=allowed)
+    for row in labels:
+        assert sorted(row.tolist()) == sorted(allowed.tolist())
@@ -0,0 +1,91 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from ai_assistant.config.index_factory import IndexConfig
+from ai_assistant.config.vector_shard import VectorShard
+
+DIMENSION = 8
+
+class MemoryLogStore:
+    """The parts of VectorLogStore a shard uses to append and sync, kept in a list"""
+
+    def __init__(self):
+        self.segments = []
+        self.next_seq = 0
+
+    async def manifest(self):
+        return {"snapshot_id": None, "last_seq": 0, "epoch": None}
+
+    async def append_ops(self, ops):
+        seqs = []
+        for op in ops:
+            self.next_seq += 1
+            self.segments.append((self.next_seq, op))
+            seqs.append(self.next_seq)
+        return seqs
+
+    async def iter_segments(self, after_seq=0):
+        for seq, op in list(self.segments):
+            if seq > after_seq:
+                yield seq, op
+
+@pytest.fixture
+def shards(monkeypatch):
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", "flat")
+    store = MemoryLogStore()
+    pair = [VectorShard("product_index", None, IndexConfig(), DIMENSION) for _ in range(2)]
+    for shard in pair:
+        shard.store = store
+    return pair
+
+def unit_vectors(count: int, seed: int) -> np.ndarray:
+    data = np.random.default_rng(seed).standard_normal((count, DIMENSION)).astype(np.float32)
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+def test_sync_applies_segments_of_other_writers_only(shards):
+    leader, follower = shards
+
+    async def scenario():
+        leader.upsert(["p1", "p2"], unit_vectors(2, 1), [{"id": "p1"}, {"id": "p2"}])
+        await leader.flush()
+        follower.upsert(["p3"], unit_vectors(1, 2), [{"id": "p3"}])
+        await follower.flush()
+        leader.remove(["p1"])
+        await leader.flush()
+
+        assert await follower.sync() == 2
+        assert await leader.sync() == 1
+        # Nothing new the second time
+        assert await follower.sync() == 0
+
+    asyncio.run(scenario())
+    for shard in shards:
+        assert sorted(shard.id_index.doc_slots) == ["p2", "p3"]
+        assert shard._last_seq == 3
+        assert not shard._own_seqs
+
+def test_flush_after_clear_writes_one_snapshot_and_no_segments(shards, monkeypatch, tmp_path):
+    monkeypatch.setattr("ai_assistant.config.local_snapshot.LOCAL_SNAPSHOT_DIR", str(tmp_path))
+    shard = shards[0]
+    snapshots = []
+
+    async def write_snapshot(index_bytes, rows, last_seq, dimension, reset=False):
+        snapshots.append((rows, reset))
+        return "snapshot-1"
+    shard.store.write_snapshot = write_snapshot
+
+    async def scenario():
+        shard.clear()
+        for batch in range(3):
+            doc_ids = [f"p{batch}-{i}" for i in range(4)]
+            shard.upsert(doc_ids, unit_vectors(4, batch), [{"id": doc_id} for doc_id in doc_ids])
+        await shard.flush()
+
+    asyncio.run(scenario())
+    assert shard.store.segments == []
+    assert len(snapshots) == 1
+    rows, reset = snapshots[0]
+    assert reset and len(rows) == 12
+    assert shard._epoch == "snapshot-1"